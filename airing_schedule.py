@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按放送时间安排搜索
+根据追番列表（weekday / begin_time，缺少时取放送表）算出每部番剧最近一集的播出时间（JST），
+播出后 first_check_delay_minutes 分钟第一次搜索，没找到时按退避间隔（每次翻倍）继续检查，
+找到新集数或超过 check_deadline_hours 后停止，等下一集播出。
+检查状态保存在 data/airing_state.json 中，调度器重启后不会重复检查已找到的剧集。
+命令行: python airing_schedule.py    列出每部番剧最近一集的播出时间和下一次检查时间
+"""
+
+import datetime
+import json
+import os
+import sys
+
+from search_torrents import WATCHLIST_FILE, build_schedule_backup, resolve_air_time
+from state_store import atomic_write_json, read_json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
+STATE_FILE = os.path.join(PROJECT_ROOT, 'data/airing_state.json')
+DEFAULT_WEEKDAYS = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def get_airing_settings(config):
+    """读取 scheduler 中的检查间隔配置（缺省时使用默认值）"""
+    global_config = (config or {}).get('global_settings', {})
+    settings = (config or {}).get('scheduler', {})
+    return {
+        'tz': datetime.timezone(datetime.timedelta(hours=global_config.get('jst_timezone_offset', 9))),
+        'weekdays': global_config.get('chinese_weekdays') or DEFAULT_WEEKDAYS,
+        'seasonal_file': os.path.join(PROJECT_ROOT, (config or {}).get('seasonal_fetcher', {}).get(
+            'output_file', 'data/seasonal_anime_list.json')),
+        # 播出后多久第一次搜索（字幕组通常需要一段时间才能发布）
+        'first_check_delay_minutes': settings.get('first_check_delay_minutes', 30),
+        # 第一次没找到后的检查间隔，之后每次乘以 check_backoff_factor
+        'check_backoff_minutes': settings.get('check_backoff_minutes', 30),
+        'check_backoff_factor': settings.get('check_backoff_factor', 2),
+        # 播出后超过这个时间仍没找到就不再检查，等下一集
+        'check_deadline_hours': settings.get('check_deadline_hours', 48),
+    }
+
+
+def check_offsets(settings):
+    """每次检查相对播出时间的偏移，例如默认配置为 0.5h, 1h, 2h, 4h, 8h, 16h, 32h"""
+    deadline = datetime.timedelta(hours=settings['check_deadline_hours'])
+    offset = datetime.timedelta(minutes=settings['first_check_delay_minutes'])
+    interval = datetime.timedelta(minutes=settings['check_backoff_minutes'])
+    offsets = []
+    while offset <= deadline:
+        offsets.append(offset)
+        offset += interval
+        interval *= settings['check_backoff_factor']
+    return offsets
+
+
+def latest_airing(weekday, time_of_day, now):
+    """now 之前（含）最近一次播出的时间"""
+    air = datetime.datetime.combine(now.date(), time_of_day, tzinfo=now.tzinfo)
+    air -= datetime.timedelta(days=(air.weekday() - weekday) % 7)
+    if air > now:
+        air -= datetime.timedelta(days=7)
+    return air
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class AiringSchedule:
+    """每部番剧当前这一集的检查计划（只在调度器进程内使用）"""
+
+    def __init__(self, config, state_path=STATE_FILE, watchlist_path=WATCHLIST_FILE):
+        self.settings = get_airing_settings(config)
+        self.offsets = check_offsets(self.settings)
+        self.state_path = state_path
+        self.watchlist_path = watchlist_path
+        # state: {番剧名: {'air_time', 'checks', 'last_check', 'found_at'}}
+        self.state = read_json(state_path, {})
+        self.shows = {}
+        self.sources_mtime = None
+
+    def now(self):
+        return datetime.datetime.now(self.settings['tz'])
+
+    def reload_shows(self):
+        """追番列表或放送表修改后重新计算每部番剧的放送时间"""
+        sources = (self.watchlist_path, self.settings['seasonal_file'])
+        mtime = tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in sources)
+        if mtime == self.sources_mtime:
+            return
+        self.sources_mtime = mtime
+        watchlist = read_json(self.watchlist_path, {})
+        schedule_backup = build_schedule_backup(read_json(self.settings['seasonal_file'], []))
+        self.shows = {}
+        for title, anime_config in watchlist.items():
+            try:
+                air_info = resolve_air_time(title, anime_config, schedule_backup, self.settings['weekdays'])
+            except ValueError as e:
+                print_error(f"番剧 {title} 的放送时间无效: {e}")
+                continue
+            if not air_info:
+                continue
+            weekday, time_of_day, _, _ = air_info
+            begin_date = parse_date(anime_config.get('begin_date')
+                                    or schedule_backup.get(title, {}).get('begin_date'))
+            self.shows[title] = {'weekday': weekday, 'time': time_of_day, 'begin_date': begin_date}
+        for title in [t for t in self.state if t not in self.shows]:
+            del self.state[title]
+
+    def current_airing(self, title, now):
+        """(最近一集的播出时间, 检查状态)；番剧还没开播时播出时间为 None"""
+        show = self.shows[title]
+        air = latest_airing(show['weekday'], show['time'], now)
+        if show['begin_date'] and air.date() < show['begin_date']:
+            return None, None
+        entry = self.state.get(title)
+        if not entry or entry['air_time'] != air.isoformat():
+            entry = {'air_time': air.isoformat(), 'checks': 0, 'last_check': None, 'found_at': None}
+        return air, entry
+
+    def next_check(self, title, now):
+        """下一次检查的时间（不晚于 now 表示已到期）"""
+        air, entry = self.current_airing(title, now)
+        if air is not None and not entry['found_at'] and entry['checks'] < len(self.offsets) \
+                and now <= air + self.offsets[-1]:
+            return air + self.offsets[entry['checks']]
+        # 本集已找到或已过截止时间：下一集播出后第一次检查
+        show = self.shows[title]
+        next_air = latest_airing(show['weekday'], show['time'], now) + datetime.timedelta(days=7)
+        while show['begin_date'] and next_air.date() < show['begin_date']:
+            next_air += datetime.timedelta(days=7)
+        return next_air + self.offsets[0] if self.offsets else next_air
+
+    def due(self, now=None):
+        """到期需要检查的番剧"""
+        now = now or self.now()
+        self.reload_shows()
+        return [title for title in self.shows if self.next_check(title, now) <= now]
+
+    def upcoming(self, now=None):
+        """(下一次检查的时间, 番剧列表)，没有可安排的番剧时返回 (None, [])"""
+        now = now or self.now()
+        self.reload_shows()
+        checks = {title: self.next_check(title, now) for title in self.shows}
+        if not checks:
+            return None, []
+        when = min(checks.values())
+        return when, [title for title, at in checks.items() if at == when]
+
+    def record(self, titles, found_titles, now=None):
+        """
+        记录一次检查的结果。调度器停机错过的检查不再补做：
+        检查次数至少推进到 now 之前的偏移数，下一次检查按之后的退避间隔进行
+        """
+        now = now or self.now()
+        self.reload_shows()
+        for title in titles:
+            if title not in self.shows:
+                continue
+            air, entry = self.current_airing(title, now)
+            if air is None:
+                continue
+            elapsed = sum(1 for offset in self.offsets if air + offset <= now)
+            entry['checks'] = max(entry['checks'] + 1, elapsed)
+            entry['last_check'] = now.isoformat(timespec='seconds')
+            if title in found_titles:
+                entry['found_at'] = entry['last_check']
+            self.state[title] = entry
+        atomic_write_json(self.state_path, self.state)
+
+
+def main():
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    schedule = AiringSchedule(config)
+    now = schedule.now()
+    schedule.reload_shows()
+    offsets = ', '.join(f"{offset.total_seconds() / 3600:g}h" for offset in schedule.offsets)
+    print_info(f"当前 JST 时间: {now.strftime('%Y-%m-%d %H:%M')}，播出后检查: {offsets}")
+    for title in sorted(schedule.shows, key=lambda t: schedule.next_check(t, now)):
+        air, entry = schedule.current_airing(title, now)
+        state = '未开播'
+        if air is not None:
+            state = f"最近播出 {air.strftime('%m-%d %H:%M')}，已检查 {entry['checks']} 次"
+            if entry['found_at']:
+                state += '，已找到'
+        print_info(f"{title}: {state}，下次检查 {schedule.next_check(title, now).strftime('%m-%d %H:%M')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,11 @@ import os
 import sys
 from flask import Flask, render_template, request, jsonify
 from bangumi_api import BangumiAPI, convert_calendar_to_seasonal_list, load_bangumi_token_from_config
+from jobs import run_job
+from log_store import read_run, tail_lines
+from progress_events import current_run_id, read_events, snapshot
+from state_store import atomic_write_json, file_lock
+from timer_scheduler import notify_scheduler, read_status
 
 # --- 配置 ---
 CONFIG_FILE = 'data/config.json'
@@ -25,10 +30,11 @@ def load_config():
         return {}
 
 def save_config(config_data):
-    """保存完整的 config.json"""
+    """保存完整的 config.json（原子写入）"""
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config_data, f, ensure_ascii=False, indent=4)
+        atomic_write_json(CONFIG_FILE, config_data, indent=4)
+        # 让正在运行的调度器按新配置重新安排检查
+        notify_scheduler()
         return True
     except Exception as e:
         print(f"Error saving {CONFIG_FILE}: {e}", file=sys.stderr)
@@ -46,10 +52,11 @@ def load_watchlist():
         return {}
 
 def save_watchlist(watchlist_data):
-    """保存追番列表"""
+    """保存追番列表（原子写入）"""
     try:
-        with open(WATCHLIST_FILE, 'w', encoding='utf-8') as f:
-            json.dump(watchlist_data, f, ensure_ascii=False, indent=4)
+        atomic_write_json(WATCHLIST_FILE, watchlist_data, indent=4)
+        # 让正在运行的调度器按新的放送时间重新安排检查
+        notify_scheduler()
         return True
     except Exception as e:
         print(f"Error saving {WATCHLIST_FILE}: {e}", file=sys.stderr)
@@ -133,34 +140,37 @@ def save_watchlist_route():
             if alt_name and alt_name != anime.get('primary_title'):
                 anime_info_map[alt_name] = anime
     
-    # 加载当前追番列表
-    current_watchlist = load_watchlist()
-    new_watchlist = {}
+    # 读改写期间持有锁，避免与其他请求/进程互相覆盖
+    with file_lock(WATCHLIST_FILE):
+        # 加载当前追番列表
+        current_watchlist = load_watchlist()
+        new_watchlist = {}
     
-    # 1. 移除 (取消勾选的)
-    # 2. 保留 (继续勾选的) - 保持原有配置
-    # 3. 添加 (新勾选的) - 使用默认配置并添加放送时间信息
-    for title in selected_titles:
-        if title in current_watchlist:
-            # 保留旧的配置
-            new_watchlist[title] = current_watchlist[title]
-            # 更新或添加放送时间信息（如果有的话）
-            if title in anime_info_map:
-                anime_info = anime_info_map[title]
-                new_watchlist[title]['weekday'] = anime_info.get('weekday', '')
-                new_watchlist[title]['begin_time'] = anime_info.get('begin_time', '00:00')
-                new_watchlist[title]['begin_date'] = anime_info.get('begin_date', '')
-        else:
-            # 新添加的番剧，设置默认搜索词和放送时间
-            anime_info = anime_info_map.get(title, {})
-            new_watchlist[title] = {
-                "search_keys": [title, "1080p"],
-                "weekday": anime_info.get('weekday', ''),
-                "begin_time": anime_info.get('begin_time', '00:00'),
-                "begin_date": anime_info.get('begin_date', '')
-            }
-
-    if save_watchlist(new_watchlist):
+        # 1. 移除 (取消勾选的)
+        # 2. 保留 (继续勾选的) - 保持原有配置
+        # 3. 添加 (新勾选的) - 使用默认配置并添加放送时间信息
+        for title in selected_titles:
+            if title in current_watchlist:
+                # 保留旧的配置
+                new_watchlist[title] = current_watchlist[title]
+                # 更新或添加放送时间信息（如果有的话）
+                if title in anime_info_map:
+                    anime_info = anime_info_map[title]
+                    new_watchlist[title]['weekday'] = anime_info.get('weekday', '')
+                    new_watchlist[title]['begin_time'] = anime_info.get('begin_time', '00:00')
+                    new_watchlist[title]['begin_date'] = anime_info.get('begin_date', '')
+            else:
+                # 新添加的番剧，设置默认搜索词和放送时间
+                anime_info = anime_info_map.get(title, {})
+                new_watchlist[title] = {
+                    "search_keys": [title, "1080p"],
+                    "weekday": anime_info.get('weekday', ''),
+                    "begin_time": anime_info.get('begin_time', '00:00'),
+                    "begin_date": anime_info.get('begin_date', '')
+                }
+        saved = save_watchlist(new_watchlist)
+
+    if saved:
         print("[*] watchlist.json 更新成功!")
         return jsonify({"status": "success", "message": "追番列表已更新!"})
     else:
@@ -186,8 +196,8 @@ def refresh_seasonal():
         
         # 保存到文件
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(seasonal_list, f, ensure_ascii=False, indent=4)
+            atomic_write_json(output_file, seasonal_list, indent=4)
+            notify_scheduler()
             
             print(f"[*] 成功保存 {len(seasonal_list)} 部动画到 {output_file}")
             return jsonify({
@@ -203,109 +213,99 @@ def refresh_seasonal():
         print(f"[!] 更新失败: {e}", file=sys.stderr)
         return jsonify({"error": f"更新失败: {str(e)}"}), 500
 
-@app.route('/api/search_torrents', methods=['POST'])
-def search_torrents():
-    """API: 调用 search_torrents.py 脚本进行种子搜索"""
-    import subprocess
-    
-    script_path = os.path.join(os.path.dirname(__file__), 'search_torrents.py')
-    
-    if not os.path.exists(script_path):
-        return jsonify({"error": "search_torrents.py 脚本未找到"}), 500
-    
+def job_response(job_name, label, timeout):
+    """执行搜索 / 下载作业（进程内或子进程，见 jobs.py）并整理为接口响应"""
     try:
-        print("[*] 开始执行 search_torrents.py...")
-        result = subprocess.run(
-            [sys.executable, script_path],
-            check=True,
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            timeout=300  # 搜索可能需要更长时间
-        )
-        # 合并 stdout 和 stderr 以显示完整输出
-        full_output = result.stdout
-        if result.stderr:
-            full_output += "\n" + result.stderr
-        
-        print(f"[*] 搜索完成")
-        return jsonify({
-            "status": "success",
-            "message": "种子搜索完成！",
-            "output": full_output,
-            "stdout": result.stdout,
-            "stderr": result.stderr
-        })
-    except subprocess.TimeoutExpired:
-        return jsonify({"error": "搜索超时"}), 500
-    except subprocess.CalledProcessError as e:
-        print(f"[!] 搜索失败: {e.stderr}", file=sys.stderr)
-        return jsonify({"error": f"搜索失败: {e.stderr}"}), 500
+        print(f"[*] 开始执行{label}作业...")
+        result = run_job(job_name, timeout=timeout)
     except Exception as e:
         print(f"[!] 未知错误: {e}", file=sys.stderr)
         return jsonify({"error": f"未知错误: {str(e)}"}), 500
 
+    if not result['success']:
+        detail = result['stderr'] or result['error']
+        print(f"[!] {label}失败: {detail}", file=sys.stderr)
+        return jsonify({"error": f"{label}失败: {detail}"}), 500
+
+    # 合并 stdout 和 stderr 以显示完整输出
+    full_output = result['stdout']
+    if result['stderr']:
+        full_output += "\n" + result['stderr']
+
+    print(f"[*] {label}完成")
+    return jsonify({
+        "status": "success",
+        "message": "种子搜索完成！" if job_name == 'search' else "下载任务完成！",
+        "output": full_output,
+        "stdout": result['stdout'],
+        "stderr": result['stderr']
+    })
+
+@app.route('/api/search_torrents', methods=['POST'])
+def search_torrents():
+    """API: 执行种子搜索作业"""
+    return job_response('search', '搜索', timeout=300)  # 搜索可能需要更长时间
+
 @app.route('/api/start_download', methods=['POST'])
 def start_download():
-    """API: 调用 download_bt.py 脚本开始下载"""
-    import subprocess
-    
-    script_path = os.path.join(os.path.dirname(__file__), 'download_bt.py')
-    
-    if not os.path.exists(script_path):
-        return jsonify({"error": "download_bt.py 脚本未找到"}), 500
-    
+    """API: 执行下载作业"""
+    return job_response('download', '下载', timeout=1800)  # 下载可能需要很长时间，设置30分钟超时
+
+@app.route('/api/progress', methods=['GET'])
+def get_progress():
+    """
+    API: 下载进度事件
+    不带参数时返回本次运行每个任务的最新状态和当前偏移；
+    带 since（上次返回的 offset）和 run_id 时只返回之后的新事件（运行已换成新的一次时从头返回）
+    """
+    since = request.args.get('since', type=int)
+    run_id = current_run_id()
     try:
-        print("[*] 开始执行 download_bt.py...")
-        result = subprocess.run(
-            [sys.executable, script_path],
-            check=True,
-            capture_output=True,
-            text=True,
-            encoding='utf-8',
-            timeout=1800  # 下载可能需要很长时间，设置30分钟超时
-        )
-        # 合并 stdout 和 stderr 以显示完整输出
-        full_output = result.stdout
-        if result.stderr:
-            full_output += "\n" + result.stderr
-        
-        print(f"[*] 下载完成")
-        return jsonify({
-            "status": "success",
-            "message": "下载任务完成！",
-            "output": full_output,
-            "stdout": result.stdout,
-            "stderr": result.stderr
-        })
-    except subprocess.TimeoutExpired:
-        return jsonify({"error": "下载超时"}), 500
-    except subprocess.CalledProcessError as e:
-        print(f"[!] 下载失败: {e.stderr}", file=sys.stderr)
-        return jsonify({"error": f"下载失败: {e.stderr}"}), 500
+        if since is None or request.args.get('run_id') != run_id:
+            events, offset = read_events(0)
+            return jsonify({"run_id": run_id, "offset": offset, **snapshot(events)})
+        events, offset = read_events(since)
+        return jsonify({"run_id": run_id, "offset": offset, "events": events})
     except Exception as e:
-        print(f"[!] 未知错误: {e}", file=sys.stderr)
-        return jsonify({"error": f"未知错误: {str(e)}"}), 500
+        return jsonify({"error": f"读取进度失败: {str(e)}"}), 500
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_status():
+    """API: 调度器是否在运行，以及下一次检查的时间和番剧"""
+    try:
+        return jsonify(read_status())
+    except Exception as e:
+        return jsonify({"error": f"读取调度器状态失败: {str(e)}"}), 500
 
 @app.route('/api/get_logs', methods=['GET'])
 def get_logs():
-    """API: 获取 scheduler.log 的内容"""
+    """
+    API: 获取 scheduler.log 的内容
+    lines=N 只返回最后 N 行（从文件末尾向前读取，与日志大小无关）；
+    run_id=ID 只返回该次作业的日志（可与 lines 同时使用）
+    """
     log_file = os.path.join(os.path.dirname(__file__), 'data', 'scheduler.log')
     
     # 获取查询参数，支持获取最后N行
     lines = request.args.get('lines', type=int)
-    
-    if not os.path.exists(log_file):
-        return jsonify({"content": "日志文件不存在", "exists": False})
+    run_id = request.args.get('run_id')
     
     try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            if lines:
-                # 读取最后N行
-                all_lines = f.readlines()
-                content = ''.join(all_lines[-lines:])
-            else:
-                # 读取全部内容
+        if run_id:
+            content = read_run(run_id, lines, log_file)
+            if content is None:
+                return jsonify({"content": f"没有找到作业 {run_id} 的日志", "exists": False})
+            return jsonify({"content": content, "exists": True})
+
+        if not os.path.exists(log_file):
+            return jsonify({"content": "日志文件不存在", "exists": False})
+
+        if lines:
+            # 读取最后N行
+            content = tail_lines(log_file, lines)
+        else:
+            # 读取全部内容（日志按大小轮转，当前文件不会无限增长）
+            with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
                 content = f.read()
         
         return jsonify({"content": content, "exists": True})
@@ -322,15 +322,18 @@ def update_search_keys():
     if not anime_title:
         return jsonify({"error": "缺少番剧标题"}), 400
     
-    watchlist = load_watchlist()
-    
-    if anime_title not in watchlist:
-        return jsonify({"error": f"番剧 '{anime_title}' 不在追番列表中"}), 404
-    
-    # 更新搜索关键词
-    watchlist[anime_title]['search_keys'] = search_keys
+    # 读改写期间持有锁，避免与其他请求/进程互相覆盖
+    with file_lock(WATCHLIST_FILE):
+        watchlist = load_watchlist()
+        
+        if anime_title not in watchlist:
+            return jsonify({"error": f"番剧 '{anime_title}' 不在追番列表中"}), 404
+        
+        # 更新搜索关键词
+        watchlist[anime_title]['search_keys'] = search_keys
+        saved = save_watchlist(watchlist)
     
-    if save_watchlist(watchlist):
+    if saved:
         print(f"[*] 已更新 '{anime_title}' 的搜索关键词: {search_keys}")
         return jsonify({"status": "success", "message": f"已更新 '{anime_title}' 的搜索关键词"})
     else:
@@ -415,8 +418,8 @@ def use_bangumi_calendar():
         
         # 保存到文件
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(seasonal_list, f, ensure_ascii=False, indent=4)
+            atomic_write_json(output_file, seasonal_list, indent=4)
+            notify_scheduler()
             
             print(f"[*] 成功保存 {len(seasonal_list)} 部动画到 {output_file}")
             return jsonify({
@@ -2,140 +2,218 @@
 # -*- coding: utf-8 -*-
 """
 Bangumi 自动追番调度器
-使用 schedule 库定时执行搜索和下载任务，并作为后台服务运行。
+按每部番剧的放送时间安排搜索（见 airing_schedule.py）：播出后不久第一次检查，没找到时退避重试，
+找到新剧集后执行下载。主循环睡眠到下一次检查的时间（见 timer_scheduler.py），
+收到 SIGHUP 时重新加载配置和追番列表，收到 SIGUSR1 时记录下一次运行信息，并作为后台服务运行。
 """
 
-import schedule
 import time
 import datetime
-import subprocess
 import sys
 import os
 import pytz # 用于处理时区
+import threading
 import traceback # 用于打印错误堆栈
 
+from airing_schedule import AiringSchedule
+from jobs import JOB_SCRIPTS, request_stop, run_job as execute_job
+from log_store import open_log
+from progress_events import follow
+from state_store import read_json
+from timer_scheduler import TimerScheduler, remove_pid, write_pid, write_status
+
 # --- 路径定义 ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
-SEARCH_SCRIPT = os.path.join(PROJECT_ROOT, 'search_torrents.py')
-DOWNLOAD_SCRIPT = os.path.join(PROJECT_ROOT, 'download_bt.py')
 DATA_DIR = os.path.join(PROJECT_ROOT, 'data')
 LOG_FILE = os.path.join(DATA_DIR, 'scheduler.log') # 日志文件移至 data 目录
+CONFIG_FILE = os.path.join(DATA_DIR, 'config.json')
 
 # --- 配置 ---
-# (重要) 请确保您的服务器时区设置正确，或者在此处明确指定
-# 我们将使用 Asia/Tokyo (JST) 作为目标时区
-TARGET_TIMES_JST = ["05:00", "15:00"]
+# 放送时间按 Asia/Tokyo (JST) 计算，检查间隔见 config.json 的 scheduler 配置
 TARGET_TZ = pytz.timezone('Asia/Tokyo')
+# 下载进行中时，同一任务的传输进度最多每隔多少秒写一次日志（阶段变化总是记录）
+PROGRESS_LOG_INTERVAL = 300
 
 # --- 辅助函数 ---
+# 日志在第一次写日志时打开，之后一直使用同一个写入端（按配置轮转压缩，见 log_store.py）
+LOG = None
+LOG_LOCK = threading.Lock()  # 作业输出、进度事件和主循环可能在不同线程中同时写日志
+
+
+def get_log():
+    global LOG
+    if LOG is None:
+        LOG = open_log(load_config(), LOG_FILE)
+    return LOG
+
+
+def mark_run(run_id, started):
+    """在日志索引中记录一次作业的开始 / 结束位置（失败时只影响按 run_id 查询日志）"""
+    try:
+        with LOG_LOCK:
+            if started:
+                get_log().begin_run(run_id)
+            else:
+                get_log().end_run(run_id)
+    except Exception as e:
+        print_log(f"更新日志索引失败: {e}", level="WARNING")
+
+
 def print_log(msg, level="INFO"):
     """记录日志到文件和控制台"""
+    global LOG
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     log_line = f"[{timestamp}] [{level}] {msg}"
-    print(log_line) # 输出到 systemd journal 或控制台
-    try:
-        # 尝试追加到日志文件
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_line + '\n')
-    except Exception as e:
-        # 如果日志写入失败，只打印到控制台
-        print(f"[{timestamp}] [ERROR] Failed to write to log file: {e}")
-
-def run_script(script_path):
-    """运行指定的 Python 脚本"""
-    script_name = os.path.basename(script_path)
-    print_log(f"--- 开始执行子脚本: {script_name} ---")
-    if not os.path.exists(script_path):
-        print_log(f"错误：脚本文件未找到: {script_path}", level="ERROR")
-        return False
+    with LOG_LOCK:
+        # 输出到 systemd journal 或控制台（进程内作业运行时 sys.stdout 被重定向用于捕获作业输出，直接写原始输出）
+        print(log_line, file=sys.__stdout__, flush=True)
+        try:
+            get_log().write(log_line)
+        except Exception as e:
+            # 如果日志写入失败，只打印到控制台（下次重新打开）
+            if LOG is not None:
+                LOG.close()
+            LOG = None
+            print(f"[{timestamp}] [ERROR] Failed to write to log file: {e}", file=sys.__stdout__, flush=True)
+
+def format_bytes(n):
+    return f"{(n or 0) / (1024 * 1024):.1f} MB"
+
+
+def log_progress_event(event, last_logged):
+    """把下载脚本的结构化事件写入日志：阶段变化都记录，传输进度按任务节流"""
+    title = event.get('title') or event.get('task_id')
+    if event['type'] == 'stage':
+        reason = f"（{event['reason']}）" if event.get('reason') else ''
+        print_log(f"  [{event['stage']}] {title}{reason}")
+    elif event['type'] == 'progress':
+        now = time.monotonic()
+        done = event.get('total') and event.get('bytes') == event.get('total')
+        if not done and now - last_logged.get(event['task_id'], 0) < PROGRESS_LOG_INTERVAL:
+            return
+        last_logged[event['task_id']] = now
+        eta = f"，剩余约 {event['eta']} 秒" if event.get('eta') is not None else ''
+        print_log(f"  [{event['stage']}] {title}: {format_bytes(event.get('bytes'))} / "
+                  f"{format_bytes(event.get('total'))}，{format_bytes(event.get('rate'))}/s{eta}")
+
+
+def run_script(job_name, run_id=None, titles=None):
+    """执行搜索或下载作业（下载进度通过事件流订阅，不再解析标准输出）"""
+    script_name = os.path.basename(JOB_SCRIPTS[job_name])
+    print_log(f"--- 开始执行作业: {script_name} ---")
+
+    is_download_script = (job_name == 'download')
+    stop_following = threading.Event()
+    follower = None
+    if is_download_script:
+        last_logged = {}
+        follower = threading.Thread(target=follow, daemon=True,
+                                    args=(lambda event: log_progress_event(event, last_logged), stop_following),
+                                    kwargs={'run_id': run_id})
+        follower.start()
+
+    def log_output(stream, line):
+        # 下载进度已由事件流记录，跳过给终端看的进度行
+        if is_download_script and line.startswith("进度:"):
+            return
+        print_log(f"  {line}", level="ERROR" if stream == 'stderr' else "INFO")
 
     try:
-        python_executable = sys.executable
-        process = subprocess.run(
-            [python_executable, script_path],
-            check=True,
-            capture_output=True, # 捕获输出以便记录
-            text=True,
-            encoding='utf-8'
-        )
-        
-        # 记录子脚本的标准输出
-        if process.stdout:
-            print_log(f"--- {script_name} 输出 ---")
-            
-            # --- *** 修改处：过滤下载脚本的日志 V2 *** ---
-            is_download_script = (script_path == DOWNLOAD_SCRIPT)
-            
-            # 状态标志，用于只记录一次 0% 和 100%
-            has_logged_start = False
-            has_logged_completion = False
-
-            for line in process.stdout.splitlines():
-                log_this_line = True  # 默认记录所有行
-
-                if is_download_script and "进度:" in line:
-                    # 如果是下载脚本，并且是进度行
-                    
-                    # 检查是否为 0% 进度
-                    # (增加 " 0%" 兼容性)
-                    if (" 0.0%" in line or " 0%" in line) and not has_logged_start:
-                        log_this_line = True
-                        has_logged_start = True # 标记已记录
-                    
-                    # 检查是否为 100% 进度
-                    # (增加 "100%" 兼容性)
-                    elif ("100.0%" in line or "100%" in line) and not has_logged_completion:
-                        log_this_line = True
-                        has_logged_completion = True # 标记已记录
-                    
-                    # 其他所有进度行 (非0%, 非100%, 或重复的0/100)
-                    else:
-                        log_this_line = False # 不记录
-                
-                if log_this_line:
-                    print_log(f"  {line}")
-            # --- *** 修改结束 *** ---
-
-            print_log(f"--- {script_name} 输出结束 ---")
-
-        print_log(f"子脚本 '{script_name}' 执行成功。", level="SUCCESS")
-        return True
-
-    except FileNotFoundError:
-        print_log(f"错误：找不到 Python 解释器 '{python_executable}'", level="ERROR")
-        return False
-    except subprocess.CalledProcessError as e:
-        print_log(f"错误：脚本 '{script_name}' 执行失败。返回码: {e.returncode}", level="ERROR")
-        # 记录子脚本的错误输出
-        if e.stderr:
-            print_log(f"--- {script_name} 错误输出 ---", level="ERROR")
-            for line in e.stderr.splitlines():
-                print_log(f"  {line}", level="ERROR")
-            print_log(f"--- {script_name} 错误输出结束 ---", level="ERROR")
+        # 作业输出边产生边写入日志（标准错误输出记为 ERROR），不再等作业结束后整体处理
+        print_log(f"--- {script_name} 输出 ---")
+        result = execute_job(job_name, run_id=run_id, titles=titles, on_line=log_output)
+        print_log(f"--- {script_name} 输出结束 ---")
+
+        if result['success']:
+            print_log(f"作业 '{script_name}' 执行成功。", level="SUCCESS")
+            return True
+
+        print_log(f"错误：作业 '{script_name}' 执行失败（{result['mode']}）。{result['error']}", level="ERROR")
         return False
+
     except Exception as e:
-        print_log(f"运行脚本 '{script_name}' 时发生意外错误: {e}", level="ERROR")
+        print_log(f"运行作业 '{script_name}' 时发生意外错误: {e}", level="ERROR")
         # 打印详细错误堆栈信息
         traceback.print_exc()
         return False
+    finally:
+        if follower:
+            stop_following.set()
+            follower.join()
 
-def run_job():
-    """定义要定时执行的任务：搜索并下载"""
+def load_config():
+    return read_json(CONFIG_FILE, {})
+
+
+def queued_episodes(config):
+    """任务队列中的 (番剧, 集数, 磁力链接)，用于判断一次搜索是否找到了新剧集"""
+    output_file = config.get('torrent_searcher', {}).get('output_file')
+    if not output_file:
+        return set()
+    return {(task.get('anime_title'), task.get('episode'), task.get('magnet'))
+            for task in read_json(os.path.join(PROJECT_ROOT, output_file), [])}
+
+
+def run_job(airing, titles):
+    """定义到期时执行的任务：搜索到期的番剧，找到新剧集或队列中有未完成的任务时下载"""
     run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    print_log(f"====== 作业开始 (ID: {run_id}) ======")
+    mark_run(run_id, True)
+    try:
+        print_log(f"====== 作业开始 (ID: {run_id}) ======")
+        print_log(f"按放送时间检查 {len(titles)} 部番剧: {', '.join(titles)}")
 
-    search_success = run_script(SEARCH_SCRIPT)
+        config = load_config()
+        before = queued_episodes(config)
+        search_success = run_script('search', titles=titles)
+        after = queued_episodes(config)
+        found = {title for title, _, _ in after - before}
+        airing.record(titles, found)
 
-    if search_success:
-        print_log("搜索任务成功，准备执行下载任务...")
-        time.sleep(5) # 在下载前稍作停顿
-        download_success = run_script(DOWNLOAD_SCRIPT)
-        if not download_success:
-             print_log("下载任务执行失败。", level="WARNING")
-    else:
-        print_log("搜索任务失败，跳过本次下载任务。", level="WARNING")
+        now = airing.now()
+        for title in [t for t in titles if t in airing.shows]:
+            state = "找到新剧集" if title in found else "未找到新剧集"
+            print_log(f"  {title}: {state}，下次检查 {airing.next_check(title, now).strftime('%m-%d %H:%M')} (JST)")
+
+        if search_success and after:
+            print_log("搜索任务成功，准备执行下载任务...")
+            time.sleep(5) # 在下载前稍作停顿
+            download_success = run_script('download', run_id)
+            if not download_success:
+                 print_log("下载任务执行失败。", level="WARNING")
+        elif search_success:
+            print_log("任务队列为空，跳过本次下载任务。")
+        else:
+            print_log("搜索任务失败，跳过本次下载任务。", level="WARNING")
+
+        print_log(f"====== 作业结束 (ID: {run_id}) ======")
+    finally:
+        mark_run(run_id, False)
+
+
+def run_due_checks(airing):
+    """执行所有到期的检查（同一时间到期的番剧合并为一次作业）"""
+    titles = airing.due()
+    if titles:
+        run_job(airing, titles)
+
+
+def schedule_next_check(timers, airing, callback):
+    """把定时器设到下一次检查的时间（只保留一个），并更新状态文件"""
+    timers.cancel('airing')
+    next_check, titles = airing.upcoming()
+    if next_check:
+        timers.call_at(next_check, 'airing', callback)
+    write_status(next_check, titles, TARGET_TZ)
 
-    print_log(f"====== 作业结束 (ID: {run_id}) ======")
+
+def report_next_run(timers, airing):
+    next_check, _ = timers.next_run()
+    if next_check:
+        _, titles = airing.upcoming()
+        next_run_local = next_check.astimezone(TARGET_TZ) # 转换为目标时区显示
+        print_log(f"🕒 等待下一次检查... 下次运行时间: {next_run_local.strftime('%Y-%m-%d %H:%M:%S %Z%z')}（{', '.join(titles)}）")
+    else:
+        print_log("🕒 追番列表中没有带放送时间的番剧，等待列表更新...")
 
 # --- 主调度逻辑 ---
 def main():
@@ -147,72 +225,65 @@ def main():
     print_log(f"数据目录: {DATA_DIR}")
     print_log(f"日志文件: {LOG_FILE}")
     print_log(f"目标时区: {TARGET_TZ.zone}")
-    print_log(f"计划执行时间 (JST): {', '.join(TARGET_TIMES_JST)}")
 
-    # 清除旧计划
-    print_log("正在清除已存在的计划任务...")
-    schedule.clear()
-    print_log("计划任务已清除。")
+    try:
+        write_pid()
+    except BlockingIOError:
+        print_log("另一个调度器正在运行，退出", level="ERROR")
+        return
+    timers = TimerScheduler()
+    timers.install_signal_handlers()
+    print_log(f"进程 ID: {os.getpid()}（kill -HUP 重新加载配置，kill -USR1 查看下一次运行，kill 正常退出）")
+
+    # 重新加载配置时替换 airing，定时器回调总是使用当前的那个
+    state = {'airing': AiringSchedule(load_config())}
 
-    # 设置定时任务
-    job_count = 0
-    for time_str in TARGET_TIMES_JST:
-        print_log(f"尝试设置每日任务于 {TARGET_TZ.zone} {time_str} 执行...")
+    def check_due_shows():
         try:
-            # 尝试使用带时区的 at() 方法
-            schedule.every().day.at(time_str, TARGET_TZ).do(run_job)
-            print_log(f"✅ 成功设置每日任务于 {time_str} {TARGET_TZ.zone}")
-            job_count += 1
-        except TypeError:
-            # 备用方案
-            print_log(f"⚠️ 警告：当前 schedule 库版本可能不支持时区参数。", level="WARNING")
-            print_log(f"    将基于服务器本地时间 {time_str} 设置任务。", level="WARNING")
-            print_log(f"    👉 请确保服务器时区已设为 '{TARGET_TZ.zone}' 以保证准确执行！", level="WARNING")
-            schedule.every().day.at(time_str).do(run_job)
-            print_log(f"✅ 成功设置每日任务于 {time_str} (服务器本地时间)")
-            job_count += 1
-        except Exception as e:
-            print_log(f"❌ 设置任务 {time_str} 失败: {e}", level="ERROR")
-
+            run_due_checks(state['airing'])
+        finally:
+            schedule_next_check(timers, state['airing'], check_due_shows)
 
-    if job_count == len(TARGET_TIMES_JST):
-         print_log(f"====== ✅ 调度器初始化成功，共设置 {job_count} 个任务。进入主循环... ======")
-    else:
-         print_log(f"====== ⚠️ 调度器初始化有误，仅设置 {job_count}/{len(TARGET_TIMES_JST)} 个任务。进入主循环... ======", level="WARNING")
+    offsets = ', '.join(f"{offset.total_seconds() / 3600:g}h" for offset in state['airing'].offsets)
+    print_log(f"按放送时间检查，播出后: {offsets}（找到新剧集后停止）")
+    schedule_next_check(timers, state['airing'], check_due_shows)
+    print_log(f"====== ✅ 调度器初始化成功，共 {len(state['airing'].shows)} 部番剧有放送时间。进入主循环... ======")
 
     # 主循环
     last_log_time = None # 初始化上次日志时间
-    while True:
-        try:
-            pending_jobs = schedule.get_jobs()
-            if not pending_jobs:
-                print_log("错误：没有设置任何计划任务。退出循环。", level="ERROR")
-                break
-
-            # --- *** 修正处：调用 next_run() 函数 *** ---
-            next_run_datetime = schedule.next_run()
-            # --- *** 修正结束 *** ---
-
-            now = datetime.datetime.now(TARGET_TZ)
-
-            if next_run_datetime: # 检查是否成功获取到时间
-                # 每隔约1小时记录一次下一个任务时间
-                log_interval_passed = (last_log_time is None) or ((now - last_log_time).total_seconds() > 3600)
-                if log_interval_passed:
-                    # 使用获取到的 next_run_datetime 对象
-                    next_run_local = next_run_datetime.astimezone(TARGET_TZ) # 转换为目标时区显示
-                    print_log(f"🕒 等待下一个任务... 下次运行时间: {next_run_local.strftime('%Y-%m-%d %H:%M:%S %Z%z')}")
+    try:
+        while True:
+            try:
+                now = datetime.datetime.now(TARGET_TZ)
+
+                # 上一次安排失败或追番列表原来为空时，重新安排下一次检查
+                if timers.next_run()[0] is None:
+                    schedule_next_check(timers, state['airing'], check_due_shows)
+
+                # 每隔约1小时记录一次下一次检查的时间
+                if last_log_time is None or (now - last_log_time).total_seconds() >= 3600:
+                    report_next_run(timers, state['airing'])
                     last_log_time = now # 更新上次记录时间
 
-            # 运行到点的任务
-            schedule.run_pending()
-            # 短暂休眠，避免CPU空转
-            time.sleep(1)
+                # 睡眠到下一次检查（或被信号唤醒），运行到点的任务
+                reasons = timers.run_once()
+
+                if 'reload' in reasons:
+                    print_log("收到 SIGHUP，重新加载配置和追番列表...")
+                    state['airing'] = AiringSchedule(load_config())
+                    schedule_next_check(timers, state['airing'], check_due_shows)
+                    report_next_run(timers, state['airing'])
+                elif 'report' in reasons:
+                    report_next_run(timers, state['airing'])
 
-        except Exception as loop_e:
-            print_log(f"主循环执行时出错: {loop_e}", level="ERROR")
-            traceback.print_exc() # 打印错误细节
-            time.sleep(60) # 出错后等待1分钟再重试
+            except Exception as loop_e:
+                print_log(f"主循环执行时出错: {loop_e}", level="ERROR")
+                traceback.print_exc() # 打印错误细节
+                time.sleep(60) # 出错后等待1分钟再重试
+    finally:
+        # 进程内的作业在工作线程中执行，解释器退出时会等它结束，先让它停下来
+        request_stop()
+        remove_pid()
 
 
 if __name__ == "__main__":
@@ -220,6 +291,9 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print_log("====== 🛑 用户中断，调度器正在退出 ======")
+    except SystemExit:
+        print_log("====== 🛑 收到 SIGTERM，调度器已退出 ======")
+        raise
     except Exception as e:
         print_log(f"====== 🔥 调度器发生严重错误: {e} ======", level="CRITICAL")
         traceback.print_exc()
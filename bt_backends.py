@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BT 下载后端
+统一的后端接口（添加磁力 / 查询状态 / 获取文件 / 移除任务），以及本地守护进程后端：
+aria2 (JSON-RPC)、qBittorrent (WebUI API v2)、Transmission (RPC)
+Seedr 云端后端实现在 download_bt.py 中（依赖其中的传输逻辑）
+"""
+
+import base64
+import binascii
+import os
+import sys
+import requests
+import urllib.parse
+
+VIDEO_EXTENSIONS = ['.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v']
+RPC_TIMEOUT = 30
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def magnet_info_hash(magnet):
+    """从磁力链接中解析 info hash（统一为 40 位小写十六进制），解析失败返回 None"""
+    query = urllib.parse.urlparse(magnet or '').query
+    for xt in urllib.parse.parse_qs(query).get('xt', []):
+        if not xt.lower().startswith('urn:btih:'):
+            continue
+        value = xt[9:]
+        if len(value) == 40:
+            return value.lower()
+        if len(value) == 32:
+            try:
+                return base64.b32decode(value.upper()).hex()
+            except (binascii.Error, ValueError):
+                return None
+    return None
+
+
+def is_video_file(path):
+    return os.path.splitext(path.lower())[1] in VIDEO_EXTENSIONS
+
+
+class DownloadBackend:
+    """
+    下载后端接口，由 download_bt.run_download_pipeline 调用：
+    - prepare(jobs):          处理任务前调用一次（登录、清理等），不能影响从上次运行恢复的任务
+    - admit(job):             准入控制，空间不足时返回 False，任务留在队列中等其他任务完成后再添加
+    - add(job):               添加任务的磁力链接，把后端的任务 id 记录到 job 中，返回是否成功
+                              （id 会随任务状态持久化，下次运行直接按 id 继续查询）
+    - refresh(jobs):          每轮轮询只调用一次（传入全部任务，只查询 stage 为 added 的），
+                              返回所有等待中任务共享的状态快照
+    - status(job, snapshot):  从快照中读取单个任务的状态，返回 (state, item)
+                              state: 'downloading' / 'done' / 'missing' / 'error'
+                              下载中时更新 job 的 progress / size / download_rate
+                              done 时 item 会保存到 job['item']，供 fetch 使用
+    - fetch(job, save_dir, settings): 把完成的文件放到本地目录，返回本地文件路径列表（在工作线程中执行）
+    - remove(job):            从后端移除任务（本地后端保留已下载的数据）
+    - release(job):           任务回到队列或最终失败时调用，释放为它预留的资源
+                              （云端后端删除残留的种子/文件，避免失败任务一直占用配额）
+    """
+
+    name = 'base'
+    # 是否为云端后端（云端需要传输到本地，也需要考虑云端空间）
+    remote = False
+
+    def prepare(self, jobs):
+        """开始处理任务前调用一次（jobs 中可能有从上次运行恢复的任务）"""
+
+    def admit(self, job):
+        return True
+
+    def add(self, job):
+        raise NotImplementedError
+
+    def refresh(self, jobs):
+        raise NotImplementedError
+
+    def status(self, job, snapshot):
+        raise NotImplementedError
+
+    def fetch(self, job, save_dir, settings):
+        raise NotImplementedError
+
+    def remove(self, job):
+        raise NotImplementedError
+
+    def release(self, job):
+        """任务回到队列或失败时调用；本地后端没有配额，默认什么都不做"""
+
+    def collect_local_files(self, job, paths):
+        """本地后端：筛选出视频文件，由 BT 客户端完成了分块校验，记录为已校验"""
+        files = [path for path in paths if is_video_file(path) and os.path.exists(path)]
+        job['integrity'] = [{'file': os.path.basename(path), 'size': os.path.getsize(path),
+                             'status': 'verified', 'verified_by': self.name} for path in files]
+        if not files:
+            print_error(f"{self.name} 任务中未找到视频文件: {job['task'].get('title', 'Unknown')}")
+        return files
+
+
+class Aria2Backend(DownloadBackend):
+    """aria2 JSON-RPC 后端（磁力任务完成元数据下载后会生成 followedBy 子任务）"""
+
+    name = 'aria2'
+    STATUS_KEYS = ['gid', 'status', 'totalLength', 'completedLength', 'downloadSpeed',
+                   'followedBy', 'files', 'errorMessage']
+
+    def __init__(self, host='localhost', port=6800, secret=None, **_):
+        self.url = f"http://{host}:{port}/jsonrpc"
+        self.secret = secret
+        self.session = requests.Session()
+
+    def call(self, method, *params):
+        # system.* 方法本身不带 token（multicall 的每个子调用各自带）
+        if self.secret and not method.startswith('system.'):
+            params = (f"token:{self.secret}",) + params
+        payload = {'jsonrpc': '2.0', 'id': 'bangmi', 'method': method, 'params': list(params)}
+        r = self.session.post(self.url, json=payload, timeout=RPC_TIMEOUT)
+        data = r.json()
+        if 'error' in data:
+            raise RuntimeError(f"aria2 {method} 失败: {data['error'].get('message')}")
+        return data['result']
+
+    def add(self, job):
+        task = job['task']
+        try:
+            options = {'dir': os.path.abspath(job['save_dir']), 'seed-time': '0'}
+            job['backend_id'] = self.call('aria2.addUri', [task['magnet']], options)
+        except Exception as e:
+            print_error(f"添加到 aria2 失败: {task.get('title', 'Unknown')}: {e}")
+            return False
+        print_success(f"已添加到 aria2: {task.get('title', 'Unknown')}")
+        return True
+
+    def refresh(self, jobs):
+        # 一次 multicall 取回所有任务（包括元数据任务生成的子任务）的状态
+        statuses = {}
+        pending = [job['backend_id'] for job in jobs if job['stage'] == 'added' and job.get('backend_id')]
+        while pending:
+            calls = [{'methodName': 'aria2.tellStatus',
+                      'params': ([f"token:{self.secret}"] if self.secret else []) + [gid, self.STATUS_KEYS]}
+                     for gid in pending]
+            results = self.call('system.multicall', calls)
+            children = []
+            for gid, result in zip(pending, results):
+                if isinstance(result, list) and result:
+                    statuses[gid] = result[0]
+                    children.extend(child for child in result[0].get('followedBy', []) if child not in statuses)
+            pending = children
+        return statuses
+
+    def _resolve(self, gid, snapshot):
+        """沿 followedBy 找到真正下载文件的任务"""
+        status = snapshot.get(gid)
+        while status and status.get('followedBy'):
+            gid = status['followedBy'][0]
+            status = snapshot.get(gid)
+        return gid, status
+
+    def status(self, job, snapshot):
+        gid, status = self._resolve(job.get('backend_id'), snapshot)
+        if status is None:
+            return 'missing', None
+        if status['status'] in ('error', 'removed'):
+            print_error(f"aria2 任务出错: {status.get('errorMessage', status['status'])}")
+            return 'error', None
+        job['active_id'] = gid
+        job['size'] = int(status.get('totalLength', 0)) or job.get('size')
+        job['download_rate'] = int(status.get('downloadSpeed', 0))
+        if status['status'] == 'complete':
+            return 'done', [f['path'] for f in status.get('files', [])]
+        if job['size']:
+            job['progress'] = int(status.get('completedLength', 0)) / job['size'] * 100
+        return 'downloading', None
+
+    def fetch(self, job, save_dir, settings):
+        return self.collect_local_files(job, job['item'])
+
+    def remove(self, job):
+        for gid in {job.get('backend_id'), job.get('active_id')} - {None}:
+            try:
+                self.call('aria2.removeDownloadResult', gid)
+            except Exception as e:
+                print_info(f"移除 aria2 任务记录失败: {e}")
+
+
+class QBittorrentBackend(DownloadBackend):
+    """qBittorrent WebUI API v2 后端（按 info hash 跟踪任务）"""
+
+    name = 'qbittorrent'
+    DONE_STATES = {'uploading', 'stalledUP', 'pausedUP', 'stoppedUP', 'queuedUP', 'forcedUP', 'checkingUP'}
+    ERROR_STATES = {'error', 'missingFiles'}
+
+    def __init__(self, host='localhost', port=8080, username=None, password=None, **_):
+        self.base_url = f"http://{host}:{port}/api/v2"
+        self.username = username
+        self.password = password
+        self.session = requests.Session()
+        self.session.headers['Referer'] = f"http://{host}:{port}"
+
+    def prepare(self, jobs):
+        if self.username:
+            r = self.session.post(f"{self.base_url}/auth/login", timeout=RPC_TIMEOUT,
+                                  data={'username': self.username, 'password': self.password or ''})
+            if r.status_code != 200 or r.text.strip() != 'Ok.':
+                raise RuntimeError(f"qBittorrent 登录失败: {r.status_code} {r.text.strip()}")
+            print_success("qBittorrent 登录成功")
+
+    def add(self, job):
+        task = job['task']
+        info_hash = magnet_info_hash(task.get('magnet'))
+        if not info_hash:
+            print_error(f"无法从磁力链接解析 info hash: {task.get('title', 'Unknown')}")
+            return False
+        try:
+            r = self.session.post(f"{self.base_url}/torrents/add", timeout=RPC_TIMEOUT,
+                                  data={'urls': task['magnet'], 'savepath': os.path.abspath(job['save_dir'])})
+            if r.status_code != 200 or r.text.strip() == 'Fails.':
+                raise RuntimeError(f"{r.status_code} {r.text.strip()}")
+        except Exception as e:
+            print_error(f"添加到 qBittorrent 失败: {task.get('title', 'Unknown')}: {e}")
+            return False
+        job['backend_id'] = info_hash
+        print_success(f"已添加到 qBittorrent: {task.get('title', 'Unknown')}")
+        return True
+
+    def refresh(self, jobs):
+        hashes = [job['backend_id'] for job in jobs if job['stage'] == 'added' and job.get('backend_id')]
+        if not hashes:
+            # hashes 为空时 API 返回所有任务
+            return {}
+        r = self.session.get(f"{self.base_url}/torrents/info", timeout=RPC_TIMEOUT,
+                             params={'hashes': '|'.join(hashes)})
+        r.raise_for_status()
+        return {torrent['hash'].lower(): torrent for torrent in r.json()}
+
+    def status(self, job, snapshot):
+        torrent = snapshot.get(job.get('backend_id'))
+        if torrent is None:
+            return 'missing', None
+        if torrent['state'] in self.ERROR_STATES:
+            print_error(f"qBittorrent 任务出错: {torrent['state']}")
+            return 'error', None
+        job['size'] = torrent.get('size') or job.get('size')
+        job['download_rate'] = torrent.get('dlspeed', 0)
+        job['progress'] = torrent.get('progress', 0) * 100
+        if torrent['state'] in self.DONE_STATES and torrent.get('progress', 0) >= 1:
+            return 'done', torrent['save_path']
+        return 'downloading', None
+
+    def fetch(self, job, save_dir, settings):
+        r = self.session.get(f"{self.base_url}/torrents/files", timeout=RPC_TIMEOUT,
+                             params={'hash': job['backend_id']})
+        r.raise_for_status()
+        return self.collect_local_files(job, [os.path.join(job['item'], f['name']) for f in r.json()])
+
+    def remove(self, job):
+        try:
+            self.session.post(f"{self.base_url}/torrents/delete", timeout=RPC_TIMEOUT,
+                              data={'hashes': job['backend_id'], 'deleteFiles': 'false'})
+        except Exception as e:
+            print_info(f"移除 qBittorrent 任务失败: {e}")
+
+
+class TransmissionBackend(DownloadBackend):
+    """Transmission RPC 后端（自动处理 409 X-Transmission-Session-Id 握手）"""
+
+    name = 'transmission'
+    FIELDS = ['id', 'hashString', 'name', 'percentDone', 'rateDownload', 'sizeWhenDone',
+              'leftUntilDone', 'error', 'errorString', 'downloadDir', 'files']
+
+    def __init__(self, host='localhost', port=9091, username=None, password=None, **_):
+        self.url = f"http://{host}:{port}/transmission/rpc"
+        self.session = requests.Session()
+        if username:
+            self.session.auth = (username, password or '')
+
+    def call(self, method, arguments):
+        payload = {'method': method, 'arguments': arguments}
+        r = self.session.post(self.url, json=payload, timeout=RPC_TIMEOUT)
+        if r.status_code == 409:
+            self.session.headers['X-Transmission-Session-Id'] = r.headers.get('X-Transmission-Session-Id', '')
+            r = self.session.post(self.url, json=payload, timeout=RPC_TIMEOUT)
+        r.raise_for_status()
+        data = r.json()
+        if data.get('result') != 'success':
+            raise RuntimeError(f"Transmission {method} 失败: {data.get('result')}")
+        return data.get('arguments', {})
+
+    def add(self, job):
+        task = job['task']
+        try:
+            result = self.call('torrent-add', {'filename': task['magnet'],
+                                               'download-dir': os.path.abspath(job['save_dir'])})
+            torrent = result.get('torrent-added') or result.get('torrent-duplicate')
+            if not torrent:
+                raise RuntimeError(f"返回中没有任务信息: {result}")
+            job['backend_id'] = torrent['id']
+        except Exception as e:
+            print_error(f"添加到 Transmission 失败: {task.get('title', 'Unknown')}: {e}")
+            return False
+        print_success(f"已添加到 Transmission: {torrent.get('name') or task.get('title', 'Unknown')}")
+        return True
+
+    def refresh(self, jobs):
+        ids = [job['backend_id'] for job in jobs if job['stage'] == 'added' and job.get('backend_id') is not None]
+        result = self.call('torrent-get', {'ids': ids, 'fields': self.FIELDS})
+        return {torrent['id']: torrent for torrent in result.get('torrents', [])}
+
+    def status(self, job, snapshot):
+        torrent = snapshot.get(job.get('backend_id'))
+        if torrent is None:
+            return 'missing', None
+        if torrent.get('error'):
+            print_error(f"Transmission 任务出错: {torrent.get('errorString')}")
+            return 'error', None
+        job['size'] = torrent.get('sizeWhenDone') or job.get('size')
+        job['download_rate'] = torrent.get('rateDownload', 0)
+        job['progress'] = torrent.get('percentDone', 0) * 100
+        if torrent.get('percentDone', 0) >= 1 and torrent.get('leftUntilDone', 0) == 0:
+            return 'done', [os.path.join(torrent['downloadDir'], f['name']) for f in torrent.get('files', [])]
+        return 'downloading', None
+
+    def fetch(self, job, save_dir, settings):
+        return self.collect_local_files(job, job['item'])
+
+    def remove(self, job):
+        try:
+            self.call('torrent-remove', {'ids': [job['backend_id']], 'delete-local-data': False})
+        except Exception as e:
+            print_info(f"移除 Transmission 任务失败: {e}")
+
+
+LOCAL_BACKENDS = {
+    'aria2': Aria2Backend,
+    'qbittorrent': QBittorrentBackend,
+    'transmission': TransmissionBackend,
+}
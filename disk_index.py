@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地已有剧集索引
+解析 anime/ 下视频文件的文件名（媒体库的 <番剧>/Season N/SxxEyy 结构，或手动放入的任意命名），
+得到番剧和集数，供 search_torrents.py 在加入任务队列前判断该集是否已在本地（不论来自哪个字幕组）。
+索引保存在 data/disk_index.json 中，按目录的 mtime 增量更新：目录内容没变时不重新列出，
+文件的大小和 mtime 没变时不重新解析
+命令行: python disk_index.py    刷新索引并列出每部番剧已有的集数
+"""
+
+import json
+import os
+import re
+import sys
+
+from bt_backends import is_video_file
+from library import get_anime_dir, parse_season, safe_name
+from release_parser import parse_file_episode
+from state_store import atomic_write_json, read_json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
+INDEX_FILE = os.path.join(PROJECT_ROOT, 'data/disk_index.json')
+INDEX_VERSION = 1
+SEASON_DIR_PATTERN = re.compile(r'^Season (\d{1,2})$')
+# 比较番剧名时忽略大小写、空白和标点
+NAME_NOISE = re.compile(r'[\s\W_]+')
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def normalize_name(name):
+    return NAME_NOISE.sub('', name or '').lower()
+
+
+def describe_file(rel_path, stat):
+    """解析一个文件的索引条目：媒体库目录结构给出番剧和季度，文件名给出集数"""
+    parts = rel_path.split(os.sep)
+    season, episode = parse_file_episode(parts[-1])
+    show_key = None
+    if len(parts) == 3 and SEASON_DIR_PATTERN.match(parts[1]):
+        show_key = normalize_name(parts[0])
+        season = int(SEASON_DIR_PATTERN.match(parts[1]).group(1))
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'show_key': show_key,
+        'name_key': normalize_name(os.path.splitext(parts[-1])[0]),
+        'season': season,
+        'episode': episode,
+    }
+
+
+class DiskIndex:
+    """anime/ 下已有剧集的索引（只在单个进程内使用，写入时整体原子替换）"""
+
+    def __init__(self, anime_dir, index_path=INDEX_FILE):
+        self.anime_dir = anime_dir
+        self.index_path = index_path
+        data = read_json(index_path, {})
+        if data.get('version') != INDEX_VERSION or data.get('anime_dir') != anime_dir:
+            data = {}
+        # dirs: {相对目录: {'mtime': ns, 'subdirs': [...]}}，files: {相对路径: 索引条目}
+        self.dirs = data.get('dirs', {})
+        self.files = data.get('files', {})
+
+    def refresh(self):
+        """增量扫描：只重新列出 mtime 变化的目录，返回 (重新列出的目录数, 重新解析的文件数)"""
+        self.stats = [0, 0]
+        seen_dirs = set()
+        if os.path.isdir(self.anime_dir):
+            self._scan_dir('', seen_dirs)
+        # 已被删除的目录连同其中的文件一起移出索引
+        for rel_dir in [d for d in self.dirs if d not in seen_dirs]:
+            del self.dirs[rel_dir]
+        self.files = {path: entry for path, entry in self.files.items()
+                      if os.path.dirname(path) in seen_dirs}
+        self.save()
+        return tuple(self.stats)
+
+    def _scan_dir(self, rel_dir, seen_dirs):
+        seen_dirs.add(rel_dir)
+        path = os.path.join(self.anime_dir, rel_dir)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            seen_dirs.discard(rel_dir)
+            return
+        record = self.dirs.get(rel_dir)
+        if record and record['mtime'] == mtime:
+            for subdir in record['subdirs']:
+                self._scan_dir(subdir, seen_dirs)
+            return
+
+        self.stats[0] += 1
+        subdirs, present = [], set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(rel_path)
+                elif entry.is_file() and is_video_file(entry.name):
+                    present.add(rel_path)
+                    stat = entry.stat()
+                    old = self.files.get(rel_path)
+                    if not old or old['size'] != stat.st_size or old['mtime'] != stat.st_mtime_ns:
+                        self.files[rel_path] = describe_file(rel_path, stat)
+                        self.stats[1] += 1
+        for rel_path in [p for p in self.files if os.path.dirname(p) == rel_dir and p not in present]:
+            del self.files[rel_path]
+        self.dirs[rel_dir] = {'mtime': mtime, 'subdirs': subdirs}
+        for subdir in subdirs:
+            self._scan_dir(subdir, seen_dirs)
+
+    def save(self):
+        atomic_write_json(self.index_path, {'version': INDEX_VERSION, 'anime_dir': self.anime_dir,
+                                            'dirs': self.dirs, 'files': self.files})
+
+    def episodes_for(self, anime_title, aliases=()):
+        """
+        本地已有的某部番剧的集数。
+        媒体库中的文件按番剧目录和季度匹配；其他文件要求文件名包含番剧名或别名（如第一个搜索关键词）
+        """
+        show, season = parse_season(anime_title)
+        show_key = normalize_name(safe_name(show))
+        name_keys = [key for key in {normalize_name(anime_title), *(normalize_name(a) for a in aliases)} if key]
+        episodes = set()
+        for entry in self.files.values():
+            if entry['episode'] is None:
+                continue
+            if entry['show_key'] is not None:
+                matched = entry['show_key'] == show_key and entry['season'] == season
+            else:
+                matched = any(key in entry['name_key'] for key in name_keys)
+            if matched:
+                episodes.add(entry['episode'])
+        return episodes
+
+    def has_episode(self, anime_title, episode, aliases=()):
+        return float(episode) in self.episodes_for(anime_title, aliases)
+
+
+def open_disk_index(config=None):
+    """按配置的 anime 目录打开索引并增量刷新"""
+    index = DiskIndex(get_anime_dir(config))
+    rescanned_dirs, parsed_files = index.refresh()
+    print_info(f"💽 本地索引: {len(index.files)} 个文件（重新扫描 {rescanned_dirs} 个目录，解析 {parsed_files} 个文件）")
+    return index
+
+
+def main():
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    index = open_disk_index(config)
+    watchlist_file = os.path.join(PROJECT_ROOT, config.get('torrent_searcher', {}).get(
+        'watchlist_file', 'data/watchlist.json'))
+    for title, conf in read_json(watchlist_file, {}).items():
+        episodes = sorted(index.episodes_for(title, conf.get('search_keys', [])[:1]))
+        print_info(f"{title}: {', '.join(f'{e:g}' for e in episodes) if episodes else '无'}")
+
+
+if __name__ == "__main__":
+    main()
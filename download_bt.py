@@ -5,26 +5,67 @@ BT下载脚本 - 使用Seedr云端下载
 从search_results.json读取磁力链接，上传到Seedr，下载完成后传输到本地并删除云端文件
 """
 
+import datetime
+import hashlib
 import json
 import os
+import random
+import re
 import time
 import requests
 from seedrcc import Seedr
+from seedrcc.exceptions import AuthenticationError
+from seedrcc.token import Token
+from bt_backends import DownloadBackend, LOCAL_BACKENDS, VIDEO_EXTENSIONS, is_video_file
+from history_store import open_history
+from library import get_anime_dir, get_organize_mode, organize_files
+from progress_events import ProgressEmitter
+from release_parser import parse_release
+from retention import ensure_space
+from state_store import Journal, atomic_write_json, file_lock, read_json, update_json
+from thread_output import thread_pool
 from contextlib import contextmanager
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
 import sys
+import threading
+import types
+import urllib.parse
+import urllib3
 
 # --- 1. 路径定义 ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
-HISTORY_FILE = os.path.join(PROJECT_ROOT, 'data/download_history.json')
 SEARCH_RESULTS_FILE = os.path.join(PROJECT_ROOT, 'data/search_results.json')
-DOWNLOAD_DIR = os.path.join(PROJECT_ROOT, 'anime')
+# 已完成任务的预写日志：先写日志再写历史和任务队列，进程被杀后下次启动时补上
+JOURNAL_FILE = os.path.join(PROJECT_ROOT, 'data/download_journal.jsonl')
+# 缓存的 Seedr 登录 token（权限 600），避免每次运行都用密码登录
+SEEDR_TOKEN_FILE = os.path.join(PROJECT_ROOT, 'data/seedr_token.json')
+# Seedr 文件夹列表缓存（文件夹 id + 大小不变时内容不会变化，不再重复请求）
+SEEDR_CACHE_FILE = os.path.join(PROJECT_ROOT, 'data/seedr_cache.json')
+# 同一时间只允许一个下载进程（调度器和手动触发可能同时启动）
+RUN_LOCK_FILE = os.path.join(PROJECT_ROOT, 'data/download_bt')
+JOURNAL = Journal(JOURNAL_FILE)
+# 结构化进度事件（data/progress_events.jsonl），供调度器和 Web 应用订阅
+EVENTS = ProgressEmitter()
+DOWNLOAD_DIR = get_anime_dir(None)  # 默认下载目录，实际使用 local_storage.anime_dir（见 get_anime_dir）
+# 进程内执行的作业的停止标志（调度器收到 SIGTERM 时由 jobs.request_stop 设置）：
+# 传输循环在下一块数据前、流水线在下一轮开始前停止，已写入的 .part / 分段进度和任务阶段都保留，下次运行继续
+STOP = threading.Event()
 
 # --- 2. 辅助功能 ---
 def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
 def print_info(msg): print(f"ℹ️ {msg}")
 def print_success(msg): print(f"✅ {msg}")
 
+
+class JobStopped(BaseException):
+    """设置了 STOP 时由传输循环和流水线抛出（继承 BaseException，不会被各处的 except Exception 当作普通失败处理）"""
+
+
+def check_stop():
+    if STOP.is_set():
+        raise JobStopped()
+
 def load_config():
     """加载配置文件"""
     try:
@@ -39,30 +80,105 @@ def load_json(file_path, default=None):
     if default is None:
         default = []
     try:
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return default
+        return read_json(file_path, default)
     except Exception as e:
         print_error(f"加载 {file_path} 失败: {e}")
         return default
 
 def save_json(file_path, data):
-    """安全保存JSON文件"""
+    """安全保存JSON文件（临时文件 + fsync + rename，写到一半崩溃不会损坏原文件）"""
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        atomic_write_json(file_path, data)
         return True
     except Exception as e:
         print_error(f"保存 {file_path} 失败: {e}")
         return False
 
 
-def login_to_seedr():
-    """使用配置文件中的账号密码登录Seedr"""
-    print_info("加载配置文件...")
-    sys.stdout.flush()
-    config = load_config()
+def load_seedr_token(email):
+    """读取缓存的 Seedr token（只在账号一致时使用），没有时返回 None"""
+    cached = load_json(SEEDR_TOKEN_FILE, {})
+    if not cached or cached.get('email') != email or not cached.get('token'):
+        return None
+    try:
+        return Token.from_dict(cached['token'])
+    except Exception as e:
+        print_error(f"缓存的 Seedr token 无效: {e}")
+        return None
+
+
+def save_seedr_token(token, email):
+    """保存 token（仅当前用户可读），登录和自动刷新 token 后调用"""
+    data = {'email': email, 'token': token.to_dict(),
+            'saved_at': datetime.datetime.now().isoformat(timespec='seconds')}
+    try:
+        atomic_write_json(SEEDR_TOKEN_FILE, data, mode=0o600)
+    except Exception as e:
+        print_error(f"保存 Seedr token 失败: {e}")
+
+
+class SeedrSession:
+    """
+    Seedr 客户端包装：优先复用缓存的 token，跳过密码登录和 get_settings。
+    access token 过期时由 seedrcc 用 refresh token 自动刷新（刷新后写回缓存）；
+    刷新也失败（401）时用密码重新登录一次并重试该调用
+    """
+
+    def __init__(self, email, password):
+        self.email = email
+        self.password = password
+        self.client = None
+        self.lock = threading.Lock()
+
+    def on_token_refresh(self, token):
+        save_seedr_token(token, self.email)
+
+    def resume(self):
+        """使用缓存的 token 创建客户端，没有缓存时返回 False"""
+        token = load_seedr_token(self.email)
+        if not token:
+            return False
+        self.client = Seedr(token=token, on_token_refresh=self.on_token_refresh)
+        print_success(f"使用缓存的 Seedr 登录凭据: {self.email}")
+        return True
+
+    def login(self):
+        """用账号密码登录并缓存 token"""
+        print_info(f"正在使用账号 {self.email} 登录 Seedr...")
+        sys.stdout.flush()
+        self.client = Seedr.from_password(self.email, self.password, on_token_refresh=self.on_token_refresh)
+        save_seedr_token(self.client.token, self.email)
+
+    def relogin(self, failed_client):
+        with self.lock:
+            # 其他线程已经重新登录过了
+            if self.client is not failed_client:
+                return
+            print_info("Seedr 登录凭据已失效，重新登录...")
+            self.login()
+
+    def __getattr__(self, name):
+        # 只转发客户端的属性（self.client 等自身属性不会走到这里）
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            client = self.client
+            try:
+                return getattr(client, name)(*args, **kwargs)
+            except AuthenticationError:
+                self.relogin(client)
+                return getattr(self.client, name)(*args, **kwargs)
+        return call
+
+
+def login_to_seedr(config=None):
+    """登录Seedr：优先复用缓存的 token，没有缓存时使用配置文件中的账号密码登录"""
+    if config is None:
+        print_info("加载配置文件...")
+        sys.stdout.flush()
+        config = load_config()
     if not config:
         return None
         
@@ -74,15 +190,17 @@ def login_to_seedr():
         print_error("config.json 中未找到 seedr_email 或 seedr_password")
         return None
     
+    session = SeedrSession(email, password)
+    if session.resume():
+        return session
+    
     try:
-        print_info(f"正在使用账号 {email} 登录 Seedr...")
-        sys.stdout.flush()
-        client = Seedr.from_password(email, password)
+        session.login()
         print_info("获取用户设置...")
         sys.stdout.flush()
-        settings = client.get_settings()
+        settings = session.get_settings()
         print_success(f"Seedr 登录成功，用户: {settings.account.username}")
-        return client
+        return session
     except Exception as e:
         print_error(f"Seedr 登录失败: {e}")
         import traceback
@@ -90,222 +208,920 @@ def login_to_seedr():
         return None
 
 def is_already_downloaded(magnet, history):
-    """检查磁力链接是否已经下载过"""
-    return magnet in history.get('all_downloaded_magnets', [])
+    """检查磁力链接是否已经下载过（按 info hash 索引查询）"""
+    return history.is_downloaded(magnet)
 
 
-def add_to_history(magnet, anime_title, episode_num, history):
-    """(新) 将磁力链接和最高集数添加到历史记录"""
-    
-    # 1. 更新磁力链接列表
-    if 'all_downloaded_magnets' not in history:
-        history['all_downloaded_magnets'] = []
+def add_to_history(magnet, anime_title, episode_num, history, title=None, release=None):
+    """(新) 将磁力链接、该集的版本和最高集数添加到历史记录（每次调用立即写入数据库）"""
     
-    if magnet not in history['all_downloaded_magnets']:
-        history['all_downloaded_magnets'].append(magnet)
+    # 1. 记录已下载的磁力链接
+    try:
+        new_ep = float(episode_num)
+    except (TypeError, ValueError):
+        new_ep = None
+    if history.add_download(magnet, anime_title, new_ep, title):
         print_info(f"磁力链接已添加到历史: {magnet}")
     
     # 2. 更新最高集数
-    if 'highest_episode_downloaded' not in history:
-        history['highest_episode_downloaded'] = {}
-        
     # 确保 anime_title 是有效的
     if not anime_title or anime_title == 'Unknown':
         print_error("无法更新最高集数，因为 'anime_title' 未知")
         return
 
-    if anime_title not in history['highest_episode_downloaded']:
-        history['highest_episode_downloaded'][anime_title] = 0.0
+    if new_ep is None:
+        print_error(f"集数 {episode_num} 不是有效数字，无法更新历史。")
+        return
+
+    # 3. 记录该集下载的版本（字幕组 / 分辨率 / 语言），之后其他字幕组的同一集不再下载
+    history.record_episode(anime_title, new_ep, release or parse_release(title), magnet)
 
     try:
-        # 确保是浮点数比较
-        current_max = float(history['highest_episode_downloaded'][anime_title])
-        new_ep = float(episode_num)
-
-        if new_ep > current_max:
-            history['highest_episode_downloaded'][anime_title] = new_ep
+        updated, current_max = history.update_highest_episode(anime_title, new_ep)
+        if updated:
             print_success(f"✅ 更新 {anime_title} 的最高集数为: {new_ep}")
         else:
             print_info(f"ℹ️ {anime_title} 的集数 {new_ep} 不高于历史记录 {current_max}")
-            
-    except ValueError:
-        print_error(f"集数 {episode_num} 不是有效数字，无法更新历史。")
     except Exception as e:
         print_error(f"更新最高集数时出错: {e}")
 
-def wait_for_seedr_download(client, torrent_id, title, skip_initial_wait=False):
-    """等待Seedr完成下载"""
-    if not skip_initial_wait:
-        print_info("等待30秒让Seedr处理种子...")
-        time.sleep(30)
+def extract_keywords(title):
+    """从标题中提取关键词用于匹配"""
+    # 移除方括号和括号内容，但保留数字
+    # 提取集数
+    episode_match = re.search(r'[\[【](\d{1,3})[\]】]', title)
+    episode_num = episode_match.group(1) if episode_match else None
     
-    print_info(f"检查 Seedr 下载状态: {title}")
+    # 移除字幕组信息
+    cleaned = re.sub(r'[\[【][^\]】]*(?:字幕|Sub)[^\]】]*[\]】]', '', title, flags=re.IGNORECASE)
+    # 移除分辨率信息
+    cleaned = re.sub(r'\b(?:1080p|720p|2160p|4K|WebRip|BDRip|BluRay|HEVC|x264|x265)\b', '', cleaned, flags=re.IGNORECASE)
+    # 移除语言信息
+    cleaned = re.sub(r'[\[【](?:简|繁|日|英|内嵌|外挂)+.*?[\]】]', '', cleaned)
     
-    # 提取关键词 - 改进版
-    def extract_keywords(title):
-        """从标题中提取关键词用于匹配"""
-        # 移除方括号和括号内容，但保留数字
-        import re
-        # 提取集数
-        episode_match = re.search(r'[\[【](\d{1,3})[\]】]', title)
-        episode_num = episode_match.group(1) if episode_match else None
-        
-        # 移除字幕组信息
-        cleaned = re.sub(r'[\[【][^\]】]*(?:字幕|Sub)[^\]】]*[\]】]', '', title, flags=re.IGNORECASE)
-        # 移除分辨率信息
-        cleaned = re.sub(r'\b(?:1080p|720p|2160p|4K|WebRip|BDRip|BluRay|HEVC|x264|x265)\b', '', cleaned, flags=re.IGNORECASE)
-        # 移除语言信息
-        cleaned = re.sub(r'[\[【](?:简|繁|日|英|内嵌|外挂)+.*?[\]】]', '', cleaned)
-        
-        # 分割并清理
-        keywords = []
-        # 按常见分隔符分割
-        parts = re.split(r'[\s\-_/【】\[\]]+', cleaned)
-        for part in parts:
-            part = part.strip()
-            # 保留有意义的词（字母数字组合、中文、长度>1的词）
-            if part and (len(part) > 1 or re.search(r'[\u4e00-\u9fff]', part)):
-                keywords.append(part.lower())
-        
-        # 添加集数作为关键词
-        if episode_num:
-            keywords.append(episode_num)
-        
-        return [kw for kw in keywords if kw][:8]  # 返回前8个关键词
+    # 分割并清理
+    keywords = []
+    # 按常见分隔符分割
+    parts = re.split(r'[\s\-_/【】\[\]]+', cleaned)
+    for part in parts:
+        part = part.strip()
+        # 保留有意义的词（字母数字组合、中文、长度>1的词）
+        if part and (len(part) > 1 or re.search(r'[\u4e00-\u9fff]', part)):
+            keywords.append(part.lower())
     
-    title_keywords = extract_keywords(title)
-    print_info(f"提取的匹配关键词: {title_keywords}")
+    # 添加集数作为关键词
+    if episode_num:
+        keywords.append(episode_num)
     
-    # 最多检查5次，每次间隔30秒
-    for attempt in range(5):
+    return [kw for kw in keywords if kw][:8]  # 返回前8个关键词
+
+# --- Seedr API 批量调用 ---
+
+SEEDR_API_WORKERS = 4    # 批量列表/删除时的并发数
+SEEDR_CALL_RETRIES = 3   # 单个 API 调用的重试次数
+
+
+def seedr_call(func, *args):
+    """调用 Seedr API，失败时指数退避重试（认证错误直接抛出）"""
+    for attempt in range(SEEDR_CALL_RETRIES):
         try:
-            contents = client.list_contents()
-            
-            print_info(f"Seedr 根目录文件数: {len(contents.files)}, 文件夹数: {len(contents.folders)}")
-            
-            # 寻找匹配的文件或文件夹
-            video_extensions = ['.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v']
-            
-            # 先检查直接文件
-            for file in contents.files:
-                file_ext = os.path.splitext(file.name.lower())[1]
-                if file_ext in video_extensions:
-                    print_info(f"检查文件: {file.name}")
-                    # 检查文件名是否匹配（至少匹配2个关键词）
-                    match_count = sum(1 for keyword in title_keywords if keyword in file.name.lower())
-                    if match_count >= 2:
-                        print_success(f"✅ 发现匹配的视频文件: {file.name} (匹配{match_count}个关键词)")
-                        return file, 'file'
-            
-            # 检查文件夹
-            for folder in contents.folders:
-                print_info(f"检查文件夹: {folder.name}")
-                try:
-                    folder_contents = client.list_contents(folder_id=folder.id)
-                    
-                    # 检查文件夹内的视频文件
-                    for file in folder_contents.files:
-                        file_ext = os.path.splitext(file.name.lower())[1]
-                        if file_ext in video_extensions:
-                            print_info(f"  └─ 检查文件: {file.name}")
-                            # 检查文件名是否匹配（至少匹配2个关键词）
-                            match_count = sum(1 for keyword in title_keywords if keyword in file.name.lower())
-                            if match_count >= 2:
-                                print_success(f"✅ 发现文件夹中的匹配视频: {folder.name}/{file.name} (匹配{match_count}个关键词)")
-                                return file, 'file'
-                    
-                    # 如果文件夹名包含关键词，可能整个文件夹都是相关的
-                    folder_match_count = sum(1 for keyword in title_keywords if keyword in folder.name.lower())
-                    if folder_match_count >= 2:
-                        # 检查文件夹是否有内容
-                        if folder_contents.files:
-                            print_success(f"✅ 发现匹配的文件夹: {folder.name} (匹配{folder_match_count}个关键词)")
-                            return folder, 'folder'
-                            
-                except Exception as e:
-                    print_info(f"跳过文件夹 {folder.name}: {e}")
-                    continue
-            
-            if attempt < 4:  # 不是最后一次尝试
-                print_info(f"第 {attempt + 1} 次检查未找到文件，30秒后重试...")
-                time.sleep(30)
-            
-        except Exception as e:
-            print_error(f"检查下载状态时出错: {e}")
-            if attempt < 4:
-                time.sleep(30)
+            return func(*args)
+        except AuthenticationError:
+            raise
+        except Exception:
+            if attempt == SEEDR_CALL_RETRIES - 1:
+                raise
+            time.sleep((2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+def run_seedr_bulk(func, items, description):
+    """
+    通过有界线程池并发执行一批 Seedr API 调用（每个调用各自重试），
+    返回与 items 顺序一致的结果列表（失败的为 None），最后汇总失败的调用
+    """
+    if not items:
+        return []
+    results = [None] * len(items)
+    failures = []
+    with thread_pool(min(SEEDR_API_WORKERS, len(items))) as pool:
+        futures = {pool.submit(func, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                failures.append((items[index], e))
+    if failures:
+        print_error(f"{description}: {len(failures)}/{len(items)} 个调用失败")
+        for item, e in failures:
+            print_error(f"   - {getattr(item, 'name', item)}: {e}")
+    return results
+
+
+def load_seedr_cache():
+    """{文件夹 id: {'size': 文件夹大小, 'files': [...]}}"""
+    return load_json(SEEDR_CACHE_FILE, {})
+
+
+def save_seedr_cache(cache, contents):
+    """只保留根目录中仍然存在的文件夹"""
+    alive = {str(folder.id) for folder in contents.folders}
+    for folder_id in [key for key in cache if key not in alive]:
+        del cache[folder_id]
+    save_json(SEEDR_CACHE_FILE, cache)
+
+
+def list_seedr_folder(client, folder, cache=None):
+    """列出文件夹中的文件；文件夹 id 和大小都没变时直接使用缓存"""
+    key = str(folder.id)
+    cached = cache.get(key) if cache is not None else None
+    if cached and cached['size'] == folder.size:
+        return [types.SimpleNamespace(**file) for file in cached['files']]
+    files = seedr_call(client.list_contents, folder.id).files
+    if cache is not None:
+        cache[key] = {'size': folder.size, 'files': [
+            {'name': file.name, 'size': file.size, 'folder_file_id': file.folder_file_id,
+             'hash': getattr(file, 'hash', None)} for file in files]}
+    return files
+
+
+def list_seedr_folders(client, folders, cache=None):
+    """并发列出多个文件夹（缓存未命中的才请求），返回与 folders 顺序一致的文件列表（失败的为 None）"""
+    hits = sum(1 for folder in folders if cache and cache.get(str(folder.id), {}).get('size') == folder.size)
+    if len(folders) > hits:
+        print_info(f"列出 {len(folders) - hits} 个云端文件夹（{hits} 个使用缓存）")
+    return run_seedr_bulk(lambda folder: list_seedr_folder(client, folder, cache), folders, "列出云端文件夹")
+
+
+def find_seedr_item(client, title_keywords, claimed=(), contents=None, cache=None):
+    """
+    (备用) 按关键词扫描 Seedr 云端，返回匹配的 (文件/文件夹, 类型)，未找到返回 (None, None)
+    claimed: 已被其他任务认领的文件/文件夹（('file', folder_file_id) 或 ('folder', id)），不再参与匹配
+    contents: 已获取的根目录列表，传入时不再重复请求
+    cache: 文件夹列表缓存（并发列出所有文件夹后按原顺序匹配）
+    """
+    if contents is None:
+        contents = seedr_call(client.list_contents)
+    
+    print_info(f"Seedr 根目录文件数: {len(contents.files)}, 文件夹数: {len(contents.folders)}")
+    
+    # 先检查直接文件
+    for file in contents.files:
+        file_ext = os.path.splitext(file.name.lower())[1]
+        if file_ext in VIDEO_EXTENSIONS and ('file', file.folder_file_id) not in claimed:
+            print_info(f"检查文件: {file.name}")
+            # 检查文件名是否匹配（至少匹配2个关键词）
+            match_count = sum(1 for keyword in title_keywords if keyword in file.name.lower())
+            if match_count >= 2:
+                print_success(f"✅ 发现匹配的视频文件: {file.name} (匹配{match_count}个关键词)")
+                return file, 'file'
+    
+    # 检查文件夹（并发列出，按原顺序匹配）
+    folders = [folder for folder in contents.folders if ('folder', folder.id) not in claimed]
+    for folder, files in zip(folders, list_seedr_folders(client, folders, cache)):
+        print_info(f"检查文件夹: {folder.name}")
+        if files is None:
+            print_info(f"跳过文件夹 {folder.name}: 无法列出内容")
+            continue
+        
+        # 检查文件夹内的视频文件
+        for file in files:
+            file_ext = os.path.splitext(file.name.lower())[1]
+            if file_ext in VIDEO_EXTENSIONS and ('file', file.folder_file_id) not in claimed:
+                print_info(f"  └─ 检查文件: {file.name}")
+                # 检查文件名是否匹配（至少匹配2个关键词）
+                match_count = sum(1 for keyword in title_keywords if keyword in file.name.lower())
+                if match_count >= 2:
+                    print_success(f"✅ 发现文件夹中的匹配视频: {folder.name}/{file.name} (匹配{match_count}个关键词)")
+                    return file, 'file'
+        
+        # 如果文件夹名包含关键词，可能整个文件夹都是相关的
+        folder_match_count = sum(1 for keyword in title_keywords if keyword in folder.name.lower())
+        if folder_match_count >= 2:
+            # 检查文件夹是否有内容
+            if files:
+                print_success(f"✅ 发现匹配的文件夹: {folder.name} (匹配{folder_match_count}个关键词)")
+                return folder, 'folder'
     
-    print_error("检查5次后仍未找到匹配的下载文件")
     return None, None
 
-def download_from_seedr(client, item, item_type, save_dir):
-    """从Seedr下载文件到本地"""
+def list_seedr_transfers(client):
+    """获取一次云端快照（每轮轮询只调用一次 list_contents，所有任务共享）"""
+    contents = client.list_contents()
+    return {
+        'contents': contents,
+        'torrents_by_id': {t.id: t for t in contents.torrents},
+        'torrents_by_hash': {t.hash.lower(): t for t in contents.torrents if t.hash},
+        'folders_by_name': {f.name: f for f in contents.folders},
+        'files_by_name': {f.name: f for f in contents.files},
+    }
+
+def locate_job_in_snapshot(job, snapshot, claimed=()):
+    """
+    按 torrent id / hash 在云端快照中定位任务
+    返回:
+        ('downloading', torrent)        - 仍在 Seedr 上下载
+        ('done', (item, item_type))     - 已下载完成，种子已转为同名文件夹/文件
+        (None, None)                    - 快照中找不到（需要回退到关键词匹配）
+    """
+    torrent = snapshot['torrents_by_id'].get(job.get('torrent_id'))
+    if torrent is None and job.get('torrent_hash'):
+        torrent = snapshot['torrents_by_hash'].get(job['torrent_hash'].lower())
+    if torrent is not None:
+        return 'downloading', torrent
+
+    # 下载完成后种子从传输列表消失，Seedr 会以种子名创建文件夹（单文件种子可能直接是文件）
+    name = job.get('torrent_name')
+    if name:
+        folder = snapshot['folders_by_name'].get(name)
+        if folder is not None and ('folder', folder.id) not in claimed:
+            return 'done', (folder, 'folder')
+        file = snapshot['files_by_name'].get(name)
+        if file is not None and ('file', file.folder_file_id) not in claimed:
+            return 'done', (file, 'file')
+
+    return None, None
+
+def parse_seedr_progress(torrent):
+    """将 Seedr 返回的进度（字符串或数字）转为 0-100 的浮点数"""
+    try:
+        return float(torrent.progress)
+    except (TypeError, ValueError):
+        return 0.0
+
+DOWNLOAD_RETRIES = 3              # 单个文件断点续传的最大尝试次数
+DOWNLOAD_TIMEOUT = (15, 60)       # (连接超时, 读取超时) 秒
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024  # 小于此大小的文件不分段
+TRANSFER_BUFFER_SIZE = 1024 * 1024   # 每个连接复用的读缓冲区大小
+PROGRESS_INTERVAL = 2             # 进度输出的最短间隔（秒）
+FSYNC_INTERVAL = 64 * 1024 * 1024  # fsync 策略为 interval 时，每写入多少字节同步一次
+BANDWIDTH_BURST = 1.0             # 令牌桶容量：限速时最多允许突发多少秒的流量
+FALLOC_FL_KEEP_SIZE = 0x01
+
+
+def get_transfer_settings(settings):
+    """本地传输相关配置（settings 为 get_downloader_settings 的结果，可为 None）"""
+    settings = settings or {}
+    return {
+        'buffer_size': settings.get('transfer_buffer_size', TRANSFER_BUFFER_SIZE),
+        'progress_interval': settings.get('progress_interval', PROGRESS_INTERVAL),
+        'preallocate': settings.get('preallocate', True),
+        # none: 不主动同步 / end: 重命名前同步一次 / interval: 每 fsync_interval 字节同步一次
+        'fsync': settings.get('fsync', 'end'),
+        'fsync_interval': settings.get('fsync_interval', FSYNC_INTERVAL),
+        # 顺序下载时计算的整文件哈希算法；配置了 seedr_hash_algorithm 时与 Seedr 的文件哈希一致。
+        # 没有参照值时整文件哈希只能记录、无法判断损坏，默认不计算（会使传输循环的 CPU 开销增加数倍）
+        'hash_algorithm': settings.get('seedr_hash_algorithm') or settings.get('hash_algorithm'),
+        # 所有并发传输共用的限速器（None 表示不限速）
+        'limiter': settings.get('bandwidth_limiter'),
+    }
+
+
+def parse_clock(value):
+    """'HH:MM' → 当天的分钟数"""
+    hour, minute = value.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def parse_bandwidth_schedule(schedule):
+    """
+    bandwidth_schedule 配置: [{"start": "08:00", "end": "23:30", "rate": 5242880}, ...]
+    rate 为字节/秒（0 或 null 表示不限速），时间为本机时间，start > end 时跨越午夜；不在任何时段内时不限速
+    """
+    windows = []
+    for entry in schedule or []:
+        try:
+            windows.append((parse_clock(entry['start']), parse_clock(entry['end']), entry.get('rate') or 0))
+        except (KeyError, ValueError, AttributeError):
+            print_error(f"忽略无效的限速时段: {entry}")
+    return windows
+
+
+class BandwidthLimiter:
+    """
+    全局令牌桶限速：所有传输线程共用一个桶，总速率不超过当前时段的限制。
+    令牌不足时记为欠账，由本次取令牌的线程睡眠补足，因此并发线程之间按到达顺序分摊带宽
+    """
+
+    def __init__(self, windows, burst=BANDWIDTH_BURST):
+        self.windows = windows
+        self.burst = burst
+        self.rate = None
+        self.tokens = 0.0
+        self.updated_at = time.monotonic()
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def current_rate(self, now=None):
+        """当前时段的限速（字节/秒），不限速时为 0"""
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return 0
+
+    def consume(self, n):
+        """取 n 字节的令牌，超出速率时睡眠"""
+        with self.lock:
+            now = time.monotonic()
+            # 每分钟重新判断一次所在时段，跨过时段边界时立即生效
+            if now - self.checked_at >= 60 or self.rate is None:
+                rate = self.current_rate()
+                if rate != self.rate:
+                    print_info(f"传输限速: {rate / 1024 / 1024:.1f} MB/s" if rate else "传输限速: 不限速")
+                    self.rate = rate
+                    self.tokens = rate * self.burst
+                self.checked_at = now
+            if not self.rate:
+                return
+            self.tokens = min(self.rate * self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            STOP.wait(wait)
+
+
+class TransferProgress:
+    """线程安全的传输进度统计，按时间节流输出进度行（与文件大小和分块大小无关）"""
+
+    def __init__(self, name, total_size, already_downloaded=0, interval=PROGRESS_INTERVAL):
+        self.name = name
+        # 创建时所在线程绑定的任务（分段下载的工作线程共用同一个统计对象）
+        self.task = EVENTS.current_task
+        self.total_size = total_size
+        self.downloaded = already_downloaded
+        self.resumed = already_downloaded
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.last_report = 0.0
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.downloaded += n
+            now = time.monotonic()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self._report(now)
+
+    def rate(self, now=None):
+        elapsed = max((now or time.monotonic()) - self.started_at, 1e-6)
+        return (self.downloaded - self.resumed) / elapsed
+
+    def _report(self, now, final=False):
+        if self.task is not None:
+            EVENTS.progress(self.task, 'transferring', self.downloaded, self.total_size, self.rate(now),
+                            self.name, force=final)
+        progress = (self.downloaded / self.total_size * 100) if self.total_size else 0.0
+        print(f"进度: {progress:.1f}% ({self.downloaded/(1024*1024):.1f}/{self.total_size/(1024*1024):.1f} MB, "
+              f"{self.rate(now)/(1024*1024):.1f} MB/s) {self.name}", flush=True)
+
+    def finish(self):
+        with self.lock:
+            self._report(time.monotonic(), final=True)
+
+
+def preallocate_file(fd, size, keep_size=False):
+    """
+    预分配磁盘空间，减少碎片并提前发现磁盘空间不足
+    keep_size=True 时不改变文件大小（Linux fallocate KEEP_SIZE），单连接续传依赖 .part 的大小作为偏移
+    不支持的平台/文件系统上静默跳过
+    """
+    try:
+        if keep_size:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+            if libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+        else:
+            os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError) as e:
+        if not keep_size:
+            os.ftruncate(fd, size)
+        print_info(f"预分配磁盘空间不可用，已跳过: {e}")
+
+
+def positional_write(fd, data, offset):
+    """按绝对位置写入（多个分段线程共用同一个文件描述符）"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def read_raw(raw, view):
+    """
+    从 urllib3 响应中 readinto，把读取过程中的底层异常转换为 requests 的异常
+    （直接读 response.raw 时 requests 不会再做这层转换，连接中途断开时调用方的重试逻辑也能捕获到）
+    """
+    try:
+        return raw.readinto(view)
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except urllib3.exceptions.SSLError as e:
+        raise requests.exceptions.SSLError(e)
+    except (urllib3.exceptions.HTTPError, OSError) as e:
+        raise requests.exceptions.ConnectionError(e)
+
+
+def stream_to_fd(response, fd, offset, limit, on_write, transfer):
+    """
+    共用的传输循环：用一块复用的大缓冲区 readinto 响应体，按位置写入 fd
+    limit: 最多写入的字节数（None 表示读到结束）
+    on_write: 每写入一块后回调，参数为 (本块在文件中的偏移, 本块数据)
+    返回写入的总字节数
+    """
+    raw = response.raw
+    raw.decode_content = True
+    buf = bytearray(transfer['buffer_size'])
+    view = memoryview(buf)
+    written = 0
+    unsynced = 0
+    while limit is None or written < limit:
+        check_stop()
+        want = len(buf) if limit is None else min(len(buf), limit - written)
+        n = read_raw(raw, view[:want])
+        if not n:
+            break
+        positional_write(fd, view[:n], offset + written)
+        on_write(offset + written, view[:n])
+        written += n
+        if transfer['limiter']:
+            transfer['limiter'].consume(n)
+        if transfer['fsync'] == 'interval':
+            unsynced += n
+            if unsynced >= transfer['fsync_interval']:
+                os.fsync(fd)
+                unsynced = 0
+    return written
+
+
+def finalize_part_file(fd, transfer):
+    """按 fsync 策略在重命名前同步数据"""
+    if transfer['fsync'] in ('end', 'interval'):
+        os.fsync(fd)
+
+
+# --- 完整性校验 ---
+
+def bdecode(data, index=0):
+    """最小的 bencode 解码器，返回 (值, 结束位置)；字典的键保持为 bytes"""
+    token = data[index:index + 1]
+    if token == b'i':
+        end = data.index(b'e', index)
+        return int(data[index + 1:end]), end + 1
+    if token == b'l':
+        index += 1
+        items = []
+        while data[index:index + 1] != b'e':
+            item, index = bdecode(data, index)
+            items.append(item)
+        return items, index + 1
+    if token == b'd':
+        index += 1
+        result = {}
+        while data[index:index + 1] != b'e':
+            key, index = bdecode(data, index)
+            result[key], index = bdecode(data, index)
+        return result, index + 1
+    colon = data.index(b':', index)
+    length = int(data[index:colon])
+    return data[colon + 1:colon + 1 + length], colon + 1 + length
+
+
+def get_torrent_url(task):
+    """任务中可用的 .torrent 地址：task['torrent_url'] 或磁力链接的 xs 参数"""
+    if task.get('torrent_url'):
+        return task['torrent_url']
+    query = urllib.parse.urlparse(task.get('magnet', '')).query
+    for value in urllib.parse.parse_qs(query).get('xs', []):
+        if value.startswith(('http://', 'https://')):
+            return value
+    return None
+
+
+def fetch_torrent_info(task):
+    """下载并解析任务的 .torrent，返回 info 字典；没有来源或失败时返回 None"""
+    url = get_torrent_url(task)
+    if not url:
+        return None
+    try:
+        r = requests.get(url, timeout=DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+        torrent, _ = bdecode(r.content)
+        return torrent[b'info']
+    except Exception as e:
+        print_info(f"无法获取种子信息，跳过分块校验: {e}")
+        return None
+
+
+def get_piece_layout(info, file_name, file_size):
+    """
+    在种子 info 中定位文件，返回分块校验所需信息:
+    {'piece_length', 'hashes', 'total_length', 'file_offset'(文件在整个种子数据中的偏移), 'file_size'}
+    找不到对应文件时返回 None
+    """
+    if not info:
+        return None
+    piece_length = info[b'piece length']
+    pieces = info[b'pieces']
+    hashes = [pieces[i:i + 20] for i in range(0, len(pieces), 20)]
+
+    if b'files' not in info:
+        entries = [([info[b'name']], info[b'length'])]
+    else:
+        entries = [(entry[b'path'], entry[b'length']) for entry in info[b'files']]
+
+    total_length = sum(length for _, length in entries)
+    offset = 0
+    for path, length in entries:
+        name = path[-1].decode('utf-8', errors='replace')
+        if name == file_name and length == file_size:
+            return {'piece_length': piece_length, 'hashes': hashes, 'total_length': total_length,
+                    'file_offset': offset, 'file_size': file_size}
+        offset += length
+    return None
+
+
+class IntegrityChecker:
+    """
+    传输过程中的流式校验（不需要再读一遍文件）：
+    - 数据按顺序到达时计算整文件哈希（分段下载时不计算）
+    - 有种子分块信息时，逐块计算 SHA-1 并与 info 中的 piece 哈希比对；
+      跨越文件边界的首尾分块无法单独校验，会被跳过
+    同一分块的数据必须由同一个线程按顺序写入（分段下载会按分块边界切分）；
+    多个分段线程共用一个校验器，共享的分块表和计数在锁内修改，分块的 SHA-1 在锁外计算
+    """
+
+    def __init__(self, algorithm=None, expected_digest=None, layout=None):
+        self.algorithm = algorithm
+        self.hasher = hashlib.new(algorithm) if algorithm else None
+        self.hash_offset = 0
+        self.expected_digest = expected_digest.lower() if expected_digest else None
+        self.layout = layout
+        self.partial = {}
+        self.pieces_verified = 0
+        self.pieces_failed = []
+        self.lock = threading.Lock()
+
+    def feed(self, offset, data):
+        if self.hasher is not None:
+            if offset == self.hash_offset:
+                self.hasher.update(data)
+                self.hash_offset += len(data)
+            else:
+                # 乱序写入，无法再计算整文件哈希
+                self.hasher = None
+        if self.layout:
+            self._feed_pieces(offset, data)
+
+    def feed_from_file(self, fd, start, length, buffer_size=TRANSFER_BUFFER_SIZE):
+        """续传时补算已写入部分（只读取之前已下载的数据）"""
+        end = start + length
+        while start < end:
+            data = os.pread(fd, min(buffer_size, end - start), start)
+            if not data:
+                break
+            self.feed(start, data)
+            start += len(data)
+
+    def _feed_pieces(self, offset, data):
+        layout = self.layout
+        piece_length = layout['piece_length']
+        file_start = layout['file_offset']
+        file_end = file_start + layout['file_size']
+        pos = file_start + offset
+        view = memoryview(data)
+        while view:
+            index = pos // piece_length
+            piece_start = index * piece_length
+            piece_end = min(piece_start + piece_length, layout['total_length'])
+            take = min(len(view), piece_end - pos)
+            # 只校验完全落在本文件内的分块
+            if piece_start >= file_start and piece_end <= file_end:
+                with self.lock:
+                    state = self.partial.get(index)
+                    if state is None and pos == piece_start:
+                        state = self.partial[index] = [hashlib.sha1(), pos]
+                if state is not None and state[1] == pos:
+                    state[0].update(view[:take])
+                    state[1] += take
+                    if state[1] == piece_end:
+                        matched = state[0].digest() == layout['hashes'][index]
+                        with self.lock:
+                            if matched:
+                                self.pieces_verified += 1
+                            else:
+                                self.pieces_failed.append(index)
+                            del self.partial[index]
+            pos += take
+            view = view[take:]
+
+    def result(self):
+        digest = self.hasher.hexdigest() if self.hasher is not None else None
+        if self.pieces_failed or (self.expected_digest and digest and digest != self.expected_digest):
+            status = 'corrupt'
+        elif self.pieces_verified or (self.expected_digest and digest == self.expected_digest):
+            status = 'verified'
+        else:
+            status = 'unverified'
+        return {
+            'status': status,
+            'algorithm': self.algorithm if digest else None,
+            'digest': digest,
+            'pieces_verified': self.pieces_verified,
+            'pieces_failed': len(self.pieces_failed),
+        }
+
+
+def piece_aligned_boundaries(total_size, segments, layout):
+    """计算分段边界；有分块信息时把边界对齐到种子分块，保证每个分块只由一个连接写入"""
+    seg_size = -(-total_size // segments)  # 向上取整
+    if not layout:
+        return list(range(0, total_size, seg_size)) + [total_size]
+    piece_length = layout['piece_length']
+    shift = layout['file_offset'] % piece_length
+    boundaries = [0]
+    for k in range(1, segments):
+        pos = k * seg_size
+        pos += (-(shift + pos)) % piece_length
+        if boundaries[-1] < pos < total_size:
+            boundaries.append(pos)
+    return boundaries + [total_size]
+
+
+def download_url_to_file(url, save_path, expected_size=0, settings=None, layout=None, expected_digest=None):
+    """
+    断点续传下载单个文件：
+    - 数据先写入 <文件名>.part，中断后（包括进程重启）通过 Range 请求从已有位置继续
+    - 写入的同时计算哈希 / 校验种子分块，发现损坏则删除重下
+    - 完成后校验大小（content-length / Seedr 提供的 size），一致才原子重命名为最终文件名
+    返回完整性校验结果（dict，status 为 corrupt 表示多次重试后仍然损坏），其他失败返回 None
+    """
+    transfer = get_transfer_settings(settings)
+    part_path = save_path + '.part'
+    name = os.path.basename(save_path)
+    integrity = None
+
+    if os.path.exists(save_path) and expected_size and os.path.getsize(save_path) == expected_size:
+        print_info(f"文件已存在且大小一致，跳过: {name}")
+        return {'status': 'existing'}
+
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        if offset:
+            print_info(f"从 {offset/(1024*1024):.1f} MB 处继续下载")
+        checker = IntegrityChecker(transfer['hash_algorithm'], expected_digest, layout)
+
+        try:
+            with requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status_code == 416 and expected_size and offset == expected_size:
+                    # .part 已经完整，只是上次没来得及重命名
+                    total_size = expected_size
+                    with open(part_path, 'rb') as f:
+                        checker.feed_from_file(f.fileno(), 0, offset)
+                else:
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        # 服务器不支持 Range，只能从头开始
+                        print_info("服务器不支持断点续传，从头下载")
+                        offset = 0
+                    content_length = int(r.headers.get('content-length', 0))
+                    total_size = (offset + content_length) if content_length else expected_size
+
+                    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        if not offset:
+                            os.ftruncate(fd, 0)
+                        else:
+                            checker.feed_from_file(fd, 0, offset)
+                        if transfer['preallocate'] and total_size:
+                            preallocate_file(fd, total_size, keep_size=True)
+                        progress = TransferProgress(name, total_size, offset, transfer['progress_interval'])
+
+                        def on_write(pos, data):
+                            checker.feed(pos, data)
+                            progress.update(len(data))
+
+                        stream_to_fd(r, fd, offset, None, on_write, transfer)
+                        progress.finish()
+                        finalize_part_file(fd, transfer)
+                    finally:
+                        os.close(fd)
+        except requests.RequestException as e:
+            print_error(f"下载中断 (第 {attempt}/{DOWNLOAD_RETRIES} 次): {e}")
+            continue
+
+        actual_size = os.path.getsize(part_path)
+        if (total_size and actual_size != total_size) or (expected_size and actual_size != expected_size):
+            print_error(f"文件大小不一致 (第 {attempt}/{DOWNLOAD_RETRIES} 次): 本地 {actual_size}, 期望 {total_size or expected_size}")
+            if actual_size > (expected_size or total_size):
+                # 多出来的数据无法续传，删除后重下
+                os.remove(part_path)
+            continue
+
+        integrity = checker.result()
+        if integrity['status'] == 'corrupt':
+            print_error(f"完整性校验失败 (第 {attempt}/{DOWNLOAD_RETRIES} 次)，删除后重新下载: {name}")
+            os.remove(part_path)
+            continue
+
+        os.replace(part_path, save_path)
+        return integrity
+
+    return integrity
+
+
+def probe_range_support(url, session=None):
+    """请求第一个字节，返回 (是否支持 Range, 文件总大小)；失败时返回 (False, 0)"""
+    getter = session.get if session else requests.get
+    try:
+        with getter(url, stream=True, headers={'Range': 'bytes=0-0'}, timeout=DOWNLOAD_TIMEOUT) as r:
+            content_range = r.headers.get('content-range', '')
+            if r.status_code == 206 and '/' in content_range:
+                total = content_range.rsplit('/', 1)[1]
+                return True, int(total) if total.isdigit() else 0
+    except requests.RequestException as e:
+        print_error(f"检测 Range 支持失败: {e}")
+    return False, 0
+
+
+def download_url_segmented(url, save_path, total_size, segments, settings=None, layout=None):
+    """
+    多连接分段下载：
+    - 将文件按字节范围分成 segments 段（有种子分块信息时按分块对齐），每段一个独立连接并行下载
+    - 预分配 <文件名>.part，各段用 pwrite 直接写到各自位置，写入的同时校验种子分块
+    - 每段失败后只重试该段（从该段已完成的位置继续），分段进度保存在 .part.json 中，进程重启后也能续传
+    - 完成后校验大小并原子重命名，打印总平均速度
+    返回完整性校验结果（dict，status 为 corrupt 表示文件损坏），其他失败返回 None
+    """
+    transfer = get_transfer_settings(settings)
+    part_path = save_path + '.part'
+    state_path = part_path + '.json'
+    boundaries = piece_aligned_boundaries(total_size, segments, layout)
+
+    # 读取上次的分段进度（总大小或分段边界变化则重新开始）
+    state = None
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        state = load_json(state_path, None)
+        if not state or state.get('total_size') != total_size or \
+                [seg[0] for seg in state.get('segments', [])] != boundaries[:-1]:
+            state = None
+    if state is None:
+        state = {
+            'total_size': total_size,
+            'segments': [[start, end - 1, 0] for start, end in zip(boundaries, boundaries[1:])],
+        }
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != total_size:
+        if transfer['preallocate']:
+            preallocate_file(fd, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+    save_json(state_path, state)
+
+    lock = threading.Lock()
+    progress = TransferProgress(os.path.basename(save_path), total_size,
+                                sum(seg[2] for seg in state['segments']), transfer['progress_interval'])
+    # 分段下载是乱序写入，只做分块校验
+    checker = IntegrityChecker(None, None, layout)
+
+    def fetch_segment(seg):
+        start, end = seg[0], seg[1]
+        checker.feed_from_file(fd, start, seg[2], transfer['buffer_size'])
+
+        def on_write(pos, data):
+            checker.feed(pos, data)
+            with lock:
+                seg[2] += len(data)
+            progress.update(len(data))
+
+        with requests.Session() as session:
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                if start + seg[2] > end:
+                    return True
+                headers = {'Range': f'bytes={start + seg[2]}-{end}'}
+                try:
+                    with session.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as r:
+                        if r.status_code != 206:
+                            raise requests.RequestException(f"服务器返回 {r.status_code}，不支持分段")
+                        stream_to_fd(r, fd, start + seg[2], end - start - seg[2] + 1, on_write, transfer)
+                    if start + seg[2] > end:
+                        return True
+                    raise requests.RequestException("连接提前关闭")
+                except requests.RequestException as e:
+                    print_error(f"分段 {start}-{end} 下载中断 (第 {attempt}/{DOWNLOAD_RETRIES} 次): {e}")
+                finally:
+                    with lock:
+                        save_json(state_path, state)
+        return False
+
+    try:
+        with thread_pool(segments) as pool:
+            results = list(pool.map(fetch_segment, state['segments']))
+        if all(results):
+            finalize_part_file(fd, transfer)
+    finally:
+        os.close(fd)
+
+    if not all(results):
+        print_error("部分分段下载失败，已保留进度供续传")
+        return None
+
+    progress.finish()
+    print_success(f"分段下载完成: {segments} 个连接，平均速度 {progress.rate()/(1024*1024):.2f} MB/s")
+
+    integrity = checker.result()
+    if integrity['status'] == 'corrupt':
+        print_error(f"完整性校验失败，删除后重新下载: {os.path.basename(save_path)}")
+        os.remove(part_path)
+        os.remove(state_path)
+        return integrity
+
+    os.replace(part_path, save_path)
+    os.remove(state_path)
+    return integrity
+
+
+def download_file(url, save_path, expected_size=0, settings=None, layout=None, expected_digest=None):
+    """
+    下载单个文件：大文件且服务器支持 Range 时使用多连接分段下载，否则单连接断点续传
+    返回完整性校验结果（dict，status 为 corrupt 表示文件损坏），其他失败返回 None
+    """
+    segments = (settings or {}).get('download_segments', 1)
+    min_size = (settings or {}).get('segment_min_size', SEGMENT_MIN_SIZE)
+    part_path = save_path + '.part'
+    # 已有单连接留下的 .part（没有分段进度文件）时继续用单连接续传
+    single_stream_part = os.path.exists(part_path) and not os.path.exists(part_path + '.json')
+    # 需要与 Seedr 提供的整文件哈希比对时只能顺序下载
+    if segments > 1 and expected_size >= min_size and not single_stream_part and not expected_digest:
+        supports_range, total_size = probe_range_support(url)
+        if supports_range and total_size == expected_size:
+            return download_url_segmented(url, save_path, total_size, segments, settings, layout)
+        print_info("服务器不支持分段下载，使用单连接")
+
+    return download_url_to_file(url, save_path, expected_size, settings, layout, expected_digest)
+
+def download_from_seedr(client, item, item_type, save_dir, settings=None, torrent_info=None,
+                        integrity_records=None, cache=None):
+    """
+    从Seedr下载文件到本地
+    torrent_info: 种子的 info 字典（可选），用于分块校验
+    integrity_records: 传入列表时，每个文件的校验结果会追加到其中
+    cache: 文件夹列表缓存（可选）
+    """
     downloaded_files = []
+    hash_algorithm = (settings or {}).get('seedr_hash_algorithm')
     
     try:
         if item_type == 'file':
             # 单个文件
-            file_result = client.fetch_file(item.folder_file_id)
-            if not file_result or not file_result.url:
-                print_error(f"无法获取文件下载链接: {item.name}")
-                return []
-            
-            save_path = os.path.join(save_dir, item.name)
-            print_info(f"下载文件: {item.name} ({item.size / (1024*1024):.1f} MB)")
-            
-            with requests.get(file_result.url, stream=True) as r:
-                r.raise_for_status()
-                total_size = int(r.headers.get('content-length', 0)) or item.size
-                downloaded = 0
-                
-                with open(save_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            if total_size > 0:
-                                progress = (downloaded / total_size) * 100
-                                print(f"\r进度: {progress:.1f}% ({downloaded/(1024*1024):.1f}/{total_size/(1024*1024):.1f} MB)", end='', flush=True)
-                
-                print()  # 新行
-                downloaded_files.append(save_path)
-                
+            files = [item]
         elif item_type == 'folder':
             # 文件夹 - 下载其中的视频文件
-            folder_contents = client.list_contents(folder_id=item.id)
-            video_extensions = ['.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v']
-            
-            video_files_found = False
-            for file in folder_contents.files:
-                file_ext = os.path.splitext(file.name.lower())[1]
-                if file_ext in video_extensions:
-                    video_files_found = True
-                    file_result = client.fetch_file(file.folder_file_id)
-                    if file_result and file_result.url:
-                        save_path = os.path.join(save_dir, file.name)
-                        print_info(f"下载视频文件: {file.name} ({file.size / (1024*1024):.1f} MB)")
-                        
-                        with requests.get(file_result.url, stream=True) as r:
-                            r.raise_for_status()
-                            total_size = int(r.headers.get('content-length', 0)) or file.size
-                            downloaded = 0
-                            
-                            with open(save_path, 'wb') as f:
-                                for chunk in r.iter_content(chunk_size=8192):
-                                    if chunk:
-                                        f.write(chunk)
-                                        downloaded += len(chunk)
-                                        
-                                        if total_size > 0:
-                                            progress = (downloaded / total_size) * 100
-                                            print(f"\r进度: {progress:.1f}% ({downloaded/(1024*1024):.1f}/{total_size/(1024*1024):.1f} MB)", end='', flush=True)
-                            
-                            print()  # 新行
-                            downloaded_files.append(save_path)
-            
-            if not video_files_found:
+            files = [file for file in list_seedr_folder(client, item, cache)
+                     if os.path.splitext(file.name.lower())[1] in VIDEO_EXTENSIONS]
+            if not files:
                 print_error(f"文件夹 {item.name} 中未找到视频文件")
+                return []
+        else:
+            return []
+
+        for file in files:
+            file_result = client.fetch_file(file.folder_file_id)
+            if not file_result or not file_result.url:
+                print_error(f"无法获取文件下载链接: {file.name}")
+                return []
+
+            save_path = os.path.join(save_dir, file.name)
+            layout = get_piece_layout(torrent_info, file.name, file.size)
+            # 只有明确配置了 Seedr 文件哈希的算法时才与其比对
+            expected_digest = getattr(file, 'hash', None) if hash_algorithm else None
+            print_info(f"下载视频文件: {file.name} ({file.size / (1024*1024):.1f} MB)")
+            integrity = download_file(file_result.url, save_path, file.size, settings, layout, expected_digest)
+            if integrity is None or integrity['status'] == 'corrupt':
+                if integrity is None:
+                    print_error(f"下载失败，已保留 {os.path.basename(save_path)}.part 供续传")
+                if integrity_records is not None:
+                    integrity_records.append({'file': file.name, 'size': file.size, **(integrity or {'status': 'failed'})})
+                return []
+            if integrity_records is not None:
+                integrity_records.append({'file': file.name, 'size': file.size, **integrity})
+            if integrity['status'] == 'verified':
+                print_success(f"完整性校验通过: {file.name}")
+            downloaded_files.append(save_path)
         
         return downloaded_files
         
@@ -313,293 +1129,769 @@ def download_from_seedr(client, item, item_type, save_dir):
         print_error(f"下载文件时出错: {e}")
         return []
 
+def delete_seedr_item(client, item, item_type):
+    """删除云端文件/文件夹（带重试），失败时抛出异常"""
+    if item_type == 'file':
+        result = seedr_call(client.delete_file, item.folder_file_id)
+    else:
+        result = seedr_call(client.delete_folder, item.id)
+    if not result or not getattr(result, 'result', False):
+        raise RuntimeError("Seedr 返回删除失败")
+
+
 def cleanup_seedr(client, item, item_type):
     """清理Seedr云端文件"""
+    kind = '文件' if item_type == 'file' else '文件夹'
     try:
-        if item_type == 'file':
-            result = client.delete_file(item.folder_file_id)
-            if result and result.result:
-                print_success(f"已删除云端文件: {item.name}")
-            else:
-                print_error(f"删除云端文件失败: {item.name}")
-        elif item_type == 'folder':
-            result = client.delete_folder(item.id)
-            if result and result.result:
-                print_success(f"已删除云端文件夹: {item.name}")
-            else:
-                print_error(f"删除云端文件夹失败: {item.name}")
+        delete_seedr_item(client, item, item_type)
+        print_success(f"已删除云端{kind}: {item.name}")
     except Exception as e:
-        print_error(f"清理云端文件时出错: {e}")
+        print_error(f"删除云端{kind}失败: {item.name}: {e}")
 
 
-def clear_seedr_account(client):
-    """(新增) 登录后立刻清空Seedr云端所有文件和文件夹"""
-    print_info("🧹 正在清空 Seedr 云端空间 (防止空间不足)...")
-    try:
-        # 1. 获取根目录 (folder_id=0) 的所有内容
-        contents = client.list_contents(folder_id=0)
-        
-        files_to_delete = contents.files
-        folders_to_delete = contents.folders
-        
-        if not files_to_delete and not folders_to_delete:
-            print_success("☁️ Seedr 云端已是空的。")
+def evict_transferred_items(client, contents, keep_names, is_transferred, cache=None):
+    """
+    只删除已经传输到本地的云端文件/文件夹，返回释放的空间（字节）
+    文件夹列表和删除都通过有界线程池并发执行；列表缓存命中时不发请求
+    """
+    files = [file for file in contents.files if file.name not in keep_names]
+    folders = [folder for folder in contents.folders if folder.name not in keep_names]
+
+    def all_transferred(videos):
+        return bool(videos) and all(is_transferred(file) for file in videos)
+
+    evictable = [(file, 'file') for file in files if is_video_file(file.name) and is_transferred(file)]
+    for folder, folder_files in zip(folders, list_seedr_folders(client, folders, cache)):
+        if folder_files is not None and all_transferred([f for f in folder_files if is_video_file(f.name)]):
+            evictable.append((folder, 'folder'))
+    if not evictable:
+        print_info("没有已传输到本地、需要清理的云端文件")
+        return 0
+
+    print_info(f"🧹 删除 {len(evictable)} 个已传输到本地的云端文件/文件夹...")
+    results = run_seedr_bulk(lambda entry: delete_seedr_item(client, *entry) or True,
+                             evictable, "删除云端文件")
+    freed = sum(item.size or 0 for (item, _), ok in zip(evictable, results) if ok)
+    print_success(f"已删除 {sum(1 for ok in results if ok)}/{len(evictable)} 个，释放 {freed / (1024*1024):.0f} MB")
+    return freed
+
+
+# --- 3. 流水线下载逻辑 ---
+
+# 任务阶段: queued(待添加) -> added(云端下载中) -> cloud_done(等待传输) -> transferring(传输到本地) -> done / failed
+POLL_MIN_INTERVAL = 2      # 首次/最短云端状态轮询间隔（秒）
+POLL_MAX_INTERVAL = 60      # 指数退避后的最长轮询间隔（秒）
+CLOUD_TIMEOUT = 180         # 云端下载超时的基础时间（秒），再按种子大小追加
+MIN_CLOUD_RATE = 1024 * 1024  # 估算超时时假定的最低云端下载速度（字节/秒）
+MAX_TASK_RETRIES = 2        # 每个任务最多重试次数
+DEFAULT_TRANSFER_WORKERS = 3
+DEFAULT_TASK_SIZE = 1024 * 1024 * 1024  # 无法得知种子大小时，按 1 GB 预留云端空间
+
+
+def get_downloader_settings(config):
+    """读取 bt_downloader 配置（缺省时使用默认值）"""
+    settings = (config or {}).get('bt_downloader', {})
+    return {
+        'max_concurrent_transfers': max(1, int(settings.get('max_concurrent_transfers', DEFAULT_TRANSFER_WORKERS))),
+        'poll_min_interval': settings.get('poll_min_interval', POLL_MIN_INTERVAL),
+        'poll_max_interval': settings.get('poll_max_interval', POLL_MAX_INTERVAL),
+        'cloud_timeout': settings.get('cloud_timeout', CLOUD_TIMEOUT),
+        'min_cloud_rate': settings.get('min_cloud_rate', MIN_CLOUD_RATE),
+        'max_retries': settings.get('max_retries', MAX_TASK_RETRIES),
+        'download_segments': max(1, int(settings.get('download_segments', 1))),
+        'segment_min_size': settings.get('segment_min_size', SEGMENT_MIN_SIZE),
+        # 下载目录兼媒体库（local_storage.anime_dir），和保留策略、本地索引使用同一个目录
+        'download_dir': get_anime_dir(config),
+        # 完成后整理到 anime/<番剧>/Season N/（move / hardlink / off）
+        'organize_mode': get_organize_mode(config),
+        # 本地传输参数（见 get_transfer_settings）
+        'transfer_buffer_size': settings.get('transfer_buffer_size', TRANSFER_BUFFER_SIZE),
+        'progress_interval': settings.get('progress_interval', PROGRESS_INTERVAL),
+        'preallocate': settings.get('preallocate', True),
+        'fsync': settings.get('fsync', 'end'),
+        'fsync_interval': settings.get('fsync_interval', FSYNC_INTERVAL),
+        # 完整性校验：整文件哈希算法（None 表示不计算），以及 Seedr 文件哈希所用的算法（None 表示不比较）
+        'hash_algorithm': settings.get('hash_algorithm'),
+        'seedr_hash_algorithm': settings.get('seedr_hash_algorithm'),
+        'bandwidth_limiter': BandwidthLimiter(parse_bandwidth_schedule(settings.get('bandwidth_schedule'))),
+    }
+
+
+def torrent_total_size(info):
+    """种子 info 中所有文件的总大小"""
+    if b'files' not in info:
+        return info[b'length']
+    return sum(entry[b'length'] for entry in info[b'files'])
+
+
+class SeedrBackend(DownloadBackend):
+    """
+    Seedr 云端后端：云端下载完成后通过 HTTP 传输到本地，再清理云端。
+    按云端配额做准入控制：已准入任务按种子大小预留空间，放不下的任务留在队列中，
+    等其他任务传输完成、云端文件删除后再添加
+    """
+
+    name = 'seedr'
+    remote = True
+
+    def __init__(self, client, history=None, default_task_size=DEFAULT_TASK_SIZE, download_dir=DOWNLOAD_DIR):
+        self.client = client
+        self.history = history
+        self.download_dir = download_dir
+        self.default_task_size = default_task_size
+        self.space_max = 0
+        self.space_used = 0
+        self.foreign_used = 0   # 不属于本次任务的云端占用
+        self.reserved = {}      # 磁力链接 -> 已准入任务占用（或预计占用）的空间
+        self.cache = load_seedr_cache()
+        self.lock = threading.Lock()
+
+    def is_transferred(self, file):
+        """云端文件是否已完整传输到本地（本地同名同大小，或历史中有校验记录）"""
+        local_path = os.path.join(self.download_dir, file.name)
+        if os.path.exists(local_path) and os.path.getsize(local_path) == file.size:
             return True
+        return self.history is not None and self.history.has_transferred_file(file.name, file.size)
+
+    def prepare(self, jobs):
+        """读取配额；只删除已传输到本地的云端文件，上次中断的任务和其他文件都保留"""
+        print_info("=" * 50)
+        print_info("☁️  检查 Seedr 云端空间...")
+        snapshot = list_seedr_transfers(self.client)
+        contents = snapshot['contents']
+        resumed = [job for job in jobs if job.get('resumed')]
+        keep_names = {job['torrent_name'] for job in resumed if job.get('torrent_name')}
+        freed = evict_transferred_items(self.client, contents, keep_names, self.is_transferred, self.cache)
+        save_seedr_cache(self.cache, contents)
+
+        self.space_max = contents.space_max or 0
+        self.space_used = max(0, (contents.space_used or 0) - freed)
+        # 上次中断的任务已经在云端，按实际大小预留
+        for job in resumed:
+            state, found = locate_job_in_snapshot(job, snapshot)
+            if state == 'downloading':
+                job['size'] = found.size or job.get('size')
+            elif state == 'done':
+                job['size'] = found[0].size or job.get('size')
+            if job.get('size'):
+                self.reserved[job['task']['magnet']] = job['size']
+        self.foreign_used = max(0, self.space_used - sum(self.reserved.values()))
+
+        mb = 1024 * 1024
+        print_info(f"☁️  云端空间: 已用 {self.space_used / mb:.0f} MB / 共 {self.space_max / mb:.0f} MB")
+        print_info("=" * 50)
+
+    def estimate_size(self, job):
+        """任务占用的云端空间：实际大小 > 种子元数据 > 搜索结果中的大小 > 默认值"""
+        if job.get('size'):
+            return job['size']
+        if 'torrent_info' not in job:
+            job['torrent_info'] = fetch_torrent_info(job['task'])
+        if job['torrent_info']:
+            return torrent_total_size(job['torrent_info'])
+        if job['task'].get('size'):
+            return int(job['task']['size'])
+        return self.default_task_size
+
+    def admit(self, job):
+        size = self.estimate_size(job)
+        with self.lock:
+            # 没有自己的任务占用云端时总是尝试添加（大小只是估计值，由 Seedr 自己判断是否放得下）
+            if not self.reserved or not self.space_max:
+                return True
+            used = max(self.space_used, self.foreign_used + sum(self.reserved.values()))
+            return size <= self.space_max - used
+
+    def add(self, job):
+        """将任务的磁力链接添加到 Seedr"""
+        task = job['task']
+        try:
+            result = self.client.add_torrent(magnet_link=task['magnet'])
+        except Exception as e:
+            print_error(f"添加到 Seedr 失败: {task.get('title', 'Unknown')}: {e}")
+            return False
+
+        if not result or not getattr(result, 'result', False):
+            print_error(f"添加到 Seedr 失败: {task.get('title', 'Unknown')}")
+            return False
+
+        job['torrent_id'] = getattr(result, 'user_torrent_id', None)
+        job['torrent_hash'] = getattr(result, 'torrent_hash', None)
+        job['torrent_name'] = getattr(result, 'title', None)
+        size = self.estimate_size(job)
+        with self.lock:
+            self.reserved[task['magnet']] = size
+        print_success(f"已添加到 Seedr: {getattr(result, 'title', None) or task.get('title', 'Unknown')}")
+        return True
+
+    def refresh(self, jobs):
+        snapshot = list_seedr_transfers(self.client)
+        contents = snapshot['contents']
+        if contents.space_max:
+            with self.lock:
+                self.space_max, self.space_used = contents.space_max, contents.space_used or 0
+        # 正在传输的文件/文件夹已被认领，不再匹配给其他任务
+        snapshot['claimed'] = {job['claim'] for job in jobs
+                               if job['stage'] in ('cloud_done', 'transferring') and 'claim' in job}
+        return snapshot
 
-        print_info(f"   发现 {len(files_to_delete)} 个文件 和 {len(folders_to_delete)} 个文件夹/种子。")
+    def status(self, job, snapshot):
+        title = job['task'].get('title', 'Unknown')
+        claimed = snapshot['claimed']
+        state, found = locate_job_in_snapshot(job, snapshot, claimed)
+        if state == 'downloading':
+            job['progress'] = parse_seedr_progress(found)
+            job['size'] = found.size or job.get('size')
+            job['download_rate'] = found.download_rate
+            if job['size']:
+                with self.lock:
+                    self.reserved[job['task']['magnet']] = job['size']
+            return 'downloading', None
 
-        # 2. 删除所有文件
-        for file in files_to_delete:
+        if state == 'done':
+            item, item_type = found
+        else:
+            # 按 id 找不到（旧任务或 Seedr 改名），回退到关键词匹配
+            print_info(f"按种子 ID 未找到，使用关键词匹配: {title}")
+            print_info(f"匹配关键词: {job['keywords']}")
             try:
-                print_info(f"   - 正在删除文件: {file.name}")
-                client.delete_file(file.folder_file_id)
+                item, item_type = find_seedr_item(self.client, job['keywords'], claimed, snapshot['contents'],
+                                                  self.cache)
             except Exception as e:
-                print_error(f"   - 删除文件 {file.name} 失败: {e}")
+                print_error(f"检查下载状态时出错: {e}")
+                item, item_type = None, None
+            if not item:
+                return 'missing', None
+
+        job['claim'] = (item_type, item.folder_file_id if item_type == 'file' else item.id)
+        claimed.add(job['claim'])
+        return 'done', (item, item_type)
+
+    def fetch(self, job, save_dir, settings):
+        item, item_type = job['item']
+        if 'torrent_info' not in job:
+            job['torrent_info'] = fetch_torrent_info(job['task'])
+        torrent_info = job['torrent_info']
+        job['integrity'] = []
+        return download_from_seedr(self.client, item, item_type, save_dir,
+                                   settings, torrent_info, job['integrity'], self.cache)
+
+    def remove(self, job):
+        item, item_type = job['item']
+        cleanup_seedr(self.client, item, item_type)
+        # 在传输线程中调用，和主线程的准入判断共用预留表
+        with self.lock:
+            self.reserved.pop(job['task']['magnet'], None)
+            self.space_used = max(0, self.space_used - (item.size or 0))
 
-        # 3. 删除所有文件夹 (注意：种子/Torrents 在这里也表现为 'folder')
-        for folder in folders_to_delete:
+    def release(self, job):
+        """
+        任务回到队列或失败时调用：删除云端残留的文件/文件夹（已完成但没能传输的）
+        或种子（下载出错、超时的），并释放预留的空间。
+        失败的云端文件既不会被预留也不会被 prepare() 清理，不删除就会一直占用配额
+        """
+        title = job['task'].get('title', 'Unknown')
+        freed = 0
+        if job.get('item'):
+            item, item_type = job.pop('item')
+            cleanup_seedr(self.client, item, item_type)
+            freed = item.size or 0
+        elif job.get('torrent_id') is not None:
             try:
-                print_info(f"   - 正在删除文件夹/种子: {folder.name}")
-                client.delete_folder(folder.id) 
+                seedr_call(self.client.delete_torrent, job['torrent_id'])
+                print_info(f"已删除云端种子: {title}")
             except Exception as e:
-                print_error(f"   - 删除文件夹 {folder.name} 失败: {e}")
-        
-        print_success("✅ Seedr 云端清空完毕。")
-        return True
+                # 种子可能已被手动删除，只影响配额统计，下一轮 refresh 会按实际占用更新
+                print_info(f"删除云端种子失败: {title}: {e}")
+        job.pop('claim', None)
+        with self.lock:
+            self.reserved.pop(job['task']['magnet'], None)
+            self.space_used = max(0, self.space_used - freed)
 
-    except Exception as e:
-        print_error(f"💥 清空 Seedr 时发生严重错误: {e}")
-        print_error("   警告：脚本将继续执行，但可能会因空间不足而失败。")
-        return False
 
+def create_backend(config, history=None, sessions=None):
+    """
+    根据 bt_downloader.client_type 创建下载后端（默认 seedr），失败返回 None
+    sessions: 进程内多次运行共用的会话缓存（dict），传入时复用上次登录的 Seedr 会话
+    """
+    bt_config = (config or {}).get('bt_downloader', {})
+    client_type = bt_config.get('client_type', 'seedr')
 
-# --- 3. 主下载逻辑 ---
+    if client_type == 'seedr':
+        session_key = ('seedr', (config or {}).get('global_settings', {}).get('seedr_email'))
+        client = sessions.get(session_key) if sessions is not None else None
+        if client:
+            print_info("复用已登录的 Seedr 会话")
+        else:
+            print_info("开始登录 Seedr...")
+            sys.stdout.flush()  # 强制输出
+            client = login_to_seedr(config)
+            if not client:
+                print_error("无法登录 Seedr")
+                return None
+            if sessions is not None:
+                sessions[session_key] = client
+        return SeedrBackend(client, history, bt_config.get('default_task_size', DEFAULT_TASK_SIZE),
+                            get_anime_dir(config))
 
-def process_single_task(client, task, history, retry_step=1):
-    """处理单个下载任务，支持从指定步骤开始重试"""
-    magnet = task.get('magnet')
-    title = task.get('title', 'Unknown')
-    
-    if not magnet:
-        print_error(f"任务缺少磁力链接: {title}")
-        return False
-    
-    # 检查是否已下载
-    if is_already_downloaded(magnet, history):
-        print_info(f"跳过已下载: {title}")
-        return True
-    
-    print_info(f"开始处理: {title}")
-    if retry_step > 1:
-        print_info(f"重试模式：从步骤 {retry_step} 开始")
-    
+    backend_class = LOCAL_BACKENDS.get(client_type)
+    if not backend_class:
+        print_error(f"不支持的下载后端: {client_type}")
+        return None
+    print_info(f"使用本地下载后端: {client_type}")
+    return backend_class(**bt_config.get(client_type, {}))
+
+def transfer_job(backend, job, settings):
+    """获取文件到本地并从后端移除任务（在工作线程中执行）"""
+    os.makedirs(settings['download_dir'], exist_ok=True)
+    EVENTS.bind_task(job['task'])
     try:
-        # 步骤 1: 添加到Seedr（如果是重试且从步骤2开始，跳过此步骤）
-        if retry_step <= 1:
-            print_info("步骤 1/4: 添加到 Seedr...")
-            result = client.add_torrent(magnet_link=magnet)
-            
-            if not result:
-                print_error("添加到 Seedr 失败")
-                return False
-            
-            print_success(f"已添加到 Seedr: {result.title if hasattr(result, 'title') else 'Unknown'}")
-            torrent_id = result.torrent_id if hasattr(result, 'torrent_id') else 'unknown'
-        else:
-            print_info("步骤 1/4: 跳过（重试模式）")
-            torrent_id = 'unknown'
-
-        # 步骤 2: 等待下载完成
-        if retry_step <= 2:
-            print_info("步骤 2/4: 等待 Seedr 下载完成...")
-            skip_initial_wait = (retry_step == 2)  # 如果是从步骤2重试，跳过初始等待
-            item, item_type = wait_for_seedr_download(client, torrent_id, title, skip_initial_wait)
-            
-            if not item:
-                print_error("Seedr 下载失败或超时")
-                return False
-        else:
-            print_info("步骤 2/4: 跳过（重试模式）")
-            # 重新查找文件
-            item, item_type = wait_for_seedr_download(client, 'unknown', title, skip_initial_wait=True)
-            if not item:
-                print_error("重试时未找到文件")
-                return False
-
-        # 步骤 3: 下载到本地
-        if retry_step <= 3:
-            print_info("步骤 3/4: 下载到本地...")
-            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-            downloaded_files = download_from_seedr(client, item, item_type, DOWNLOAD_DIR)
-            
-            if not downloaded_files:
-                print_error("本地下载失败")
-                return False
-            
-            print_success(f"下载完成，共 {len(downloaded_files)} 个文件")
-            for file_path in downloaded_files:
-                print_info(f"  - {os.path.basename(file_path)}")
-        else:
-            print_info("步骤 3/4: 跳过（重试模式）")
+        downloaded_files = backend.fetch(job, settings['download_dir'], settings)
+    finally:
+        EVENTS.bind_task(None)
+    if downloaded_files:
+        backend.remove(job)
+    return downloaded_files
 
-        # 步骤 4: 清理云端文件
-        print_info("步骤 4/4: 清理云端文件...")
-        cleanup_seedr(client, item, item_type)
-        
-        # 5. 更新历史记录 (修改)
-        # 从 task 对象中获取 'anime_title' 和 'episode'
-        # 这两个字段是由 search_torrents.py 写入 search_results.json 的
-        
-        anime_title_from_task = task.get('anime_title')
-        episode_num_from_task = task.get('episode')
-        
-        if not anime_title_from_task or episode_num_from_task is None:
-            print_error(f"❌ 任务 {title} 缺少 'anime_title' 或 'episode' 字段，无法更新最高集数！")
-            # 仍然只添加磁力链接，以防重复下载
-            add_to_history(magnet, "Unknown_Anime", 0, history) 
+
+def record_integrity(job, history):
+    """把传输时的完整性校验结果写入历史记录（只在主线程中调用）"""
+    records = {}
+    checked_at = datetime.datetime.now().isoformat(timespec='seconds')
+    for record in job.get('integrity', []):
+        records[record['file']] = {**record, 'magnet': job['task'].get('magnet'), 'checked_at': checked_at}
+        if record.get('status') == 'corrupt':
+            print_error(f"文件损坏，任务将重新下载: {record['file']}")
+    if records:
+        history.record_integrity(records)
+
+
+def record_job_success(job, history):
+    """先写预写日志，再更新历史记录（只在主线程中调用）"""
+    JOURNAL.append({'op': 'task_done', 'task': job['task'],
+                    'completed_at': datetime.datetime.now().isoformat(timespec='seconds')})
+    record_task_history(job['task'], history)
+
+
+def record_task_history(task, history):
+    """把完成的任务写入历史记录（重放日志时会重复调用，必须幂等）"""
+    magnet = task.get('magnet')
+    # 'anime_title' 和 'episode' 由 search_torrents.py 写入 search_results.json
+    anime_title_from_task = task.get('anime_title')
+    episode_num_from_task = task.get('episode')
+
+    if not anime_title_from_task or episode_num_from_task is None:
+        print_error(f"❌ 任务 {task.get('title', 'Unknown')} 缺少 'anime_title' 或 'episode' 字段，无法更新最高集数！")
+        # 仍然只添加磁力链接，以防重复下载
+        add_to_history(magnet, "Unknown_Anime", 0, history, task.get('title'))
+    else:
+        add_to_history(magnet, anime_title_from_task, episode_num_from_task, history, task.get('title'),
+                       task.get('release'))
+
+
+# --- 任务状态机 ---
+# queued → added → cloud_done → transferring → done / failed
+# 状态保存在任务的 download_state 字段中（随 search_results.json 持久化），下次运行从中断的阶段继续
+
+# 需要持久化的后端任务 id（Seedr 的种子 id / hash / 名称，本地客户端的任务 id）
+PERSISTED_JOB_KEYS = ('torrent_id', 'torrent_hash', 'torrent_name', 'backend_id', 'active_id')
+# 这些阶段说明后端中已有任务，恢复时直接按 id 重新查询，不再重复添加
+RESUMABLE_STAGES = ('added', 'cloud_done', 'transferring')
+
+
+def set_stage(job, stage, reason=None):
+    """切换任务阶段并更新 download_state，标记为待保存（由流水线每轮统一写盘）"""
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+    job['stage'] = stage
+    state = job['task'].setdefault('download_state', {})
+    state['stage'] = stage
+    state['attempts'] = job['total_attempts']
+    state['backend'] = job.get('backend')
+    state['backend_ids'] = {key: job[key] for key in PERSISTED_JOB_KEYS if job.get(key) is not None}
+    state.setdefault('stage_times', {})[stage] = now
+    state['updated_at'] = now
+    if reason:
+        state['last_error'] = reason
+    job['dirty'] = True
+    EVENTS.stage(job['task'], stage, reason)
+
+
+def restore_job(task, backend_name, save_dir=DOWNLOAD_DIR):
+    """根据任务保存的 download_state 创建 job：后端中已有的任务从 added 阶段继续查询"""
+    state = task.get('download_state') or {}
+    job = {'task': task, 'stage': 'queued', 'attempts': 0, 'total_attempts': state.get('attempts', 0),
+           'keywords': extract_keywords(task.get('title', '')), 'save_dir': save_dir,
+           'backend': backend_name}
+    if (state.get('stage') in RESUMABLE_STAGES and state.get('backend') == backend_name
+            and state.get('backend_ids')):
+        job.update(state['backend_ids'])
+        job['stage'] = 'added'
+        job['resumed'] = state['stage']
+    return job
+
+
+def flush_job_states(jobs, save_state):
+    """把本轮有变化的任务状态一次性写盘"""
+    dirty = [job for job in jobs if job.pop('dirty', False)]
+    if dirty and save_state:
+        try:
+            save_state([job['task'] for job in dirty])
+        except Exception as e:
+            print_error(f"保存任务状态失败: {e}")
+
+
+def start_cloud_wait(job, settings):
+    """开始（或重新开始）等待云端完成：重置退避间隔和超时起点"""
+    now = time.time()
+    job['added_at'] = now
+    job['poll_delay'] = settings['poll_min_interval']
+    job['next_check_at'] = now + settings['poll_min_interval']
+
+
+def schedule_next_poll(job, settings):
+    """
+    计算任务的下一次检查时间：
+    - 默认从最短间隔开始指数退避（上限 poll_max_interval）
+    - 已知大小/进度/速度时，按预计剩余时间提前检查
+    - 加入 ±20% 随机抖动，避免所有任务同时到期
+    """
+    min_interval = settings['poll_min_interval']
+    delay = min(job.get('poll_delay', min_interval) * 2, settings['poll_max_interval'])
+    job['poll_delay'] = delay
+
+    size, rate = job.get('size'), job.get('download_rate')
+    if size and rate and job.get('progress') is not None:
+        eta = size * (100 - job['progress']) / 100 / rate
+        delay = max(min_interval, min(eta, delay))
+
+    job['next_check_at'] = time.time() + delay * random.uniform(0.8, 1.2)
+
+
+def cloud_deadline(job, settings):
+    """按种子大小计算云端下载的超时时间点（大小未知时只用基础超时）"""
+    size = job.get('size') or 0
+    return job['added_at'] + settings['cloud_timeout'] + size / settings['min_cloud_rate']
+
+
+def release_job(backend, job):
+    """任务回到队列或失败时释放后端资源，并清掉后端任务 id（重新添加时会得到新的 id）"""
+    backend.release(job)
+    for key in PERSISTED_JOB_KEYS:
+        job.pop(key, None)
+
+
+def fail_or_retry(backend, job, reason, settings, retry_stage):
+    """记录一次失败；未超过重试次数则回到 retry_stage，否则标记为 failed"""
+    max_retries = settings['max_retries']
+    job['attempts'] += 1
+    job['total_attempts'] += 1
+    title = job['task'].get('title', 'Unknown')
+    if job['attempts'] > max_retries:
+        release_job(backend, job)
+        set_stage(job, 'failed', reason)
+        print_error(f"❌ 任务失败（已重试 {max_retries} 次）: {title} - {reason}")
+    else:
+        if retry_stage == 'queued':
+            release_job(backend, job)
+        set_stage(job, retry_stage, reason)
+        if retry_stage == 'added':
+            start_cloud_wait(job, settings)
+        print_info(f"🔄 {reason}，第 {job['attempts']} 次重试: {title}")
+
+
+def run_download_pipeline(backend, tasks, history, settings, save_state=None):
+    """
+    流水线处理所有任务：
+    1. 尽可能把所有磁力链接一次性添加到下载后端（空间不足时暂缓，等有任务完成后再添加）
+    2. 在同一个循环中轮询所有任务的完成状态
+    3. 已完成的任务交给线程池并发获取到本地，其他任务继续下载
+    save_state(tasks): 持久化任务的 download_state，每轮循环最多调用一次
+    """
+    jobs = []
+    for task in tasks:
+        if not task.get('magnet'):
+            print_error(f"任务缺少磁力链接: {task.get('title', 'Unknown')}")
+            jobs.append({'task': task, 'stage': 'failed', 'attempts': 0})
+        elif is_already_downloaded(task['magnet'], history):
+            print_info(f"跳过已下载: {task.get('title', 'Unknown')}")
+            jobs.append({'task': task, 'stage': 'done', 'attempts': 0})
         else:
-            # (修改) 传入所有必需的参数
-            add_to_history(magnet, anime_title_from_task, episode_num_from_task, history)
-        
-        
-        return True
-        
-    except Exception as e:
-        print_error(f"处理任务时出错: {e}")
-        return False
+            job = restore_job(task, backend.name, settings['download_dir'])
+            if job.get('resumed'):
+                print_info(f"⏯️  从上次中断的阶段继续（{job['resumed']}）: {task.get('title', 'Unknown')}")
+                start_cloud_wait(job, settings)
+                job['next_check_at'] = time.time()
+            jobs.append(job)
+
+    backend.prepare(jobs)
+    futures = {}
+    last_deferred = 0
+
+    with thread_pool(settings['max_concurrent_transfers']) as pool:
+        try:
+            while True:
+                # 被要求停止时直接退出：正在进行的传输也会停止，任务保持当前阶段，下次运行继续
+                check_stop()
+                # 阶段 1: 添加排队中的任务（空间放不下的先跳过，继续尝试更小的任务）
+                deferred = 0
+                for job in jobs:
+                    if job['stage'] != 'queued':
+                        continue
+                    if not backend.admit(job):
+                        if any(j['stage'] in RESUMABLE_STAGES for j in jobs):
+                            deferred += 1
+                        else:
+                            fail_or_retry(backend, job, f"{backend.name} 空间不足", settings, 'queued')
+                        continue
+                    if backend.add(job):
+                        set_stage(job, 'added')
+                        start_cloud_wait(job, settings)
+                        continue
+                    in_flight = any(j['stage'] in RESUMABLE_STAGES for j in jobs)
+                    if in_flight:
+                        # 很可能是空间不足，等其他任务传输并清理后再添加
+                        print_info("⏸️  暂缓添加剩余任务，等待云端空间释放")
+                        break
+                    fail_or_retry(backend, job, f"添加到 {backend.name} 失败", settings, 'queued')
+                if deferred != last_deferred:
+                    if deferred:
+                        print_info(f"⏸️  空间不足，{deferred} 个任务等待其他任务完成后再添加")
+                    last_deferred = deferred
+
+                # 阶段 2: 一次轮询检查所有等待中的任务
+                pending = [job for job in jobs if job['stage'] == 'added']
+                snapshot = None
+                # 只有有任务到期时才请求；请求一次后所有等待中的任务都顺带更新
+                if any(time.time() >= job['next_check_at'] for job in pending):
+                    try:
+                        snapshot = backend.refresh(jobs)
+                    except Exception as e:
+                        print_error(f"获取 {backend.name} 任务状态时出错: {e}")
+                        for job in pending:
+                            schedule_next_poll(job, settings)
+
+                for job in (pending if snapshot is not None else []):
+                    title = job['task'].get('title', 'Unknown')
+                    state, item = backend.status(job, snapshot)
+                    if state == 'missing' and job.pop('resumed', None):
+                        # 上次的任务已不在后端（被手动删除等），重新添加
+                        print_info(f"后端中找不到上次的任务，重新添加: {title}")
+                        release_job(backend, job)
+                        set_stage(job, 'queued')
+                        continue
+                    job.pop('resumed', None)
+                    if state == 'downloading':
+                        print_info(f"☁️  {backend.name} 下载 {job.get('progress', 0):.1f}% "
+                                   f"({(job.get('download_rate') or 0) / (1024*1024):.1f} MB/s): {title}")
+                        size = job.get('size') or 0
+                        EVENTS.progress(job['task'], 'added', int(size * job.get('progress', 0) / 100), size,
+                                        job.get('download_rate'))
+
+                    if state == 'done':
+                        job['item'] = item
+                        set_stage(job, 'cloud_done')
+                    elif state == 'error':
+                        fail_or_retry(backend, job, f"{backend.name} 下载出错", settings, 'queued')
+                    elif time.time() > cloud_deadline(job, settings):
+                        fail_or_retry(backend, job, f"{backend.name} 下载超时", settings, 'added')
+                    else:
+                        schedule_next_poll(job, settings)
+
+                # 阶段 2b: 有空闲的传输线程时，开始获取已完成的任务
+                for job in jobs:
+                    if len(futures) >= settings['max_concurrent_transfers']:
+                        break
+                    if job['stage'] == 'cloud_done':
+                        set_stage(job, 'transferring')
+                        print_info(f"📥 {backend.name} 已完成，开始获取到本地: {job['task'].get('title', 'Unknown')}")
+                        futures[pool.submit(transfer_job, backend, job, settings)] = job
+
+                # 阶段 3: 收集已结束的传输（停止时传输是被中断的，不能当作失败处理）
+                check_stop()
+                for future in [f for f in futures if f.done()]:
+                    job = futures.pop(future)
+                    try:
+                        downloaded_files = future.result()
+                    except Exception as e:
+                        print_error(f"传输时出错: {e}")
+                        downloaded_files = []
+                    record_integrity(job, history)
+
+                    if downloaded_files:
+                        # 只做 rename / hardlink，在主线程中执行即可
+                        downloaded_files = organize_files(downloaded_files, job['task'], settings['download_dir'],
+                                                          settings['organize_mode'])
+                        set_stage(job, 'done')
+                        print_success(f"✅ 任务完成: {job['task'].get('title', 'Unknown')}，共 {len(downloaded_files)} 个文件")
+                        for file_path in downloaded_files:
+                            print_info(f"  - {os.path.basename(file_path)}")
+                        record_job_success(job, history)
+                    else:
+                        # 后端的文件仍然保留，重新查找后再次获取
+                        fail_or_retry(backend, job, "本地下载失败", settings, 'added')
+
+                flush_job_states(jobs, save_state)
+                if all(job['stage'] in ('done', 'failed') for job in jobs):
+                    break
+
+                # 睡到最早到期的检查时间；有传输在进行时，任一传输结束就立即进入下一轮
+                next_checks = [job['next_check_at'] for job in jobs if job['stage'] == 'added']
+                timeout = settings['poll_max_interval']
+                if next_checks:
+                    timeout = max(0, min(next_checks) - time.time())
+                if futures:
+                    wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    STOP.wait(timeout)
+        finally:
+            # 被中断时也保存最后一轮的状态变化
+            flush_job_states(jobs, save_state)
+
+    return jobs
 
 # --- 4. 主执行函数 ---
 
+def save_task_states(tasks):
+    """把任务的 download_state 写回任务队列文件（按磁力链接匹配，保留运行期间新追加的任务）"""
+    states = {task.get('magnet'): task['download_state'] for task in tasks}
+
+    def apply_states(queue):
+        for entry in queue:
+            if entry.get('magnet') in states:
+                entry['download_state'] = states[entry['magnet']]
+
+    update_json(SEARCH_RESULTS_FILE, [], apply_states)
+
+
+def replay_journal(history):
+    """重放上次运行被中断时留下的预写日志：补写历史记录，并把这些任务移出任务队列"""
+    records = [record for record in JOURNAL.replay() if record.get('op') == 'task_done']
+    if records:
+        print_info(f"🔁 重放上次中断时留下的 {len(records)} 条完成记录")
+        for record in records:
+            record_task_history(record['task'], history)
+        done_magnets = {record['task'].get('magnet') for record in records}
+        update_json(SEARCH_RESULTS_FILE, [],
+                    lambda tasks: [task for task in tasks if task.get('magnet') not in done_magnets])
+    JOURNAL.clear()
+
+
 def main():
-    """主函数：批量下载动漫，按动漫分组智能重试"""
+    """主函数：流水线批量下载动漫"""
     print("🎬 BT下载脚本启动")
     print("=" * 50)
     
     try:
-        # 1. 登录 Seedr
-        print_info("开始登录 Seedr...")
-        sys.stdout.flush()  # 强制输出
-        client = login_to_seedr()
-        if not client:
-            print_error("无法登录 Seedr，退出")
-            return
-        
-        # 清空云端空间
-        print_info("=" * 50)
-        clear_seedr_account(client)
-        print_info("=" * 50)
+        # 调度器通过 BANGMI_RUN_ID 传入本次作业的 ID，事件与调度日志可以对应起来
+        download_job(run_id=os.environ.get('BANGMI_RUN_ID'))
+    except BlockingIOError:
+        print_error("另一个下载进程正在运行，退出")
+    except KeyboardInterrupt:
+        print_info("\n⌨️  用户中断，正在退出...")
+    except Exception as e:
+        print_error(f"💥 程序出错: {e}")
+        import traceback
+        traceback.print_exc()
+    
+    print("\n🎉 下载脚本执行完毕")
+
+
+def admit_by_disk_space(tasks, config):
+    """本地磁盘的准入控制：先按保留策略腾出空间，放不下的任务留在队列中下次处理"""
+    default_size = (config or {}).get('bt_downloader', {}).get('default_task_size', DEFAULT_TASK_SIZE)
+    sizes = [task.get('size') or default_size for task in tasks]
+    available = ensure_space(config, sum(sizes))
+    if available is None:
+        return tasks
+    admitted = []
+    for task, size in zip(tasks, sizes):
+        if size <= available:
+            admitted.append(task)
+            available -= size
+    if len(admitted) < len(tasks):
+        print_error(f"💽 本地磁盘空间不足，{len(tasks) - len(admitted)} 个任务推迟到下次运行")
+    return admitted
 
+
+def download_job(config=None, history=None, sessions=None, run_id=None):
+    """
+    下载作业（可导入调用）：持有运行锁，写进度事件，处理任务队列。
+    调度器 / Web 应用在进程内执行时传入共享的配置、历史存储和会话缓存；
+    另一个下载正在运行时抛出 BlockingIOError
+    """
+    with file_lock(RUN_LOCK_FILE, blocking=False):
+        EVENTS.start_run(run_id)
+        try:
+            run_downloads(config, history, sessions)
+        except JobStopped:
+            # 任务阶段和传输进度都已保存，预写日志保留到下次运行时补上
+            print_info("⏹️  下载作业已停止，下次运行时继续")
+        finally:
+            EVENTS.finish_run()
+
+
+def run_downloads(config=None, history=None, sessions=None):
+    """处理任务队列（持有运行锁时调用）；未传入 config / history 时自行加载，自己打开的历史存储用完后关闭"""
+    if config is None:
+        config = load_config()
+    # 历史记录存放在 SQLite 中，每完成一个任务立即写入（首次运行时从 JSON 迁移）
+    owns_history = history is None
+    if owns_history:
+        history = open_history(config)
+    try:
+        # 1. 补上次被中断的运行
+        replay_journal(history)
         
-        # 2. 加载搜索结果和历史记录
+        # 2. 加载搜索结果
         search_results = load_json(SEARCH_RESULTS_FILE, [])
-        history = load_json(HISTORY_FILE, {"highest_episode_downloaded": {}, "all_downloaded_magnets": []})
-        
         if not search_results:
             print_info("没有待处理的下载任务")
             return
         
-        # 3. 按动漫分组任务
-        anime_groups = {}
-        for task in search_results:
-            anime_title = task.get('anime_title', 'Unknown')
-            if anime_title not in anime_groups:
-                anime_groups[anime_title] = []
-            anime_groups[anime_title].append(task)
+        anime_titles = {task.get('anime_title', 'Unknown') for task in search_results}
+        print_info(f"总共 {len(search_results)} 个任务，涉及 {len(anime_titles)} 部动漫")
         
-        print_info(f"总共 {len(search_results)} 个任务，分为 {len(anime_groups)} 个动漫组")
+        # 3. 磁盘空间准入：淘汰旧文件，空间仍不够时推迟部分任务（它们留在任务队列中）
+        search_results = admit_by_disk_space(search_results, config)
+        if not search_results:
+            return
         
-        all_completed_tasks = []
-        all_failed_tasks = []
+        # 4. 创建下载后端（默认 Seedr）
+        backend = create_backend(config, history, sessions)
+        if not backend:
+            print_error("无法初始化下载后端，退出")
+            return
         
-        # 4. 逐个动漫组处理
-        for group_idx, (anime_title, anime_tasks) in enumerate(anime_groups.items(), 1):
-            print(f"\n{'='*60}")
-            print(f"🎯 [{group_idx}/{len(anime_groups)}] 处理动漫组: {anime_title}")
-            print(f"📋 任务数量: {len(anime_tasks)}")
-            print('='*60)
-            
-            group_completed = []
-            group_failed = []
-            
-            # 第一轮：正常处理所有任务
-            for i, task in enumerate(anime_tasks, 1):
-                print(f"\n[{anime_title}] 📥 任务 {i}/{len(anime_tasks)}")
-                print(f"🎬 {task.get('title', 'Unknown')}")
-                print("-" * 40)
-                
-                success = process_single_task(client, task, history)
-                if success:
-                    group_completed.append(task)
-                    print_success(f"✅ 任务完成")
-                else:
-                    group_failed.append(task)
-                    print_error(f"❌ 任务失败")
-                
-                # 任务间休息
-                if i < len(anime_tasks):
-                    print_info("⏸️  等待3秒后处理下一个任务...")
-                    time.sleep(3)
-            
-            # 重试失败的任务（每个动漫组最多重试2轮）
-            retry_round = 1
-            max_retries = 2
-            
-            while group_failed and retry_round <= max_retries:
-                print(f"\n🔄 [{anime_title}] 第 {retry_round} 轮重试")
-                print(f"📋 剩余失败任务: {len(group_failed)} 个")
-                print("-" * 40)
-                
-                current_failed = group_failed.copy()
-                group_failed = []
-                
-                for i, task in enumerate(current_failed, 1):
-                    print(f"\n🔄 重试 {i}/{len(current_failed)}: {task.get('title', 'Unknown')}")
-                    
-                    # 重试时从步骤2开始（跳过上传，30s等待后检查）
-                    success = process_single_task(client, task, history, retry_step=2)
-                    if success:
-                        group_completed.append(task)
-                        print_success(f"✅ 重试成功")
-                    else:
-                        group_failed.append(task)
-                        print_error(f"❌ 重试仍失败")
-                    
-                    # 重试任务间休息更长时间
-                    if i < len(current_failed):
-                        print_info("⏸️  重试间隔5秒...")
-                        time.sleep(5)
-                
-                retry_round += 1
-            
-            # 输出动漫组结果
-            print(f"\n📊 [{anime_title}] 组内统计:")
-            print(f"✅ 成功: {len(group_completed)}/{len(anime_tasks)}")
-            print(f"❌ 失败: {len(group_failed)}/{len(anime_tasks)}")
-            
-            if group_failed:
-                print_error(f"❌ 最终失败的任务:")
-                for task in group_failed:
-                    print_error(f"   - {task.get('title', 'Unknown')}")
-            
-            all_completed_tasks.extend(group_completed)
-            all_failed_tasks.extend(group_failed)
-            
-            # 动漫组间休息
-            if group_idx < len(anime_groups):
-                print_info("⏸️  动漫组间等待10秒...")
-                time.sleep(10)
+        # 5. 流水线处理所有任务
+        settings = get_downloader_settings(config)
+        print_info(f"并发传输数: {settings['max_concurrent_transfers']}")
+        for task in search_results:
+            print_info(f"📋 [{task.get('anime_title', 'Unknown')}] {task.get('title', 'Unknown')}")
+        jobs = run_download_pipeline(backend, search_results, history, settings, save_task_states)
         
-        # 5. 保存结果
-        save_json(HISTORY_FILE, history)
+        all_completed_tasks = [job['task'] for job in jobs if job['stage'] == 'done']
+        all_failed_tasks = [job['task'] for job in jobs if job['stage'] != 'done']
         
-        # 6. 更新搜索结果文件（移除成功的任务）
         if all_failed_tasks:
-            save_json(SEARCH_RESULTS_FILE, all_failed_tasks)
-            print_info(f"💾 保留 {len(all_failed_tasks)} 个失败任务供下次重试")
+            print_error(f"❌ 最终失败的任务:")
+            for task in all_failed_tasks:
+                print_error(f"   - {task.get('title', 'Unknown')}")
+        
+        # 6. 更新任务队列：只移除本次完成的任务（运行期间搜索脚本可能追加了新任务）
+        completed_magnets = {task.get('magnet') for task in all_completed_tasks}
+        remaining_tasks = update_json(SEARCH_RESULTS_FILE, [],
+                                      lambda tasks: [task for task in tasks if task.get('magnet') not in completed_magnets])
+        # 历史和任务队列都已落盘，日志可以清空
+        JOURNAL.clear()
+        if remaining_tasks:
+            print_info(f"💾 任务队列中保留 {len(remaining_tasks)} 个任务供下次处理")
         else:
-            save_json(SEARCH_RESULTS_FILE, [])
             print_success("🎉 所有任务完成，搜索结果已清空")
         
+        # 历史记录已逐条写入，按需导出旧的 JSON 格式
+        if (config or {}).get('global_settings', {}).get('export_history_json'):
+            print_info(f"💾 已导出历史记录: {history.export_json()}")
+        
         # 7. 显示最终统计
         print("\n" + "=" * 60)
         print("🏆 最终统计报告")
@@ -608,25 +1900,19 @@ def main():
         print_success(f"✅ 成功完成: {len(all_completed_tasks)} 个")
         if all_failed_tasks:
             print_error(f"❌ 最终失败: {len(all_failed_tasks)} 个")
-        print_info(f"📁 历史记录: {len(history.get('all_downloaded_magnets', []))} 个磁力链接")
-        print_info(f"🎬 处理动漫: {len(anime_groups)} 个")
+        print_info(f"📁 历史记录: {history.download_count()} 个磁力链接")
+        print_info(f"🎬 处理动漫: {len(anime_titles)} 个")
         
         if len(all_failed_tasks) == 0:
             print_success("\n🎉 恭喜！所有下载任务都已完成！")
         else:
             print_error(f"\n⚠️  注意：还有 {len(all_failed_tasks)} 个任务未完成，已保存供下次重试")
-            
-    except KeyboardInterrupt:
-        print_info("\n⌨️  用户中断，正在退出...")
-    except Exception as e:
-        print_error(f"💥 程序出错: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    print("\n🎉 下载脚本执行完毕")
+    finally:
+        if owns_history:
+            history.close()
 
 # --- 5. 脚本入口 ---
 
 if __name__ == "__main__":
     main()
-    print("--- BT 下载脚本执行完毕 ---")
\ No newline at end of file
+    print("--- BT 下载脚本执行完毕 ---")
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+下载历史存储（SQLite）
+- downloads: 已下载的种子，按 info hash 建主键（无法解析时用磁力链接本身），按番剧建索引
+- shows:     每部番剧已下载的最高集数
+- file_integrity: 传输时的完整性校验结果
+- episodes:  每一集已下载的版本，按 (番剧, 集数, 字幕组|分辨率|语言) 建主键，用于跨字幕组去重
+首次打开时从旧的 download_history.json 迁移；每完成一个任务就单独提交一次。
+命令行: python history_store.py export [输出文件]   导出为旧的 JSON 格式
+        python history_store.py compact            整理数据库文件
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import sys
+
+from bt_backends import magnet_info_hash
+from release_parser import parse_release, release_variant
+from state_store import atomic_write_json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
+DEFAULT_JSON_FILE = 'data/download_history.json'
+DEFAULT_DB_FILE = 'data/download_history.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    key TEXT PRIMARY KEY,
+    magnet TEXT NOT NULL,
+    anime_title TEXT,
+    episode REAL,
+    title TEXT,
+    downloaded_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_downloads_anime ON downloads (anime_title);
+CREATE TABLE IF NOT EXISTS shows (
+    anime_title TEXT PRIMARY KEY,
+    highest_episode REAL NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS file_integrity (
+    file TEXT PRIMARY KEY,
+    magnet TEXT,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    anime_title TEXT NOT NULL,
+    episode REAL NOT NULL,
+    variant TEXT NOT NULL,
+    release TEXT NOT NULL,
+    magnet TEXT,
+    downloaded_at TEXT,
+    PRIMARY KEY (anime_title, episode, variant)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def magnet_key(magnet):
+    """同一个种子的不同磁力链接（tracker / dn 不同）归为同一条记录"""
+    return magnet_info_hash(magnet) or magnet
+
+
+def now_iso():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def get_history_paths(config=None):
+    """从 global_settings 读取历史文件路径（相对于项目根目录），返回 (db_path, json_path)"""
+    global_config = (config or {}).get('global_settings', {})
+    db_file = global_config.get('download_history_db', DEFAULT_DB_FILE)
+    json_file = global_config.get('download_history_file', DEFAULT_JSON_FILE)
+    return os.path.join(PROJECT_ROOT, db_file), os.path.join(PROJECT_ROOT, json_file)
+
+
+class HistoryStore:
+    """下载历史，所有写操作立即提交（WAL 模式下可与其他进程的读取并发）"""
+
+    def __init__(self, db_path, json_path=None):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self.json_path = json_path
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        if json_path:
+            self.migrate_from_json(json_path)
+        self.backfill_episodes()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- 迁移 / 导出 ---
+
+    def migrate_from_json(self, json_path):
+        """只迁移一次：之后 JSON 文件只作为导出结果，不再读取"""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+            return
+        data = {}
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f) or {}
+            except Exception as e:
+                print_error(f"读取 {json_path} 失败，跳过迁移: {e}")
+                return
+
+        magnets = data.get('all_downloaded_magnets', [])
+        highest = data.get('highest_episode_downloaded', {})
+        integrity = data.get('file_integrity', {})
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO downloads (key, magnet) VALUES (?, ?)",
+                ((magnet_key(magnet), magnet) for magnet in magnets if magnet))
+            for anime_title, episode in highest.items():
+                try:
+                    episode = float(episode)
+                except (TypeError, ValueError):
+                    continue
+                self.conn.execute(
+                    "INSERT INTO shows (anime_title, highest_episode) VALUES (?, ?) "
+                    "ON CONFLICT(anime_title) DO UPDATE SET highest_episode = MAX(highest_episode, excluded.highest_episode)",
+                    (anime_title, episode))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_integrity (file, magnet, record) VALUES (?, ?, ?)",
+                ((name, record.get('magnet'), json.dumps(record, ensure_ascii=False))
+                 for name, record in integrity.items()))
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                              (json_path if os.path.exists(json_path) else '',))
+        if magnets or highest:
+            print_success(f"已从 {json_path} 迁移 {len(magnets)} 条下载记录、{len(highest)} 部番剧的集数")
+
+    def backfill_episodes(self):
+        """只执行一次：按已有下载记录的标题补全 episodes 表"""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'episodes_backfilled'").fetchone():
+            return
+        rows = self.conn.execute(
+            "SELECT anime_title, episode, title, magnet, downloaded_at FROM downloads "
+            "WHERE anime_title IS NOT NULL AND episode IS NOT NULL AND title IS NOT NULL").fetchall()
+        with self.conn:
+            for anime_title, episode, title, magnet, downloaded_at in rows:
+                release = parse_release(title)
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO episodes (anime_title, episode, variant, release, magnet, downloaded_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (anime_title, episode, release_variant(release), json.dumps(release, ensure_ascii=False),
+                     magnet, downloaded_at))
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('episodes_backfilled', ?)", (now_iso(),))
+
+    def to_dict(self):
+        """旧 download_history.json 的结构"""
+        return {
+            'highest_episode_downloaded': self.highest_episodes(),
+            'all_downloaded_magnets': [row[0] for row in self.conn.execute(
+                "SELECT magnet FROM downloads ORDER BY rowid")],
+            'file_integrity': {row[0]: json.loads(row[1]) for row in self.conn.execute(
+                "SELECT file, record FROM file_integrity ORDER BY rowid")},
+        }
+
+    def export_json(self, json_path=None):
+        """导出为旧的 JSON 格式，供仍读取 JSON 的工具使用"""
+        json_path = json_path or self.json_path
+        atomic_write_json(json_path, self.to_dict())
+        return json_path
+
+    def compact(self):
+        """合并 WAL 并回收空间"""
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.execute('VACUUM')
+
+    # --- 查询 ---
+
+    def is_downloaded(self, magnet):
+        return self.conn.execute("SELECT 1 FROM downloads WHERE key = ?",
+                                 (magnet_key(magnet),)).fetchone() is not None
+
+    def highest_episode(self, anime_title):
+        row = self.conn.execute("SELECT highest_episode FROM shows WHERE anime_title = ?",
+                                (anime_title,)).fetchone()
+        return row[0] if row else 0.0
+
+    def highest_episodes(self):
+        return dict(self.conn.execute("SELECT anime_title, highest_episode FROM shows ORDER BY anime_title"))
+
+    def has_transferred_file(self, file_name, size):
+        """文件是否已完整传输到本地（有大小一致、未损坏的校验记录）"""
+        row = self.conn.execute("SELECT record FROM file_integrity WHERE file = ?", (file_name,)).fetchone()
+        if not row:
+            return False
+        record = json.loads(row[0])
+        return record.get('size') == size and record.get('status') not in ('corrupt', 'failed')
+
+    def episode_releases(self, anime_title, episode):
+        """某一集已下载过的版本（parse_release 的结果列表）"""
+        return [json.loads(row[0]) for row in self.conn.execute(
+            "SELECT release FROM episodes WHERE anime_title = ? AND episode = ? ORDER BY downloaded_at",
+            (anime_title, episode))]
+
+    def download_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+
+    # --- 写入（每次调用单独提交） ---
+
+    def add_download(self, magnet, anime_title=None, episode=None, title=None):
+        """记录一个已下载的种子，已存在时返回 False"""
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO downloads (key, magnet, anime_title, episode, title, downloaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (magnet_key(magnet), magnet, anime_title, episode, title, now_iso()))
+        return cursor.rowcount > 0
+
+    def record_episode(self, anime_title, episode, release, magnet=None):
+        """记录某一集下载的版本；同一版本的修正版 / 片源升级覆盖原记录"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO episodes (anime_title, episode, variant, release, magnet, downloaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (anime_title, episode, release_variant(release), json.dumps(release, ensure_ascii=False),
+                 magnet, now_iso()))
+
+    def update_highest_episode(self, anime_title, episode):
+        """集数更高时更新，返回 (是否更新, 原来的最高集数)"""
+        current = self.highest_episode(anime_title)
+        if episode <= current:
+            return False, current
+        # WHERE 条件保证其他进程同时写入更高集数时不会被覆盖
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO shows (anime_title, highest_episode, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(anime_title) DO UPDATE SET highest_episode = excluded.highest_episode, "
+                "updated_at = excluded.updated_at WHERE excluded.highest_episode > shows.highest_episode",
+                (anime_title, episode, now_iso()))
+        return True, current
+
+    def record_integrity(self, records):
+        """records: {文件名: 校验记录}"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_integrity (file, magnet, record) VALUES (?, ?, ?)",
+                ((name, record.get('magnet'), json.dumps(record, ensure_ascii=False))
+                 for name, record in records.items()))
+
+
+def open_history(config=None):
+    """按配置打开历史存储（首次打开时自动迁移 JSON）"""
+    db_path, json_path = get_history_paths(config)
+    return HistoryStore(db_path, json_path)
+
+
+def main():
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'export'
+    with open_history(config) as store:
+        if command == 'export':
+            path = store.export_json(os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else None)
+            print_success(f"已导出 {store.download_count()} 条下载记录到 {path}")
+        elif command == 'compact':
+            store.compact()
+            print_success(f"已整理 {store.db_path}")
+        else:
+            print_error(f"未知命令: {command}（可用: export, compact）")
+
+
+if __name__ == "__main__":
+    main()
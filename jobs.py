@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+搜索 / 下载作业的执行
+调度器和 Web 应用通过 run_job('search' | 'download') 执行作业，执行方式由 config.json 的 scheduler.job_mode 决定：
+- inprocess（默认）：在常驻的单个工作线程中直接调用 search_torrents.run_search / download_bt.download_job，
+  多次运行共用一份运行时（配置、HTTP 会话、Seedr 登录会话、历史数据库连接），
+  不再每次启动解释器、重新导入 requests / seedrcc 和重新登录
+- subprocess：和以前一样为每次作业启动独立的 Python 进程，脚本崩溃或内存泄漏不会影响调用方
+作业串行执行。作业输出逐行实时交给调用方的回调（进程内模式下只捕获作业线程及其传输线程的输出，
+见 thread_output），只保留最后若干行随结果返回，内存占用与输出总量无关
+进程内的工作线程不是守护线程，解释器退出时会等它结束，所以调用方退出前要先调用 request_stop()：
+设置停止标志，下载作业在下一块数据 / 下一轮检查前停止（进度和任务阶段都已保存，下次运行继续），
+而不是把工作线程改成守护线程——那样作业中的传输线程池仍会在退出时被等待结束
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import requests
+
+import download_bt
+import search_torrents
+import thread_output
+from history_store import get_history_paths, open_history
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
+JOB_SCRIPTS = {
+    'search': os.path.join(PROJECT_ROOT, 'search_torrents.py'),
+    'download': os.path.join(PROJECT_ROOT, 'download_bt.py'),
+}
+JOB_MODES = ('inprocess', 'subprocess')
+# 返回给调用方的输出每个流只保留最后这么多行（完整输出通过 on_line 回调实时处理）
+MAX_OUTPUT_LINES = 1000
+# 单行最长字符数，更长的输出拆成多行
+MAX_LINE_CHARS = 8192
+
+
+class JobRuntime:
+    """
+    进程内作业共用的运行时。只在作业工作线程中使用
+    （SQLite 连接不能跨线程，所以历史存储也在该线程中打开）
+    """
+
+    def __init__(self):
+        self.config = None
+        self.config_mtime = None
+        self.history = None
+        self.history_paths = None
+        self.http = None
+        # 登录会话缓存，见 download_bt.create_backend
+        self.sessions = {}
+
+    def load_config(self):
+        """config.json 修改后（Web 应用保存设置）自动重新加载"""
+        try:
+            mtime = os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self.config_mtime:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                self.config = json.load(f)
+            self.config_mtime = mtime
+            # 账号或后端可能已修改，旧的登录会话不再复用
+            self.sessions.clear()
+        return self.config
+
+    def get_history(self, config):
+        paths = get_history_paths(config)
+        if self.history is None or paths != self.history_paths:
+            if self.history is not None:
+                self.history.close()
+            self.history = open_history(config)
+            self.history_paths = paths
+        return self.history
+
+    def get_http(self):
+        if self.http is None:
+            self.http = requests.Session()
+        return self.http
+
+
+RUNTIME = JobRuntime()
+WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bangmi-job')
+
+
+def get_job_mode(config):
+    mode = (config or {}).get('scheduler', {}).get('job_mode', 'inprocess')
+    return mode if mode in JOB_MODES else 'inprocess'
+
+
+class OutputCapture:
+    """
+    按行接收作业输出：每行立即交给 on_line(stream, line) 回调（stream 为 'stdout' / 'stderr'），
+    只保留每个流最后 max_lines 行作为返回结果，内存占用与作业运行时长无关
+    """
+
+    def __init__(self, on_line=None, max_lines=MAX_OUTPUT_LINES):
+        self.on_line = on_line
+        self.tails = {'stdout': deque(maxlen=max_lines), 'stderr': deque(maxlen=max_lines)}
+        self.lock = threading.Lock()
+
+    def feed(self, stream, line):
+        line = line.rstrip('\r\n')
+        with self.lock:
+            self.tails[stream].append(line)
+            if self.on_line:
+                try:
+                    self.on_line(stream, line)
+                except Exception:
+                    # 回调出错不能影响作业本身
+                    pass
+
+    def text(self, stream):
+        with self.lock:
+            return ''.join(line + '\n' for line in self.tails[stream])
+
+
+class LineWriter(io.TextIOBase):
+    """进程内执行时作业线程的输出写入端，按行转交给 OutputCapture（多个传输线程可同时写入）"""
+
+    def __init__(self, capture, stream):
+        self.capture = capture
+        self.stream = stream
+        self.partial = ''
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            lines = (self.partial + text).split('\n')
+            self.partial = lines.pop()
+            if len(self.partial) > MAX_LINE_CHARS:
+                lines.append(self.partial)
+                self.partial = ''
+        for line in lines:
+            self.capture.feed(self.stream, line)
+        return len(text)
+
+    def finish(self):
+        """输出没有以换行结尾时，把最后一段作为一行"""
+        with self.lock:
+            partial, self.partial = self.partial, ''
+        if partial:
+            self.capture.feed(self.stream, partial)
+
+
+def execute_inprocess(name, run_id, titles, capture):
+    """在工作线程中执行作业，本线程（及作业创建的传输线程）的输出逐行交给 capture，返回是否成功"""
+    stdout, stderr = LineWriter(capture, 'stdout'), LineWriter(capture, 'stderr')
+    success = True
+    thread_output.install()
+    with thread_output.route_output(stdout, stderr):
+        try:
+            config = RUNTIME.load_config()
+            history = RUNTIME.get_history(config) if config else None
+            if name == 'search':
+                search_torrents.run_search(config, history, RUNTIME.get_http(), titles)
+            else:
+                download_bt.download_job(config, history, RUNTIME.sessions, run_id)
+        except BlockingIOError:
+            print("❌ 另一个下载进程正在运行，跳过本次下载", file=sys.stderr)
+            success = False
+        except BaseException:
+            # 作业中的任何异常（包括 SystemExit）都不能让工作线程退出
+            traceback.print_exc()
+            success = False
+    stdout.finish()
+    stderr.finish()
+    return success
+
+
+def pump_lines(pipe, stream, capture):
+    """逐行读取子进程的输出管道（单行最长 MAX_LINE_CHARS 个字符，更长的拆成多行）"""
+    with pipe:
+        for line in iter(lambda: pipe.readline(MAX_LINE_CHARS), ''):
+            capture.feed(stream, line)
+
+
+def execute_subprocess(name, run_id, timeout, titles, capture):
+    """为作业启动独立的 Python 进程，输出边产生边逐行交给 capture，返回 (是否成功, 错误信息)"""
+    # 子进程的标准输出接到管道时默认整块缓冲，关闭缓冲才能实时看到输出
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    if run_id:
+        env['BANGMI_RUN_ID'] = run_id
+    process = subprocess.Popen(
+        [sys.executable, JOB_SCRIPTS[name], *(titles or [])],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        env=env
+    )
+    readers = [threading.Thread(target=pump_lines, args=(pipe, stream, capture), daemon=True)
+               for pipe, stream in ((process.stdout, 'stdout'), (process.stderr, 'stderr'))]
+    for reader in readers:
+        reader.start()
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        return False, f"作业超时（{timeout} 秒）"
+    finally:
+        for reader in readers:
+            reader.join()
+    return returncode == 0, None if returncode == 0 else f"返回码: {returncode}"
+
+
+def request_stop():
+    """
+    让进程内正在执行的作业尽快停止，并取消还在排队的作业（调度器收到 SIGTERM 退出前调用）。
+    只有下载作业会检查停止标志；搜索作业只包含带超时的 HTTP 请求，会自己很快结束
+    """
+    download_bt.STOP.set()
+    WORKER.shutdown(wait=False, cancel_futures=True)
+
+
+def run_job(name, mode=None, run_id=None, timeout=None, titles=None, on_line=None):
+    """
+    执行作业并等待结束，返回 {'success', 'stdout', 'stderr', 'error', 'mode'}。
+    作业输出的每一行产生时立即交给 on_line(stream, line)；返回的 stdout / stderr 只包含最后 MAX_OUTPUT_LINES 行。
+    titles 只用于搜索作业：只搜索这些番剧（不按时间窗口筛选）。
+    进程内模式超时后作业仍会在工作线程中继续执行完，之后的作业排在它后面
+    """
+    if name not in JOB_SCRIPTS:
+        raise ValueError(f"未知作业: {name}")
+    if mode is None:
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                mode = get_job_mode(json.load(f))
+        except (OSError, ValueError):
+            mode = 'inprocess'
+
+    capture = OutputCapture(on_line)
+    if mode == 'subprocess':
+        success, error = execute_subprocess(name, run_id, timeout, titles, capture)
+    else:
+        future = WORKER.submit(execute_inprocess, name, run_id, titles, capture)
+        try:
+            success = future.result(timeout=timeout)
+            error = None if success else '作业执行失败'
+        except FutureTimeoutError:
+            success, error = False, f"作业超时（{timeout} 秒），仍在后台执行"
+    return {'success': success, 'stdout': capture.text('stdout'), 'stderr': capture.text('stderr'),
+            'error': error, 'mode': mode}
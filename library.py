@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+媒体库整理
+下载完成的文件从 anime/ 根目录整理到 anime/<番剧>/Season N/<番剧> - SxxEyy.ext（Jellyfin/Kodi 命名规则），
+只使用 rename 或 hardlink，不复制数据；每次只改动对应番剧的目录。
+整理结果记录在 data/library_manifest.json 中（按番剧增量更新）。
+"""
+
+import datetime
+import os
+import re
+import sys
+
+from release_parser import parse_episode_number
+from state_store import update_json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_FILE = os.path.join(PROJECT_ROOT, 'data/library_manifest.json')
+DEFAULT_ANIME_DIR = 'anime'
+ORGANIZE_MODES = ('move', 'hardlink', 'off')
+
+CHINESE_NUMERALS = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+# 番剧名末尾的季度标记：第二季 / 第2期 / Season 2 / S2 / 2nd Season
+SEASON_PATTERNS = [
+    re.compile(r'\s*第([一二三四五六七八九十\d]{1,3})[季期]\s*$'),
+    re.compile(r'\s*Season\s*(\d{1,2})\s*$', re.IGNORECASE),
+    re.compile(r'\s+S(\d{1,2})\s*$', re.IGNORECASE),
+    re.compile(r'\s*(\d{1,2})(?:st|nd|rd|th)\s+Season\s*$', re.IGNORECASE),
+]
+INVALID_PATH_CHARS = re.compile(r'[\\/:*?"<>|]')
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def chinese_to_int(value):
+    """二 → 2，十一 → 11，二十 → 20（季度只会用到两位数以内）"""
+    if '十' not in value:
+        return CHINESE_NUMERALS.get(value, 0)
+    tens, _, ones = value.partition('十')
+    return CHINESE_NUMERALS.get(tens, 1) * 10 + CHINESE_NUMERALS.get(ones, 0)
+
+
+def parse_season(anime_title):
+    """从番剧名中拆出季度，返回 (去掉季度标记的番剧名, 季度)，没有季度标记时为第 1 季"""
+    for pattern in SEASON_PATTERNS:
+        match = pattern.search(anime_title)
+        if not match:
+            continue
+        value = match.group(1)
+        season = int(value) if value.isdigit() else chinese_to_int(value)
+        show = anime_title[:match.start()].strip()
+        if show and season > 0:
+            return show, season
+    return anime_title.strip(), 1
+
+
+def safe_name(name):
+    """去掉文件系统不允许的字符"""
+    name = re.sub(r'\s+', ' ', INVALID_PATH_CHARS.sub(' ', name))
+    return name.strip().rstrip('.') or 'Unknown'
+
+
+def episode_key(season, episode):
+    """SxxEyy；非整数集（总集篇 12.5 等）保留小数"""
+    if float(episode).is_integer():
+        return f"S{season:02d}E{int(episode):02d}"
+    return f"S{season:02d}E{episode}"
+
+
+def library_path(library_dir, anime_title, episode, ext):
+    """返回 (番剧目录名, 季度, 目标路径)"""
+    show, season = parse_season(anime_title)
+    show_dir = safe_name(show)
+    file_name = f"{show_dir} - {episode_key(season, episode)}{ext.lower()}"
+    return show_dir, season, os.path.join(library_dir, show_dir, f"Season {season}", file_name)
+
+
+def place_file(source, target, mode):
+    """rename / hardlink 到目标位置（同名文件被新下载的版本替换），不复制数据"""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if mode == 'move':
+        os.replace(source, target)
+        return
+    tmp_target = target + '.link'
+    if os.path.lexists(tmp_target):
+        os.remove(tmp_target)
+    os.link(source, tmp_target)
+    os.replace(tmp_target, target)
+
+
+def remove_empty_parents(path, library_dir):
+    """移走文件后，删除 anime/ 下因此变空的种子目录"""
+    parent = os.path.dirname(path)
+    library_dir = os.path.abspath(library_dir)
+    while os.path.abspath(parent).startswith(library_dir + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
+
+
+def organize_files(files, task, library_dir, mode='move'):
+    """
+    整理一个任务下载的文件，返回整理后的路径列表（未整理的保持原路径）。
+    单文件任务使用任务的集数；多文件（合集）按文件名解析每个文件的集数。
+    目标所在的文件系统不同（EXDEV）或集数无法确定时，文件保持原样
+    """
+    if mode == 'off' or not files:
+        return list(files)
+    anime_title = task.get('anime_title')
+    if not anime_title or anime_title == 'Unknown':
+        return list(files)
+
+    organized = []
+    entries = {}
+    for source in files:
+        episode = task.get('episode') if len(files) == 1 else None
+        if episode is None:
+            episode = parse_episode_number(os.path.basename(source))
+        if episode is None:
+            print_info(f"无法确定集数，保持原位置: {os.path.basename(source)}")
+            organized.append(source)
+            continue
+
+        show_dir, season, target = library_path(library_dir, anime_title, float(episode),
+                                                os.path.splitext(source)[1])
+        try:
+            place_file(source, target, mode)
+        except OSError as e:
+            print_error(f"整理 {os.path.basename(source)} 失败，保持原位置: {e}")
+            organized.append(source)
+            continue
+        if mode == 'move':
+            remove_empty_parents(source, library_dir)
+        print_success(f"📚 已整理: {os.path.relpath(target, library_dir)}")
+        organized.append(target)
+        entries.setdefault(show_dir, {})[episode_key(season, float(episode))] = {
+            'path': os.path.relpath(target, library_dir),
+            'size': os.path.getsize(target),
+            'anime_title': anime_title,
+            'season': season,
+            'episode': float(episode),
+            'source_name': os.path.basename(source),
+            'magnet': task.get('magnet'),
+            'organized_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+
+    if entries:
+        update_manifest(entries)
+    return organized
+
+
+def update_manifest(entries):
+    """增量更新清单：只改动本次涉及的番剧"""
+    def apply(manifest):
+        shows = manifest.setdefault('shows', {})
+        for show_dir, episodes in entries.items():
+            shows.setdefault(show_dir, {}).update(episodes)
+        manifest['updated_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    update_json(MANIFEST_FILE, {}, apply)
+
+
+def forget_files(rel_paths):
+    """文件被删除后从清单中移除（rel_paths 为相对于 anime/ 的路径）"""
+    rel_paths = set(rel_paths)
+
+    def apply(manifest):
+        shows = manifest.setdefault('shows', {})
+        for show_dir in list(shows):
+            episodes = shows[show_dir]
+            for key in [key for key, entry in episodes.items() if entry.get('path') in rel_paths]:
+                del episodes[key]
+            if not episodes:
+                del shows[show_dir]
+        manifest['updated_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    update_json(MANIFEST_FILE, {}, apply)
+
+
+def get_anime_dir(config):
+    """
+    local_storage.anime_dir：下载目录兼媒体库（相对路径相对于项目根目录）。
+    下载、整理、保留策略和本地索引都用这个目录，不能各自解析
+    """
+    return os.path.join(PROJECT_ROOT, (config or {}).get('local_storage', {}).get('anime_dir', DEFAULT_ANIME_DIR))
+
+
+def get_organize_mode(config):
+    """local_storage.organize_mode: move（默认）/ hardlink（保留原文件供 BT 客户端做种）/ off"""
+    mode = (config or {}).get('local_storage', {}).get('organize_mode', 'move')
+    if mode not in ORGANIZE_MODES:
+        print_error(f"未知的 organize_mode: {mode}，使用 move")
+        return 'move'
+    return mode
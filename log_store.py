@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+调度日志的写入、轮转和读取
+RotatingLog 是调度器进程中唯一的日志写入端：文件超过 max_bytes 或写入满 rotate_days 天后，
+当前日志压缩为 scheduler.log.<时间>.gz，只保留最近 backup_count 个归档。
+每次作业（run_id）在日志中的起止偏移记录在 scheduler.log.index.json 中（跨越轮转时分成多段），
+Web 应用可以只读取某一次运行的日志；tail_lines 从文件末尾按块向前读取，读取量只与请求的行数有关。
+命令行: python log_store.py [行数]            查看日志最后若干行
+        python log_store.py <run_id> [行数]   查看某一次运行的日志
+"""
+
+import datetime
+import glob
+import gzip
+import os
+import shutil
+import sys
+import threading
+import time
+
+from state_store import atomic_write_json, read_json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE = os.path.join(PROJECT_ROOT, 'data/scheduler.log')
+DEFAULT_TAIL_LINES = 100
+TAIL_BLOCK_SIZE = 8192
+# 索引中最多保留的运行数（更早的运行即使归档还在也不再能按 run_id 查询）
+MAX_INDEXED_RUNS = 500
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def index_path_for(log_path):
+    return log_path + '.index.json'
+
+
+def get_log_settings(config):
+    """读取 scheduler 中的日志轮转配置（缺省时使用默认值）"""
+    settings = (config or {}).get('scheduler', {})
+    return {
+        # 日志超过这个大小时轮转
+        'max_bytes': settings.get('log_max_bytes', 10 * 1024 * 1024),
+        # 当前日志写入满这么多天后轮转（0 表示只按大小轮转）
+        'rotate_days': settings.get('log_rotate_days', 7),
+        # 保留的压缩归档数
+        'backup_count': settings.get('log_backup_count', 8),
+    }
+
+
+class RotatingLog:
+    """按大小 / 时间轮转并压缩的日志文件（线程安全，同一个日志文件只能有一个写入端）"""
+
+    def __init__(self, path=LOG_FILE, max_bytes=10 * 1024 * 1024, rotate_days=7, backup_count=8):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.index_path = index_path_for(path)
+        self.max_bytes = max_bytes
+        self.rotate_days = rotate_days
+        self.backup_count = backup_count
+        self.lock = threading.RLock()
+        self.handle = None
+        self.size = 0
+        self.open_runs = set()
+        # index: {'started': 当前日志开始写入的时间戳, 'runs': {run_id: [{'file', 'start', 'end'}]}}
+        self.index = read_json(self.index_path, {})
+        self.index.setdefault('runs', {})
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.handle = open(self.path, 'ab')
+        self.size = self.handle.tell()
+        if not self.size or 'started' not in self.index:
+            self.index['started'] = time.time()
+
+    def _should_rotate(self, incoming):
+        if not self.size:
+            return False
+        if self.max_bytes and self.size + incoming > self.max_bytes:
+            return True
+        return bool(self.rotate_days) and time.time() >= self.index['started'] + self.rotate_days * 86400
+
+    def write(self, line):
+        """写入一行（立即写到文件，其他进程读取时可以马上看到）"""
+        data = (line + '\n').encode('utf-8')
+        with self.lock:
+            if self.handle is None:
+                self._open()
+            if self._should_rotate(len(data)):
+                self.rotate()
+            self.handle.write(data)
+            self.handle.flush()
+            self.size += len(data)
+
+    def rotate(self):
+        """压缩当前日志并开始新文件；进行中的运行在新文件中接着记一段"""
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+            stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+            archive = f"{self.path}.{stamp}.gz"
+            suffix = 1
+            while os.path.exists(archive):
+                archive = f"{self.path}.{stamp}_{suffix}.gz"
+                suffix += 1
+            with open(self.path, 'rb') as src, gzip.open(archive, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+
+            archive_name = os.path.basename(archive)
+            for segments in self.index['runs'].values():
+                for segment in segments:
+                    if segment['file'] == self.name:
+                        segment['file'] = archive_name
+                        if segment['end'] is None:
+                            segment['end'] = self.size
+            for run_id in self.open_runs:
+                self.index['runs'][run_id].append({'file': self.name, 'start': 0, 'end': None})
+            self._prune_archives()
+            self._open()
+            self.index['started'] = time.time()
+            self._save_index()
+
+    def _prune_archives(self):
+        archives = sorted(glob.glob(glob.escape(self.path) + '.*.gz'), key=os.path.getmtime)
+        for old in archives[:max(0, len(archives) - self.backup_count)]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        existing = {self.name} | {os.path.basename(p) for p in glob.glob(glob.escape(self.path) + '.*.gz')}
+        runs = {}
+        for run_id, segments in self.index['runs'].items():
+            segments = [s for s in segments if s['file'] in existing]
+            if segments or run_id in self.open_runs:
+                runs[run_id] = segments
+        self.index['runs'] = runs
+
+    def _save_index(self):
+        runs = self.index['runs']
+        if len(runs) > MAX_INDEXED_RUNS:
+            for run_id in list(runs)[:len(runs) - MAX_INDEXED_RUNS]:
+                if run_id not in self.open_runs:
+                    del runs[run_id]
+        atomic_write_json(self.index_path, self.index)
+
+    def begin_run(self, run_id):
+        """记录一次运行在日志中的开始位置"""
+        with self.lock:
+            if self.handle is None:
+                self._open()
+            self.index['runs'][run_id] = [{'file': self.name, 'start': self.size, 'end': None}]
+            self.open_runs.add(run_id)
+            self._save_index()
+
+    def end_run(self, run_id):
+        with self.lock:
+            segments = self.index['runs'].get(run_id)
+            if segments:
+                segments[-1]['end'] = self.size
+            self.open_runs.discard(run_id)
+            self._save_index()
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+
+def open_log(config=None, path=LOG_FILE):
+    settings = get_log_settings(config)
+    return RotatingLog(path, settings['max_bytes'], settings['rotate_days'], settings['backup_count'])
+
+
+def tail_lines(path, lines=DEFAULT_TAIL_LINES, start=0, end=None, block_size=TAIL_BLOCK_SIZE):
+    """文件 [start, end) 范围内的最后 lines 行：从末尾按块向前读，读够行数就停"""
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END) if end is None else end
+        position, blocks, newlines = end, [], 0
+        # 多读一个换行符，保证最前面的一行是完整的
+        while position > start and newlines <= lines:
+            size = min(block_size, position - start)
+            position -= size
+            f.seek(position)
+            block = f.read(size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+    text = b''.join(reversed(blocks)).decode('utf-8', errors='replace')
+    return ''.join(text.splitlines(keepends=True)[-lines:]) if lines else ''
+
+
+def read_segment(log_dir, segment):
+    """读取一段日志（归档需要先解压，不能直接定位）"""
+    path = os.path.join(log_dir, segment['file'])
+    opener = gzip.open if segment['file'].endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        f.seek(segment['start'])
+        data = f.read() if segment['end'] is None else f.read(segment['end'] - segment['start'])
+    return data.decode('utf-8', errors='replace')
+
+
+def read_run(run_id, lines=None, path=LOG_FILE):
+    """某一次运行的日志（指定 lines 时只返回最后 lines 行），索引中没有该运行时返回 None"""
+    segments = read_json(index_path_for(path), {}).get('runs', {}).get(run_id)
+    if segments is None:
+        return None
+    log_dir = os.path.dirname(path)
+    chunks, count = [], 0
+    for segment in reversed(segments):
+        try:
+            if lines and not segment['file'].endswith('.gz'):
+                text = tail_lines(os.path.join(log_dir, segment['file']), lines, segment['start'], segment['end'])
+            else:
+                text = read_segment(log_dir, segment)
+        except OSError:
+            continue
+        chunks.insert(0, text)
+        count += text.count('\n')
+        if lines and count >= lines:
+            break
+    text = ''.join(chunks)
+    return ''.join(text.splitlines(keepends=True)[-lines:]) if lines else text
+
+
+def main():
+    args = sys.argv[1:]
+    if args and not args[0].isdigit():
+        content = read_run(args[0], int(args[1]) if len(args) > 1 else None)
+        if content is None:
+            print_error(f"日志索引中没有运行 {args[0]}")
+            return
+    elif os.path.exists(LOG_FILE):
+        content = tail_lines(LOG_FILE, int(args[0]) if args else DEFAULT_TAIL_LINES)
+    else:
+        print_error(f"日志文件 {LOG_FILE} 不存在")
+        return
+    sys.stdout.write(content)
+
+
+if __name__ == "__main__":
+    main()
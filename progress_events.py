@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+下载进度事件流
+download_bt.py 把每个任务的阶段变化和传输进度写成 JSON Lines 事件（data/progress_events.jsonl），
+调度器和 Web 应用按文件偏移增量读取，不再从标准输出里匹配进度文本。
+每次运行开始时换成新的事件文件；进度事件按任务节流（每个任务每 interval 秒最多一条），
+阶段变化总是写入，因此事件数量只与任务数和运行时长有关，与文件大小无关。
+
+事件格式:
+  {"type": "run",      "run_id", "ts", "status": "started" | "finished"}
+  {"type": "stage",    "run_id", "ts", "task_id", "title", "stage", "reason"}
+  {"type": "progress", "run_id", "ts", "task_id", "title", "stage", "file", "bytes", "total", "rate", "eta"}
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+
+from bt_backends import magnet_info_hash
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+EVENTS_FILE = os.path.join(PROJECT_ROOT, 'data/progress_events.jsonl')
+EVENT_INTERVAL = 1.0  # 同一任务两条进度事件的最短间隔（秒）
+
+
+def task_id(task):
+    """任务的稳定 id：磁力链接的 info hash（无法解析时用磁力链接本身）"""
+    magnet = task.get('magnet') or ''
+    return magnet_info_hash(magnet) or magnet
+
+
+class ProgressEmitter:
+    """事件写入端（线程安全，供下载流水线和各传输线程共用）"""
+
+    def __init__(self, path=EVENTS_FILE, interval=EVENT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.run_id = None
+        self.last_emit = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start_run(self, run_id=None):
+        """
+        开始新的一次运行：用只含 started 事件的新文件替换上次的事件文件
+        （rename 换成新的 inode，订阅端据此发现新的运行，不会把新文件接在旧偏移后面读）
+        """
+        self.run_id = run_id or datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            self.last_emit = {}
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(self._stamp({'type': 'run', 'status': 'started'}), ensure_ascii=False) + '\n')
+            os.replace(tmp_path, self.path)
+
+    def finish_run(self):
+        if self.run_id:
+            self._write({'type': 'run', 'status': 'finished'})
+
+    @property
+    def current_task(self):
+        """当前线程正在传输的任务（由 bind_task 设置），传输进度据此归属到任务"""
+        return getattr(self.local, 'task', None)
+
+    def bind_task(self, task):
+        self.local.task = task
+
+    def stage(self, task, stage, reason=None):
+        self._write({'type': 'stage', 'task_id': task_id(task), 'title': task.get('title'),
+                     'stage': stage, 'reason': reason})
+
+    def progress(self, task, stage, done, total, rate=None, file_name=None, force=False):
+        """进度事件（节流）；force=True 时不节流，用于开始和结束"""
+        key = task_id(task)
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_emit.get(key, 0.0) < self.interval:
+                return
+            self.last_emit[key] = now
+        eta = (total - done) / rate if rate and total and total > done else None
+        self._write({'type': 'progress', 'task_id': key, 'title': task.get('title'), 'stage': stage,
+                     'file': file_name, 'bytes': done, 'total': total,
+                     'rate': round(rate) if rate is not None else None,
+                     'eta': round(eta) if eta is not None else None})
+
+    def _stamp(self, event):
+        return {**event, 'run_id': self.run_id, 'ts': datetime.datetime.now().isoformat(timespec='seconds')}
+
+    def _write(self, event):
+        if not self.run_id:
+            return
+        line = json.dumps(self._stamp(event), ensure_ascii=False) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+
+def current_run_id(path=EVENTS_FILE):
+    """事件文件所属的运行（第一行是 run started 事件）"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.loads(f.readline()).get('run_id')
+    except (OSError, ValueError):
+        return None
+
+
+def read_events(offset=0, path=EVENTS_FILE):
+    """
+    从 offset 开始读取新事件，返回 (事件列表, 新的 offset)。
+    文件比 offset 短说明已开始新的运行，从头读取；末尾不完整的行留到下次
+    """
+    if not os.path.exists(path):
+        return [], 0
+    if os.path.getsize(path) < offset:
+        offset = 0
+    events = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events, offset
+
+
+def snapshot(events):
+    """把事件归并为每个任务的最新状态: {'run_id', 'status', 'tasks': {task_id: {...}}}"""
+    state = {'run_id': None, 'status': None, 'tasks': {}}
+    for event in events:
+        if event['type'] == 'run':
+            if event['run_id'] != state['run_id']:
+                state = {'run_id': event['run_id'], 'status': None, 'tasks': {}}
+            state['status'] = event['status']
+            continue
+        task = state['tasks'].setdefault(event['task_id'], {'task_id': event['task_id']})
+        task.update({key: value for key, value in event.items() if key not in ('type', 'run_id') and value is not None})
+        if event['type'] == 'stage' and event['stage'] != 'transferring':
+            # 进入其他阶段后旧的传输速率不再有意义
+            for key in ('rate', 'eta'):
+                task.pop(key, None)
+    return state
+
+
+def follow(callback, stop_event, path=EVENTS_FILE, poll_interval=1.0, run_id=None):
+    """
+    订阅事件：在 stop_event 被设置前持续读取新事件并调用 callback(event)，返回前读完剩余事件。
+    指定 run_id 时只回调该次运行的事件（订阅可以早于运行开始）；否则跳过订阅前已有的事件
+    """
+    offset, inode = 0, None
+    if run_id is None and os.path.exists(path):
+        stat = os.stat(path)
+        offset, inode = stat.st_size, stat.st_ino
+    while True:
+        stopping = stop_event.wait(poll_interval)
+        try:
+            current_inode = os.stat(path).st_ino
+        except OSError:
+            current_inode = None
+        if current_inode != inode:
+            # 新的运行替换了事件文件，从头读取
+            offset, inode = 0, current_inode
+        events, offset = read_events(offset, path)
+        for event in events:
+            if run_id is None or event.get('run_id') == run_id:
+                callback(event)
+        if stopping:
+            return
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+发布标题 / 文件名解析
+搜索脚本、下载脚本和媒体库共用
+"""
+
+import re
+
+# 整理后的媒体库文件名：<番剧> - S01E05.mkv
+LIBRARY_EPISODE_PATTERN = re.compile(r'S(\d{1,2})E(\d{1,3}(?:\.\d{1,2})?)', re.IGNORECASE)
+
+
+def parse_episode_number(title):
+    """
+    从标题中解析集数
+    优先级：
+    1. [数字] 或 【数字】 格式（方括号内的集数）
+    2. 第X话/話/集 格式
+    3. 其他数字格式
+    """
+    # 优先匹配方括号内的集数（包括v2等版本号）
+    # 匹配 [41] [41v2] 【41】等格式
+    bracket_match = re.search(
+        r'[\[【](\d{1,3}(?:\.\d{1,2})?)(?:v\d+)?[\]】]',
+        title
+    )
+    if bracket_match:
+        try:
+            num = float(bracket_match.group(1))
+            if 0 <= num < 1000:
+                return num
+        except ValueError:
+            pass
+    
+    # 其次匹配"第X话/話/集"格式
+    chinese_match = re.search(r'第(\d{1,3})[话話集]', title)
+    if chinese_match:
+        try:
+            num = float(chinese_match.group(1))
+            if 0 <= num < 1000:
+                return num
+        except ValueError:
+            pass
+    
+    # 最后匹配其他格式
+    other_match = re.search(
+        r'[\s\.\-_](\d{1,3})(?:v\d)?[\s\.\-_\]]|'
+        r'(\d{1,3})\s*END',
+        title,
+        re.IGNORECASE
+    )
+    if other_match:
+        for group in other_match.groups():
+            if group is not None:
+                try:
+                    num = float(group)
+                    if 0 <= num < 1000:
+                        return num
+                except ValueError:
+                    continue
+    
+    return None
+
+
+def parse_file_episode(file_name):
+    """从文件名解析 (季度, 集数)：优先识别媒体库的 SxxEyy 命名，季度未知时为 None"""
+    match = LIBRARY_EPISODE_PATTERN.search(file_name)
+    if match:
+        return int(match.group(1)), float(match.group(2))
+    return None, parse_episode_number(file_name)
+
+
+# --- 发布版本（字幕组 / 分辨率 / 语言 / 修正版 / 片源） ---
+
+RESOLUTION_PATTERNS = [
+    ('2160p', re.compile(r'2160[pP]|4K|3840\s*[xX×]\s*2160')),
+    ('1080p', re.compile(r'1080[pP]|1920\s*[xX×]\s*1080')),
+    ('720p', re.compile(r'720[pP]|1280\s*[xX×]\s*720')),
+]
+LANGUAGE_PATTERNS = [
+    ('简繁', re.compile(r'简繁|簡繁|CHS\s*[&_]\s*CHT|GB\s*[&_]\s*BIG5', re.IGNORECASE)),
+    ('简体', re.compile(r'简体|簡體|简中|簡中|简日|簡日|\bCHS\b|\bGB\b|\bSC\b', re.IGNORECASE)),
+    ('繁体', re.compile(r'繁体|繁體|繁中|繁日|\bCHT\b|\bBIG5\b|\bTC\b', re.IGNORECASE)),
+]
+# 片源从好到差；修正版 / 更好片源的再次发布可以替换已下载的版本
+SOURCE_PATTERNS = [
+    ('BD', re.compile(r'\bBD(?:Rip)?\b|Blu-?ray', re.IGNORECASE)),
+    # WEB-DL 与各平台的 WebRip 画质相近，视为同一档
+    ('WEB', re.compile(r'WEB-?DL|Web-?Rip|\bWEB\b|Baha|\bCR\b|ABEMA|B-Global|Bilibili', re.IGNORECASE)),
+    ('TV', re.compile(r'TV-?Rip|\bHDTV\b', re.IGNORECASE)),
+]
+SOURCE_RANK = {name: len(SOURCE_PATTERNS) - i for i, (name, _) in enumerate(SOURCE_PATTERNS)}
+VERSION_PATTERN = re.compile(r'(?<=\d)v(\d)\b|\[v(\d)\]', re.IGNORECASE)
+GROUP_PATTERN = re.compile(r'^\s*[\[【]([^\]】]+)[\]】]')
+
+
+def first_match(patterns, title):
+    for name, pattern in patterns:
+        if pattern.search(title):
+            return name
+    return None
+
+
+def parse_release(title):
+    """解析发布标题中的版本信息，无法识别的字段为 None（修正版默认 v1）"""
+    title = title or ''
+    group_match = GROUP_PATTERN.match(title)
+    version_match = VERSION_PATTERN.search(title)
+    return {
+        'group': group_match.group(1).strip() if group_match else None,
+        'resolution': first_match(RESOLUTION_PATTERNS, title),
+        'language': first_match(LANGUAGE_PATTERNS, title),
+        'version': int(next(g for g in version_match.groups() if g)) if version_match else 1,
+        'source': first_match(SOURCE_PATTERNS, title),
+    }
+
+
+def release_variant(release):
+    """同一集的不同版本按 字幕组|分辨率|语言 区分（修正版和片源升级替换同一个版本）"""
+    return '|'.join(release.get(key) or '-' for key in ('group', 'resolution', 'language'))
+
+
+def preference_key(release, preferences):
+    """按配置的偏好排序（值越小越优先）：字幕组 → 分辨率 → 语言，其次修正版本和片源越高越好"""
+    def rank(value, ordered):
+        ordered = ordered or []
+        return ordered.index(value) if value in ordered else len(ordered)
+    return (rank(release.get('group'), preferences.get('groups')),
+            rank(release.get('resolution'), preferences.get('resolutions')),
+            rank(release.get('language'), preferences.get('languages')),
+            -release.get('version', 1),
+            -SOURCE_RANK.get(release.get('source'), 0))
+
+
+def is_upgrade(release, existing, preferences):
+    """
+    该集已经下载过 existing 中的版本时，release 是否值得再下载一次：
+    同一字幕组的修正版（v2 等），或片源更好（upgrade_on_source）
+    """
+    for old in existing:
+        if (preferences.get('upgrade_on_version', True) and release.get('group') == old.get('group')
+                and release.get('version', 1) > old.get('version', 1)):
+            continue
+        if (preferences.get('upgrade_on_source', True)
+                and SOURCE_RANK.get(release.get('source'), 0) > SOURCE_RANK.get(old.get('source'), 0) > 0):
+            continue
+        return False
+    return bool(existing)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+媒体库保留策略
+统计 anime/ 下每个视频文件的大小、最后访问时间、所属番剧和观看状态（Bangumi 章节收藏），
+按磁盘预算淘汰：先删已看过的，再按最久未访问（LRU）删未看的；最近下载的文件受保护。
+download_bt.py 在开始传输前调用 ensure_space 做准入控制，空间不够的任务留在队列中下次处理。
+命令行: python retention.py          查看当前占用和淘汰计划
+        python retention.py apply    按计划淘汰
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+
+from bangumi_api import BangumiAPI, load_bangumi_token_from_config
+from bt_backends import is_video_file
+from library import MANIFEST_FILE, forget_files, get_anime_dir, remove_empty_parents
+from state_store import read_json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
+DEFAULT_SEASONAL_FILE = 'data/seasonal_anime_list.json'
+GB = 1024 ** 3
+# Bangumi 章节收藏类型：2 = 看过
+EPISODE_WATCHED = 2
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+def get_retention_settings(config):
+    """读取 local_storage.retention 配置（缺省时使用默认值）"""
+    local_storage = (config or {}).get('local_storage', {})
+    settings = local_storage.get('retention', {})
+    enabled = settings.get('enabled', False)
+    username = settings.get('bangumi_username')
+    evict_unwatched = settings.get('evict_unwatched', False)
+    if enabled and evict_unwatched and not username:
+        # 没有观看状态时所有文件都是"未看"，会按 LRU 删掉还没看的剧集
+        print_error("retention.evict_unwatched 需要配置 bangumi_username，已改为只淘汰已看过的文件")
+        evict_unwatched = False
+    return {
+        'enabled': enabled,
+        'anime_dir': get_anime_dir(config),
+        # 媒体库总大小上限（0 表示不限制，只看剩余空间）
+        'max_library_bytes': settings.get('max_library_bytes', 0),
+        # 下载完成后磁盘至少保留的剩余空间
+        'min_free_bytes': settings.get('min_free_bytes', 10 * GB),
+        # 最近下载的文件不淘汰
+        'min_age_days': settings.get('min_age_days', 7),
+        # 为 True 时已看过的文件不够腾出空间后，再按 LRU 淘汰未看的（需要 bangumi_username）
+        'evict_unwatched': evict_unwatched,
+        # 用于查询观看状态的 Bangumi 用户名（为空时所有文件都视为未看）
+        'bangumi_username': username,
+        'seasonal_file': os.path.join(PROJECT_ROOT, (config or {}).get('seasonal_fetcher', {}).get(
+            'output_file', DEFAULT_SEASONAL_FILE)),
+    }
+
+
+def scan_library(anime_dir):
+    """列出媒体库中的视频文件：按清单补充番剧和集数，清单之外的文件（旧的平铺下载）只有大小和时间"""
+    manifest = read_json(MANIFEST_FILE, {})
+    entries_by_path = {}
+    for show_dir, episodes in manifest.get('shows', {}).items():
+        for key, entry in episodes.items():
+            entries_by_path[entry['path']] = entry
+
+    files = []
+    for root, _, names in os.walk(anime_dir):
+        for name in names:
+            if not is_video_file(name):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            rel_path = os.path.relpath(path, anime_dir)
+            entry = entries_by_path.get(rel_path, {})
+            files.append({
+                'path': path,
+                'rel_path': rel_path,
+                'size': stat.st_size,
+                # 文件系统挂载了 noatime 时 atime 不更新，取两者中较新的一个
+                'last_used': max(stat.st_atime, stat.st_mtime),
+                'modified': stat.st_mtime,
+                # 大于 1 表示还有其他硬链接（如 hardlink 整理模式下的下载目录），删除后不释放空间
+                'links': stat.st_nlink,
+                'anime_title': entry.get('anime_title'),
+                'episode': entry.get('episode'),
+                'watched': False,
+            })
+    return files
+
+
+def load_subject_ids(seasonal_file):
+    """番剧名（含别名）→ Bangumi 条目 id，来自新番列表"""
+    subject_ids = {}
+    for anime in read_json(seasonal_file, []):
+        if not anime.get('bangumi_id'):
+            continue
+        for name in [anime.get('primary_title')] + anime.get('all_cn_names', []):
+            if name:
+                subject_ids.setdefault(name, anime['bangumi_id'])
+    return subject_ids
+
+
+def watched_episodes(client, username, subject_id):
+    """某个条目中已看过的集数（同时记录本季集数 ep 和总集数 sort）"""
+    watched = set()
+    for item in client.get_user_episode_collection(username, subject_id).get('data', []):
+        if item.get('type') != EPISODE_WATCHED:
+            continue
+        episode = item.get('episode', {})
+        for number in (episode.get('ep'), episode.get('sort')):
+            if number is not None:
+                watched.add(float(number))
+    return watched
+
+
+def mark_watched(files, settings):
+    """按 Bangumi 章节收藏标记已看过的文件（每部番剧只请求一次）"""
+    username = settings['bangumi_username']
+    titles = {f['anime_title'] for f in files if f['anime_title'] and f['episode'] is not None}
+    if not username or not titles:
+        return
+    subject_ids = load_subject_ids(settings['seasonal_file'])
+    client = BangumiAPI(load_bangumi_token_from_config())
+    watched_by_title = {}
+    for title in titles:
+        if title in subject_ids:
+            watched_by_title[title] = watched_episodes(client, username, subject_ids[title])
+    for f in files:
+        f['watched'] = f['episode'] is not None and float(f['episode']) in watched_by_title.get(f['anime_title'], ())
+
+
+def bytes_to_free(files, settings, incoming_bytes):
+    """为了再放下 incoming_bytes 需要腾出的空间"""
+    anime_dir = settings['anime_dir']
+    os.makedirs(anime_dir, exist_ok=True)
+    free = shutil.disk_usage(anime_dir).free
+    need = incoming_bytes + settings['min_free_bytes'] - free
+    if settings['max_library_bytes']:
+        library_size = sum(f['size'] for f in files)
+        need = max(need, library_size + incoming_bytes - settings['max_library_bytes'])
+    return max(0, need)
+
+
+def plan_eviction(files, need, settings, now=None):
+    """
+    选出要删除的文件：已看过的优先，其次最久未访问的；
+    min_age_days 内修改过的文件不动，evict_unwatched 为 False 时不删未看的，有其他硬链接的文件不动（删了也不释放空间）。
+    返回 (要删除的文件列表, 能腾出的空间)
+    """
+    if need <= 0:
+        return [], 0
+    now = now or time.time()
+    protected_after = now - settings['min_age_days'] * 86400
+    candidates = [f for f in files
+                  if f['modified'] < protected_after and f['links'] == 1
+                  and (f['watched'] or settings['evict_unwatched'])]
+    candidates.sort(key=lambda f: (not f['watched'], f['last_used']))
+
+    victims, freed = [], 0
+    for f in candidates:
+        if freed >= need:
+            break
+        victims.append(f)
+        freed += f['size']
+    return victims, freed
+
+
+def evict(files, anime_dir):
+    """删除文件、清理空目录并从清单中移除，返回实际释放的空间"""
+    freed = 0
+    removed = []
+    for f in files:
+        try:
+            os.remove(f['path'])
+        except OSError as e:
+            print_error(f"删除 {f['rel_path']} 失败: {e}")
+            continue
+        freed += f['size']
+        removed.append(f['rel_path'])
+        state = '已看' if f['watched'] else '未看'
+        print_info(f"🗑️  淘汰 ({state}, {f['size'] / 1024 / 1024:.0f} MB): {f['rel_path']}")
+        remove_empty_parents(f['path'], anime_dir)
+    if removed:
+        forget_files(removed)
+    return freed
+
+
+def ensure_space(config, incoming_bytes):
+    """
+    下载前的准入控制：按保留策略淘汰旧文件，为 incoming_bytes 腾出空间。
+    返回淘汰后可用于本次下载的字节数（None 表示保留策略已关闭，不限制）
+    """
+    settings = get_retention_settings(config)
+    if not settings['enabled']:
+        return None
+    files = scan_library(settings['anime_dir'])
+    need = bytes_to_free(files, settings, incoming_bytes)
+    if need > 0:
+        mark_watched(files, settings)
+        victims, _ = plan_eviction(files, need, settings)
+        if victims:
+            freed = evict(victims, settings['anime_dir'])
+            print_success(f"💽 已淘汰 {len(victims)} 个文件，释放 {freed / GB:.2f} GB")
+            files = scan_library(settings['anime_dir'])
+        need = bytes_to_free(files, settings, incoming_bytes)
+    return max(0, incoming_bytes - need)
+
+
+def main():
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'plan'
+    if command not in ('plan', 'apply'):
+        print_error(f"未知命令: {command}（可用: plan, apply）")
+        return
+
+    settings = get_retention_settings(config)
+    files = scan_library(settings['anime_dir'])
+    need = bytes_to_free(files, settings, 0)
+    print_info(f"📚 媒体库: {len(files)} 个文件，共 {sum(f['size'] for f in files) / GB:.2f} GB，"
+               f"剩余空间 {shutil.disk_usage(settings['anime_dir']).free / GB:.2f} GB")
+    if need <= 0:
+        print_success("空间充足，不需要淘汰")
+        return
+    mark_watched(files, settings)
+    victims, freed = plan_eviction(files, need, settings)
+    print_info(f"需要释放 {need / GB:.2f} GB，计划淘汰 {len(victims)} 个文件（{freed / GB:.2f} GB）")
+    if command == 'plan':
+        for f in victims:
+            print_info(f"  - {'已看' if f['watched'] else '未看'}: {f['rel_path']}")
+    else:
+        evict(victims, settings['anime_dir'])
+    if freed < need:
+        print_error("可淘汰的文件不足，无法满足空间要求")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,13 @@ import sys
 import json
 import os
 import datetime
-import re
 import urllib.parse
 
+from disk_index import open_disk_index
+from history_store import open_history
+from release_parser import is_upgrade, parse_episode_number, parse_release, preference_key, release_variant
+from state_store import atomic_write_json, update_json
+
 # --- 路径定义 ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(PROJECT_ROOT, 'data/config.json')
@@ -77,14 +81,19 @@ def save_json_file(filename, data):
     """保存JSON文件"""
     absolute_path = os.path.join(PROJECT_ROOT, filename)
     try:
-        os.makedirs(os.path.dirname(absolute_path), exist_ok=True)
-        with open(absolute_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        atomic_write_json(absolute_path, data)
         return True
     except Exception as e:
         print_error(f"保存 {absolute_path} 失败: {e}")
         return False
 
+def resource_size_bytes(resource):
+    """animes.garden 返回的 size 以 KB 为单位，转为字节；没有时返回 None"""
+    try:
+        return int(float(resource.get('size')) * 1024)
+    except (TypeError, ValueError):
+        return None
+
 def analyze_magnet_trackers(magnet_url):
     """分析磁力链接中的tracker信息 (来自您的代码)"""
     if not magnet_url:
@@ -149,39 +158,17 @@ def get_anime_to_scan(config, watchlist, seasonal_list):
 
     # 构建番剧时间表（作为备用数据源）
     anime_to_scan = {}
-    schedule_backup = {}
-    
-    for item in seasonal_list:
-        schedule_backup[item['primary_title']] = item
-        for name in item.get('all_cn_names', []):
-            if name != item['primary_title']:
-                schedule_backup[name] = item
+    schedule_backup = build_schedule_backup(seasonal_list)
 
     print_info(f"开始检查 {len(watchlist)} 部关注的番剧")
 
     for title, anime_config in watchlist.items():
-        # 优先从 watchlist 中读取放送时间
-        air_weekday_cn = anime_config.get('weekday')
-        air_time_str = anime_config.get('begin_time')
-        
-        # 如果 watchlist 中没有，尝试从 seasonal_list 中获取
-        if not air_weekday_cn or not air_time_str or air_time_str == '00:00':
-            anime_info = schedule_backup.get(title)
-            if anime_info:
-                air_weekday_cn = anime_info.get('weekday')
-                air_time_str = anime_info.get('begin_time')
-            else:
-                print_info(f"跳过：番剧 '{title}' 未找到放送时间信息")
-                continue
-        
-        if not air_weekday_cn or not air_time_str:
-            print_info(f"跳过：番剧 '{title}' 缺少播出时间信息")
-            continue
-
         try:
-            air_weekday_index = chinese_weekdays.index(air_weekday_cn)
-            air_hour, air_minute = map(int, air_time_str.split(':'))
-            air_time = datetime.time(hour=air_hour, minute=air_minute, tzinfo=jst_tz)
+            air_info = resolve_air_time(title, anime_config, schedule_backup, chinese_weekdays)
+            if not air_info:
+                continue
+            target_weekday, air_time_of_day, air_weekday_cn, air_time_str = air_info
+            air_time = air_time_of_day.replace(tzinfo=jst_tz)
             is_in_window = False
 
             # 检查播出时间是否在扫描窗口内
@@ -193,18 +180,7 @@ def get_anime_to_scan(config, watchlist, seasonal_list):
             
             for check_date in check_dates:
                 check_dt = datetime.datetime.combine(check_date, air_time)
-                
-                # 关键修改：如果播出时间是00:00，说明是前一天的24:00（即第二天凌晨）
-                # 例如："周六 00:00" 实际是 "周六 24:00" = "周日凌晨"
-                # 所以需要将番剧的 weekday 往后推一天来匹配实际播出日
-                actual_weekday = check_dt.weekday()
-                if air_hour == 0 and air_minute == 0:
-                    # 00:00 实际是前一天深夜，所以番剧标记的周六实际在周日播出
-                    target_weekday = (air_weekday_index + 1) % 7
-                else:
-                    target_weekday = air_weekday_index
-                
-                if actual_weekday == target_weekday and scan_start_time <= check_dt < scan_end_time:
+                if check_dt.weekday() == target_weekday and scan_start_time <= check_dt < scan_end_time:
                     is_in_window = True
                     break
 
@@ -220,59 +196,58 @@ def get_anime_to_scan(config, watchlist, seasonal_list):
     return anime_to_scan
 
 
-def parse_episode_number(title):
+def build_schedule_backup(seasonal_list):
+    """放送表按番剧名（含别名）索引，作为追番列表缺少放送时间时的备用数据源"""
+    schedule_backup = {}
+    for item in seasonal_list:
+        schedule_backup[item['primary_title']] = item
+        for name in item.get('all_cn_names', []):
+            if name != item['primary_title']:
+                schedule_backup[name] = item
+    return schedule_backup
+
+
+def resolve_air_time(title, anime_config, schedule_backup, chinese_weekdays):
     """
-    从标题中解析集数
-    优先级：
-    1. [数字] 或 【数字】 格式（方括号内的集数）
-    2. 第X话/話/集 格式
-    3. 其他数字格式
+    番剧的放送时间（JST），返回 (实际播出的星期 0-6, datetime.time, 星期名, 时间字符串)，缺少信息时返回 None。
+    优先读取追番列表中的 weekday / begin_time，没有时从放送表中获取
     """
-    # 优先匹配方括号内的集数（包括v2等版本号）
-    # 匹配 [41] [41v2] 【41】等格式
-    bracket_match = re.search(
-        r'[\[【](\d{1,3}(?:\.\d{1,2})?)(?:v\d+)?[\]】]',
-        title
-    )
-    if bracket_match:
-        try:
-            num = float(bracket_match.group(1))
-            if 0 <= num < 1000:
-                return num
-        except ValueError:
-            pass
-    
-    # 其次匹配"第X话/話/集"格式
-    chinese_match = re.search(r'第(\d{1,3})[话話集]', title)
-    if chinese_match:
-        try:
-            num = float(chinese_match.group(1))
-            if 0 <= num < 1000:
-                return num
-        except ValueError:
-            pass
-    
-    # 最后匹配其他格式
-    other_match = re.search(
-        r'[\s\.\-_](\d{1,3})[\s\.\-_\]]|'
-        r'(\d{1,3})\s*END',
-        title,
-        re.IGNORECASE
-    )
-    if other_match:
-        for group in other_match.groups():
-            if group is not None:
-                try:
-                    num = float(group)
-                    if 0 <= num < 1000:
-                        return num
-                except ValueError:
-                    continue
-    
-    return None
+    air_weekday_cn = anime_config.get('weekday')
+    air_time_str = anime_config.get('begin_time')
+
+    # 如果 watchlist 中没有，尝试从 seasonal_list 中获取
+    if not air_weekday_cn or not air_time_str or air_time_str == '00:00':
+        anime_info = schedule_backup.get(title)
+        if anime_info:
+            air_weekday_cn = anime_info.get('weekday')
+            air_time_str = anime_info.get('begin_time')
+        else:
+            print_info(f"跳过：番剧 '{title}' 未找到放送时间信息")
+            return None
+
+    if not air_weekday_cn or not air_time_str:
+        print_info(f"跳过：番剧 '{title}' 缺少播出时间信息")
+        return None
+
+    air_weekday_index = chinese_weekdays.index(air_weekday_cn)
+    air_hour, air_minute = map(int, air_time_str.split(':'))
 
-def search_and_select_episode(search_title, config, api_url, history_data):
-    """搜索并选择最新集数"""
+    # 关键修改：如果播出时间是00:00，说明是前一天的24:00（即第二天凌晨）
+    # 例如："周六 00:00" 实际是 "周六 24:00" = "周日凌晨"
+    # 所以需要将番剧的 weekday 往后推一天来匹配实际播出日
+    if air_hour == 0 and air_minute == 0:
+        target_weekday = (air_weekday_index + 1) % 7
+    else:
+        target_weekday = air_weekday_index
+    return target_weekday, datetime.time(hour=air_hour, minute=air_minute), air_weekday_cn, air_time_str
+
+
+def search_and_select_episode(search_title, config, api_url, history, disk_index=None, preferences=None, http=None):
+    """
+    搜索并选择最新集数，返回 (资源, 集数, 版本信息) 或 None。
+    disk_index 中已有的集数不再下载；同一集按 preferences（release_preferences 配置）选择字幕组等版本
+    """
+    preferences = preferences or {}
     search_keys = config.get('search_keys', [])
     print(f"\n{'='*50}")
     print_info(f"搜索：{search_title}")
@@ -280,17 +255,23 @@ def search_and_select_episode(search_title, config, api_url, history_data):
     print(f"{'='*50}")
 
     params = {'page': 1, 'pageSize': 30, 'search': search_keys}
-    highest_downloaded_ep = history_data.get('highest_episode_downloaded', {}).get(search_title, 0.0)
-    downloaded_magnets_set = set(history_data.get('all_downloaded_magnets', []))
+    highest_downloaded_ep = history.highest_episode(search_title)
     
     print_info(f"历史最高集数：{highest_downloaded_ep}")
+    # 本地已有的集数（手动放入或其他字幕组的版本），第一个搜索关键词作为文件名匹配的别名
+    episodes_on_disk = disk_index.episodes_for(search_title, search_keys[:1]) if disk_index else set()
 
     try:
         prepared_request = requests.Request('GET', api_url, params=params).prepare()
         print_info(f"请求URL：{prepared_request.url}")
 
-        with requests.Session() as session:
+        # 进程内执行时复用作业运行时的 HTTP 会话（保持连接）
+        session = http or requests.Session()
+        try:
             response = session.send(prepared_request, timeout=20)
+        finally:
+            if http is None:
+                session.close()
         response.raise_for_status()
 
         data = response.json()
@@ -304,7 +285,7 @@ def search_and_select_episode(search_title, config, api_url, history_data):
         new_resources = []
         for r in resources:
             magnet = r.get('magnet')
-            if magnet and magnet not in downloaded_magnets_set:
+            if magnet and not history.is_downloaded(magnet):
                 tracker_count = magnet.count('&tr=')
                 print_info(f"新资源：{r.get('title', '未知')} (包含 {tracker_count} 个tracker)")
                 new_resources.append(r)
@@ -313,9 +294,8 @@ def search_and_select_episode(search_title, config, api_url, history_data):
             print_info("所有资源都已下载过")
             return None
 
-        # 找到最新集数
-        latest_new_episode_resource = None
-        max_new_episode_num = -1.0
+        # 每一集只保留最符合偏好的版本（多个字幕组发布同一集时只下载一份）
+        best_by_episode = {}
         
         print_info(f"找到 {len(new_resources)} 个新资源，开始筛选")
 
@@ -325,29 +305,44 @@ def search_and_select_episode(search_title, config, api_url, history_data):
             if episode_num is None:
                 print_info(f"跳过：无法解析集数 - {title}")
                 continue
-            if episode_num > max_new_episode_num:
-                max_new_episode_num = episode_num
-                latest_new_episode_resource = r
-
-        if latest_new_episode_resource:
-            magnet_info = analyze_magnet_trackers(latest_new_episode_resource.get('magnet'))
-            print_info(f"新资源最高集数：{max_new_episode_num}")
-            print_info(f"标题：{latest_new_episode_resource.get('title')}")
-            print_info(f"Tracker数量：{magnet_info['tracker_count']}")
-            print_info(f"动漫专用Tracker：{'是' if magnet_info['has_anime_trackers'] else '否'}")
-            
-            if max_new_episode_num > highest_downloaded_ep:
-                print_success(f"该集数 ({max_new_episode_num}) 高于历史记录 ({highest_downloaded_ep})，标记下载")
-                if magnet_info['tracker_count'] > 0:
-                    print_success(f"磁力链接质量良好：包含 {magnet_info['tracker_count']} 个tracker")
-                return latest_new_episode_resource, max_new_episode_num
-            else:
-                print_info(f"该集数 ({max_new_episode_num}) 不高于历史记录 ({highest_downloaded_ep})，跳过")
-                return None
-        else:
+            release = parse_release(title)
+            best = best_by_episode.get(episode_num)
+            if best is None or preference_key(release, preferences) < preference_key(best[1], preferences):
+                best_by_episode[episode_num] = (r, release)
+
+        if not best_by_episode:
             print_info("找到新资源但无法解析集数")
             return None
 
+        # 从最新一集往前找第一个需要下载的：比历史记录新的集数，或已下载集数的升级版本（修正版 / 更好的片源）
+        for episode_num in sorted(best_by_episode, reverse=True):
+            resource, release = best_by_episode[episode_num]
+            existing = history.episode_releases(search_title, episode_num)
+            if existing:
+                if not is_upgrade(release, existing, preferences):
+                    print_info(f"跳过：第 {episode_num:g} 集已下载过 {release_variant(existing[-1])} 版本 - {resource.get('title')}")
+                    continue
+                print_success(f"第 {episode_num:g} 集有升级版本（v{release['version']} / {release['source'] or '未知片源'}），标记下载")
+            elif episode_num in episodes_on_disk:
+                print_info(f"跳过：第 {episode_num:g} 集已在本地 - {resource.get('title')}")
+                continue
+            elif episode_num <= highest_downloaded_ep:
+                print_info(f"该集数 ({episode_num}) 不高于历史记录 ({highest_downloaded_ep})，跳过")
+                continue
+            else:
+                print_success(f"该集数 ({episode_num}) 高于历史记录 ({highest_downloaded_ep})，标记下载")
+
+            magnet_info = analyze_magnet_trackers(resource.get('magnet'))
+            print_info(f"标题：{resource.get('title')}")
+            print_info(f"版本：{release_variant(release)}")
+            print_info(f"Tracker数量：{magnet_info['tracker_count']}")
+            print_info(f"动漫专用Tracker：{'是' if magnet_info['has_anime_trackers'] else '否'}")
+            if magnet_info['tracker_count'] > 0:
+                print_success(f"磁力链接质量良好：包含 {magnet_info['tracker_count']} 个tracker")
+            return resource, episode_num, release
+
+        return None
+
     except Exception as e:
         print_error(f"搜索时发生错误: {e}")
         return None
@@ -360,11 +355,35 @@ def main():
 
     print("🔍 动漫种子搜索脚本")
     print("=" * 50)
+    # 命令行参数为番剧名时只搜索这些番剧（调度器按放送时间检查单部番剧）
+    run_search(titles=sys.argv[1:] or None)
 
+
+def run_search(config=None, history=None, http=None, titles=None):
+    """
+    搜索作业（可导入调用）：扫描当前时间窗口内的番剧，把新集数追加到任务队列，返回找到的任务。
+    指定 titles 时不按时间窗口筛选，只搜索追番列表中的这些番剧。
+    调度器 / Web 应用在进程内执行时传入共享的配置、历史存储和 HTTP 会话；
+    未传入时自行加载，自己打开的历史存储用完后关闭
+    """
     # 1. 加载配置
-    config = load_config()
+    if config is None:
+        config = load_config()
     if not config:
-        return
+        return []
+    # 4. 加载下载历史 (仅用于读取，SQLite 索引查询)
+    owns_history = history is None
+    if owns_history:
+        history = open_history(config)
+    try:
+        return queue_new_episodes(config, history, http, titles)
+    finally:
+        if owns_history:
+            history.close()
+
+
+def queue_new_episodes(config, history, http=None, titles=None):
+    """按追番列表搜索新资源并追加到任务队列，返回找到的任务（包括队列中已有的）"""
     global_config = config.get('global_settings', {})
     script_config = config.get('torrent_searcher', {})
 
@@ -373,55 +392,59 @@ def main():
     seasonal_file = config.get('seasonal_fetcher', {}).get('output_file')
     if not seasonal_file:
         print_error("config.json 中 'seasonal_fetcher.output_file' 未配置")
-        return
+        return []
         
     seasonal_list = load_json_file(seasonal_file, [])
     if not seasonal_list:
         print_error(f"{seasonal_file} 为空，请先使用 Bangumi API 获取数据")
-        return
+        return []
 
     # 3. 加载追番列表
     watchlist = load_watchlist()
     if not watchlist:
         print_error("追番列表为空")
-        return
+        return []
 
-    # 4. 加载下载历史 (仅用于读取)
-    history_file = global_config.get('download_history_file')
-    if not history_file:
-        print_error("config.json 中 'global_settings.download_history_file' 未配置")
-        return
-        
-    history_data = load_json_file(history_file, {"highest_episode_downloaded": {}, "all_downloaded_magnets": []})
+    # 4b. 本地已有剧集的索引（按目录 mtime 增量刷新）
+    disk_index = open_disk_index(config)
 
-    # 5. 获取今天该扫描的番剧
-    anime_to_scan = get_anime_to_scan(config, watchlist, seasonal_list)
+    # 5. 获取今天该扫描的番剧（指定了番剧时直接搜索这些番剧）
+    if titles:
+        anime_to_scan = {title: watchlist[title] for title in titles if title in watchlist}
+        for title in titles:
+            if title not in watchlist:
+                print_error(f"番剧 '{title}' 不在追番列表中")
+    else:
+        anime_to_scan = get_anime_to_scan(config, watchlist, seasonal_list)
 
     if not anime_to_scan:
         print_info("当前时间窗口内没有需要扫描的番剧")
-        return
+        return []
 
     # 6. 执行搜索
     print_info(f"开始扫描 {len(anime_to_scan)} 部番剧")
     api_url = global_config.get('torrent_api_url')
     output_file = script_config.get('output_file')
+    # 同一集有多个字幕组发布时的偏好顺序和升级规则
+    preferences = script_config.get('release_preferences', {})
     
     # 准备一个列表来装完整的"任务对象"
     new_tasks_for_queue = []
 
     for title, conf in anime_to_scan.items():
-        # search_and_select_episode 函数本身不需要修改
-        result = search_and_select_episode(title, conf, api_url, history_data)
+        result = search_and_select_episode(title, conf, api_url, history, disk_index, preferences, http)
         
         if result:
-            episode_resource, episode_num = result
+            episode_resource, episode_num, release = result
             
             # (新增) 构建一个完整的任务对象, 供 download_bt.py 使用
             task_object = {
                 "anime_title": title, # 追番列表中的标准名称 (用于更新历史)
                 "episode": episode_num, # 解析出的集数 (用于更新历史)
                 "title": episode_resource.get('title'), # 资源原始标题
-                "magnet": episode_resource.get('magnet') # 磁力链接
+                "magnet": episode_resource.get('magnet'), # 磁力链接
+                "size": resource_size_bytes(episode_resource), # 资源大小 (用于云端空间准入)
+                "release": release # 字幕组 / 分辨率 / 语言 / 修正版本 (用于跨字幕组去重)
             }
             new_tasks_for_queue.append(task_object)
 
@@ -431,30 +454,44 @@ def main():
     elif new_tasks_for_queue:
         print_info(f"正在将 {len(new_tasks_for_queue)} 个新任务添加到 {output_file}...")
         
-        # 6a. (新增) 读取现有的任务队列 (search_results.json)
-        existing_tasks = load_json_file(output_file, [])
-        
-        # 6b. (新增) 合并并去重 (基于磁力链接)
-        existing_magnets = {task.get('magnet') for task in existing_tasks}
-        added_count = 0
-        for new_task in new_tasks_for_queue:
-            if new_task.get('magnet') not in existing_magnets:
+        # 6a. 在文件锁内读取现有的任务队列 → 合并去重 (基于磁力链接) → 原子写回，
+        #     避免与同时运行的 download_bt.py 互相覆盖
+        added = []
+
+        def merge_tasks(existing_tasks):
+            existing_magnets = {task.get('magnet') for task in existing_tasks}
+            for new_task in new_tasks_for_queue:
+                if new_task.get('magnet') in existing_magnets:
+                    print_info(f"任务 '{new_task.get('title')}' 已存在于队列中, 跳过添加。")
+                    continue
+                # 同一集已在队列中（其他字幕组的版本）：尚未开始下载且新版本更符合偏好时替换，否则跳过
+                queued = next((i for i, task in enumerate(existing_tasks)
+                               if task.get('anime_title') == new_task['anime_title']
+                               and task.get('episode') == new_task['episode']), None)
+                if queued is not None:
+                    old_task = existing_tasks[queued]
+                    old_release = old_task.get('release') or parse_release(old_task.get('title'))
+                    started = (old_task.get('download_state') or {}).get('stage', 'queued') != 'queued'
+                    if started or preference_key(new_task['release'], preferences) >= preference_key(old_release, preferences):
+                        print_info(f"任务 '{new_task.get('title')}' 的同一集已在队列中, 跳过添加。")
+                        continue
+                    print_info(f"用更符合偏好的版本替换队列中的 '{old_task.get('title')}'")
+                    existing_magnets.discard(existing_tasks.pop(queued).get('magnet'))
                 existing_tasks.append(new_task)
                 existing_magnets.add(new_task.get('magnet'))
-                added_count += 1
-            else:
-                print_info(f"任务 '{new_task.get('title')}' 已存在于队列中, 跳过添加。")
-        
-        # 6c. (修改) 保存合并后的完整队列
-        if save_json_file(output_file, existing_tasks):
-            print_success(f"成功将 {added_count} 个新任务追加到 {output_file}")
-        else:
-            print_error(f"!!! 保存任务队列 {output_file} 失败 !!!")
+                added.append(new_task)
+
+        try:
+            update_json(os.path.join(PROJECT_ROOT, output_file), [], merge_tasks)
+            print_success(f"成功将 {len(added)} 个新任务追加到 {output_file}")
+        except Exception as e:
+            print_error(f"!!! 保存任务队列 {output_file} 失败: {e} !!!")
     
     # 7. (已删除) 此脚本不再负责更新 download_history.json
     
     print_info(f"\n--- 扫描完毕 ---")
     print_success(f"共找到 {len(new_tasks_for_queue)} 个符合更新条件的剧集, 已添加到任务队列。")
+    return new_tasks_for_queue
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态文件持久化
+- atomic_write_json: 写临时文件 → fsync → rename，崩溃时旧文件保持完整
+- file_lock:         跨进程的建议锁（Web 应用、调度器启动的脚本、手动下载可能同时读写同一个文件）
+- update_json:       在锁内完成 读取 → 修改 → 原子写回
+- Journal:           追加式预写日志，每条记录 fsync 后才算写入，进程被杀后下次启动时重放
+"""
+
+import json
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只保留原子写入
+    fcntl = None
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    对 path 加建议锁。锁加在旁边的 .lock 文件上，
+    因为数据文件会被 rename 替换，锁住旧 inode 没有意义。
+    blocking=False 时锁已被占用会抛出 BlockingIOError
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = path + '.lock'
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        fcntl.flock(lock_file, flags if blocking else flags | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def fsync_dir(dir_path):
+    """rename 之后同步目录项，保证掉电后新文件名也已落盘"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path, data, indent=2, mode=None):
+    """原子写入 JSON（默认保留原文件的权限，config.json 里有密码；mode 指定时使用该权限）"""
+    dir_path = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=dir_path)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        elif os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(dir_path)
+
+
+def read_json(path, default):
+    """读取 JSON，文件不存在时返回 default（写入是原子的，读取不需要加锁）"""
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def update_json(path, default, update, indent=2):
+    """
+    在排他锁内读取 → update(data) → 原子写回，避免多个进程的读改写互相覆盖。
+    update 可以原地修改 data（返回 None），也可以返回新的数据。返回写入的数据
+    """
+    with file_lock(path):
+        data = read_json(path, default)
+        result = update(data)
+        if result is not None:
+            data = result
+        atomic_write_json(path, data, indent)
+        return data
+
+
+class Journal:
+    """
+    追加式预写日志（JSON Lines）。
+    关键状态变化先 append（fsync）再执行，检查点完成后 clear；
+    下次启动时 replay 出上次没来得及落到状态文件中的记录。
+    最后一行可能因进程被杀而不完整，重放时忽略
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with file_lock(self.path):
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print_error(f"忽略不完整的日志记录: {self.path}")
+        return records
+
+    def clear(self):
+        with file_lock(self.path):
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地下载后端的往返测试
+用一个本地 HTTP 服务器模拟 aria2 JSON-RPC、qBittorrent WebUI API 和 Transmission RPC，
+对每个后端走一遍 添加 → 查询状态 → 完成 → 获取文件 → 移除
+运行: python -m unittest discover tests
+"""
+
+import base64
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bt_backends import Aria2Backend, QBittorrentBackend, TransmissionBackend, magnet_info_hash  # noqa: E402
+
+INFO_HASH = '0123456789abcdef0123456789abcdef01234567'
+MAGNET = f'magnet:?xt=urn:btih:{INFO_HASH}&dn=Show%20-%2001'
+SESSION_ID = 'session-1'
+
+
+class FakeDaemonHandler(http.server.BaseHTTPRequestHandler):
+    """按路径分发到三种 API；任务状态保存在 server.torrents 中，由测试修改"""
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, status=200, headers=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self.qbittorrent(url.path, query)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        body = self.read_body()
+        if url.path == '/jsonrpc':
+            self.aria2(json.loads(body))
+        elif url.path == '/transmission/rpc':
+            self.transmission(json.loads(body))
+        else:
+            self.qbittorrent(url.path, dict(urllib.parse.parse_qsl(body.decode('utf-8'))))
+
+    # --- aria2 ---
+
+    def aria2(self, request):
+        server = self.server
+        method, params = request['method'], request['params']
+        if method == 'system.multicall':
+            results = []
+            for call in params[0]:
+                call_params = call['params']
+                if call_params[0] != 'token:secret':
+                    results.append({'faultCode': 1, 'faultString': 'Unauthorized'})
+                    continue
+                status = server.torrents.get(call_params[1])
+                results.append([status] if status else {'faultCode': 1, 'faultString': 'not found'})
+            return self.send_json({'id': request['id'], 'jsonrpc': '2.0', 'result': results})
+        if params[:1] != ['token:secret']:
+            return self.send_json({'id': request['id'], 'jsonrpc': '2.0',
+                                   'error': {'code': 1, 'message': 'Unauthorized'}})
+        if method == 'aria2.addUri':
+            server.added.append((params[1], params[2]))
+            # 磁力任务先下载元数据，完成后由 followedBy 指向真正的下载任务
+            server.torrents['meta'] = {'gid': 'meta', 'status': 'complete', 'followedBy': ['data'],
+                                       'totalLength': '0', 'completedLength': '0', 'downloadSpeed': '0'}
+            return self.send_json({'id': request['id'], 'jsonrpc': '2.0', 'result': 'meta'})
+        if method == 'aria2.removeDownloadResult':
+            server.removed.append(params[1])
+            return self.send_json({'id': request['id'], 'jsonrpc': '2.0', 'result': 'OK'})
+        self.send_json({'id': request['id'], 'jsonrpc': '2.0', 'error': {'code': 1, 'message': method}})
+
+    # --- qBittorrent ---
+
+    def qbittorrent(self, path, params):
+        server = self.server
+        if path == '/api/v2/auth/login':
+            if params.get('username') == 'admin' and params.get('password') == 'pass':
+                return self.send_text('Ok.', headers={'Set-Cookie': 'SID=sid-1; path=/'})
+            return self.send_text('Fails.')
+        if 'SID=sid-1' not in self.headers.get('Cookie', ''):
+            return self.send_text('Forbidden', 403)
+        if path == '/api/v2/torrents/add':
+            server.added.append((params['urls'], params['savepath']))
+            return self.send_text('Ok.')
+        if path == '/api/v2/torrents/info':
+            if not params.get('hashes'):
+                # 和 qBittorrent 一样：不指定 hashes 时返回所有任务
+                return self.send_json(list(server.torrents.values()))
+            hashes = params['hashes'].split('|')
+            return self.send_json([t for h, t in server.torrents.items() if h.lower() in hashes])
+        if path == '/api/v2/torrents/files':
+            return self.send_json(server.files.get(params['hash'].upper(), []))
+        if path == '/api/v2/torrents/delete':
+            server.removed.append((params['hashes'], params['deleteFiles']))
+            return self.send_text('')
+        self.send_text('Not Found', 404)
+
+    # --- Transmission ---
+
+    def transmission(self, request):
+        server = self.server
+        if self.headers.get('X-Transmission-Session-Id') != SESSION_ID:
+            server.conflicts += 1
+            return self.send_text('', 409, {'X-Transmission-Session-Id': SESSION_ID})
+        method, arguments = request['method'], request['arguments']
+        if method == 'torrent-add':
+            server.added.append((arguments['filename'], arguments['download-dir']))
+            if server.add_response is not None:
+                return self.send_json({'result': 'success', 'arguments': server.add_response})
+            server.torrents[7] = {'id': 7, 'hashString': INFO_HASH, 'name': 'Show - 01', 'percentDone': 0.25,
+                                  'rateDownload': 1024, 'sizeWhenDone': 4096, 'leftUntilDone': 3072,
+                                  'error': 0, 'errorString': '', 'downloadDir': server.download_dir, 'files': []}
+            return self.send_json({'result': 'success', 'arguments': {
+                'torrent-added': {'id': 7, 'hashString': INFO_HASH, 'name': 'Show - 01'}}})
+        if method == 'torrent-get':
+            torrents = [server.torrents[i] for i in arguments['ids'] if i in server.torrents]
+            return self.send_json({'result': 'success', 'arguments': {'torrents': torrents}})
+        if method == 'torrent-remove':
+            server.removed.append((arguments['ids'], arguments['delete-local-data']))
+            return self.send_json({'result': 'success', 'arguments': {}})
+        self.send_json({'result': f'method not recognized: {method}'})
+
+    def log_message(self, *args):
+        pass
+
+
+class BackendRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeDaemonHandler)
+        self.server.torrents = {}
+        self.server.files = {}
+        self.server.added = []
+        self.server.removed = []
+        self.server.conflicts = 0
+        self.server.add_response = None
+        self.server.download_dir = self.tmp
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+        self.job = {'task': {'title': 'Show - 01', 'magnet': MAGNET}, 'stage': 'queued', 'save_dir': self.tmp}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def make_files(self, *names):
+        paths = []
+        for name in names:
+            path = os.path.join(self.tmp, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 16)
+            paths.append(path)
+        return paths
+
+    def poll(self, backend):
+        snapshot = backend.refresh([self.job])
+        return backend.status(self.job, snapshot)
+
+    def test_aria2_round_trip(self):
+        backend = Aria2Backend(port=self.port, secret='secret')
+        backend.prepare([self.job])
+        self.assertTrue(backend.add(self.job))
+        self.assertEqual(self.job['backend_id'], 'meta')
+        self.assertEqual(self.server.added, [([MAGNET], {'dir': self.tmp, 'seed-time': '0'})])
+        self.job['stage'] = 'added'
+
+        self.server.torrents['data'] = {'gid': 'data', 'status': 'active', 'totalLength': '4096',
+                                        'completedLength': '1024', 'downloadSpeed': '512', 'files': []}
+        self.assertEqual(self.poll(backend), ('downloading', None))
+        self.assertEqual((self.job['active_id'], self.job['progress']), ('data', 25.0))
+
+        video, extra = self.make_files('Show - 01.mkv', 'Show - 01.nfo')
+        self.server.torrents['data'].update(status='complete', completedLength='4096',
+                                            files=[{'path': video}, {'path': extra}])
+        state, item = self.poll(backend)
+        self.assertEqual(state, 'done')
+        self.job['item'] = item
+        self.assertEqual(backend.fetch(self.job, self.tmp, {}), [video])
+        self.assertEqual(self.job['integrity'][0]['verified_by'], 'aria2')
+
+        backend.remove(self.job)
+        self.assertEqual(sorted(self.server.removed), ['data', 'meta'])
+
+    def test_qbittorrent_round_trip(self):
+        backend = QBittorrentBackend(port=self.port, username='admin', password='pass')
+        backend.prepare([self.job])
+        self.assertTrue(backend.add(self.job))
+        # 按磁力链接中的 info hash 跟踪，不依赖 torrents/add 的返回内容
+        self.assertEqual(self.job['backend_id'], INFO_HASH)
+        self.assertEqual(self.server.added, [(MAGNET, self.tmp)])
+        self.job['stage'] = 'added'
+
+        self.assertEqual(self.poll(backend), ('missing', None))
+        # qBittorrent 返回的 hash 大小写不固定
+        torrent = {'hash': INFO_HASH.upper(), 'state': 'downloading', 'progress': 0.5, 'size': 4096,
+                   'dlspeed': 512, 'save_path': self.tmp}
+        self.server.torrents[INFO_HASH.upper()] = torrent
+        self.assertEqual(self.poll(backend), ('downloading', None))
+        self.assertEqual(self.job['progress'], 50.0)
+
+        video, = self.make_files(os.path.join('Show', 'Show - 01.mkv'))
+        torrent.update(state='stalledUP', progress=1)
+        self.server.files[INFO_HASH.upper()] = [{'name': os.path.join('Show', 'Show - 01.mkv')}]
+        state, item = self.poll(backend)
+        self.assertEqual((state, item), ('done', self.tmp))
+        self.job['item'] = item
+        self.assertEqual(backend.fetch(self.job, self.tmp, {}), [video])
+
+        backend.remove(self.job)
+        self.assertEqual(self.server.removed, [(INFO_HASH, 'false')])
+
+    def test_qbittorrent_base32_magnet(self):
+        value = base64.b32encode(bytes.fromhex(INFO_HASH)).decode('ascii')
+        self.assertEqual(magnet_info_hash(f'magnet:?xt=urn:btih:{value}'), INFO_HASH)
+        backend = QBittorrentBackend(port=self.port, username='admin', password='pass')
+        backend.prepare([self.job])
+        self.job['task']['magnet'] = f'magnet:?xt=urn:btih:{value}'
+        self.assertTrue(backend.add(self.job))
+        self.assertEqual(self.job['backend_id'], INFO_HASH)
+
+    def test_malformed_magnet_hash(self):
+        self.assertIsNone(magnet_info_hash('magnet:?xt=urn:btih:ZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZ1'))
+
+    def test_qbittorrent_refresh_without_hashes(self):
+        backend = QBittorrentBackend(port=self.port, username='admin', password='pass')
+        backend.prepare([self.job])
+        # 其他程序添加的任务不能出现在快照中
+        self.server.torrents['F' * 40] = {'hash': 'F' * 40, 'state': 'downloading', 'progress': 0}
+        self.assertEqual(backend.refresh([self.job]), {})
+
+    def test_qbittorrent_login_failure(self):
+        backend = QBittorrentBackend(port=self.port, username='admin', password='wrong')
+        with self.assertRaises(RuntimeError):
+            backend.prepare([self.job])
+
+    def test_transmission_round_trip(self):
+        backend = TransmissionBackend(port=self.port)
+        backend.prepare([self.job])
+        self.assertTrue(backend.add(self.job))
+        # 第一次请求收到 409，带上返回的会话 id 重试
+        self.assertEqual(self.server.conflicts, 1)
+        self.assertEqual(backend.session.headers['X-Transmission-Session-Id'], SESSION_ID)
+        self.assertEqual(self.job['backend_id'], 7)
+        self.assertEqual(self.server.added, [(MAGNET, self.tmp)])
+        self.job['stage'] = 'added'
+
+        self.assertEqual(self.poll(backend), ('downloading', None))
+        self.assertEqual(self.job['progress'], 25.0)
+
+        video, = self.make_files('Show - 01.mkv')
+        self.server.torrents[7].update(percentDone=1, leftUntilDone=0, files=[{'name': 'Show - 01.mkv'}])
+        state, item = self.poll(backend)
+        self.assertEqual((state, item), ('done', [video]))
+        self.job['item'] = item
+        self.assertEqual(backend.fetch(self.job, self.tmp, {}), [video])
+
+        backend.remove(self.job)
+        self.assertEqual(self.server.removed, [([7], False)])
+        # 整个过程中会话 id 只需要获取一次
+        self.assertEqual(self.server.conflicts, 1)
+
+    def test_transmission_session_id_renewed(self):
+        backend = TransmissionBackend(port=self.port)
+        backend.session.headers['X-Transmission-Session-Id'] = 'expired'
+        self.assertEqual(backend.refresh([]), {})
+        self.assertEqual(self.server.conflicts, 1)
+
+    def test_transmission_add_without_torrent(self):
+        self.server.add_response = {}
+        backend = TransmissionBackend(port=self.port)
+        self.assertFalse(backend.add(self.job))
+        self.assertNotIn('backend_id', self.job)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地传输的断线续传测试
+用本地 HTTP 服务器模拟响应体传到一半时连接被断开，确认单连接下载会用 Range 请求续传、
+分段下载只重试断开的那一段，最终文件内容完整
+运行: python -m unittest discover tests
+"""
+
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download_bt  # noqa: E402
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+# 每个请求在发送这么多字节后断开连接，之后的请求正常返回
+DROP_AFTER = 1024 * 1024
+
+
+class DroppingHandler(http.server.BaseHTTPRequestHandler):
+    """支持 Range 的文件服务器；前 drops 个请求只发送部分响应体就关闭连接"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.ranges.append(self.headers.get('Range'))
+            drop = server.drops > 0
+            server.drops -= 1 if drop else 0
+
+        start, end = 0, len(DATA) - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first)
+            end = int(last) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(DATA)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        body = DATA[start:end + 1]
+        if drop and len(body) > 1:
+            # 声明了完整长度但只发送一部分，然后直接断开
+            self.wfile.write(body[:min(DROP_AFTER, len(body) // 2)])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DroppingHandler)
+        self.server.lock = threading.Lock()
+        self.server.ranges = []
+        self.server.drops = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/file.bin'
+        self.tmp = tempfile.mkdtemp()
+        self.save_path = os.path.join(self.tmp, 'file.bin')
+        self.settings = {'transfer_buffer_size': 64 * 1024, 'progress_interval': 60, 'fsync': 'none'}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def read_result(self):
+        with open(self.save_path, 'rb') as f:
+            return f.read()
+
+    def test_single_stream_resumes_with_range(self):
+        self.server.drops = 1
+        integrity = download_bt.download_url_to_file(self.url, self.save_path, len(DATA), self.settings)
+        self.assertIsNotNone(integrity)
+        self.assertEqual(self.read_result(), DATA)
+        self.assertFalse(os.path.exists(self.save_path + '.part'))
+        # 第一次完整请求被断开，第二次从已写入的位置续传
+        self.assertEqual(self.server.ranges[0], None)
+        self.assertEqual(self.server.ranges[1], f'bytes={DROP_AFTER}-')
+
+    def test_segment_retries_after_drop(self):
+        self.server.drops = 1
+        integrity = download_bt.download_url_segmented(self.url, self.save_path, len(DATA), 3, self.settings)
+        self.assertIsNotNone(integrity)
+        self.assertEqual(self.read_result(), DATA)
+        self.assertFalse(os.path.exists(self.save_path + '.part.json'))
+        # 3 个分段 + 断开那一段的一次重试
+        self.assertEqual(len(self.server.ranges), 4)
+
+    def test_stop_keeps_part_for_next_run(self):
+        class StopAfterFirstChunk:
+            def consume(self, n):
+                download_bt.STOP.set()
+
+        self.addCleanup(download_bt.STOP.clear)
+        settings = dict(self.settings, bandwidth_limiter=StopAfterFirstChunk())
+        with self.assertRaises(download_bt.JobStopped):
+            download_bt.download_url_to_file(self.url, self.save_path, len(DATA), settings)
+        chunk = self.settings['transfer_buffer_size']
+        self.assertEqual(os.path.getsize(self.save_path + '.part'), chunk)
+
+        # 下次运行从停止的位置续传
+        download_bt.STOP.clear()
+        integrity = download_bt.download_url_to_file(self.url, self.save_path, len(DATA), self.settings)
+        self.assertIsNotNone(integrity)
+        self.assertEqual(self.read_result(), DATA)
+        self.assertEqual(self.server.ranges[1], f'bytes={chunk}-')
+
+    def test_transfer_settings_from_config(self):
+        config = {'bt_downloader': {'transfer_buffer_size': 4096, 'progress_interval': 5, 'preallocate': False,
+                                    'fsync': 'interval', 'fsync_interval': 8192}}
+        transfer = download_bt.get_transfer_settings(download_bt.get_downloader_settings(config))
+        self.assertEqual((transfer['buffer_size'], transfer['progress_interval'], transfer['preallocate'],
+                          transfer['fsync'], transfer['fsync_interval']), (4096, 5, False, 'interval', 8192))
+
+    def test_hash_settings_from_config(self):
+        config = {'bt_downloader': {'hash_algorithm': 'md5'}}
+        settings = download_bt.get_downloader_settings(config)
+        self.assertEqual(download_bt.get_transfer_settings(settings)['hash_algorithm'], 'md5')
+        config['bt_downloader']['seedr_hash_algorithm'] = 'sha256'
+        settings = download_bt.get_downloader_settings(config)
+        self.assertEqual(settings['seedr_hash_algorithm'], 'sha256')
+        self.assertEqual(download_bt.get_transfer_settings(settings)['hash_algorithm'], 'sha256')
+
+    def test_read_errors_are_request_exceptions(self):
+        class BrokenRaw:
+            decode_content = False
+
+            def readinto(self, view):
+                raise download_bt.urllib3.exceptions.ProtocolError('Connection broken')
+
+        response = type('Response', (), {'raw': BrokenRaw()})()
+        transfer = download_bt.get_transfer_settings(self.settings)
+        with open(self.save_path, 'wb') as f:
+            with self.assertRaises(download_bt.requests.RequestException):
+                download_bt.stream_to_fd(response, f.fileno(), 0, None, lambda pos, data: None, transfer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+传输中完整性校验的测试
+确认默认配置不计算整文件哈希，多个分段线程同时写入时分块校验的计数准确
+运行: python -m unittest discover tests
+"""
+
+import hashlib
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download_bt  # noqa: E402
+
+PIECE_LENGTH = 16 * 1024
+PIECES = 64
+
+
+class IntegrityCheckerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = bytearray(os.urandom(PIECE_LENGTH * PIECES))
+        hashes = [hashlib.sha1(self.data[i:i + PIECE_LENGTH]).digest()
+                  for i in range(0, len(self.data), PIECE_LENGTH)]
+        self.layout = {'piece_length': PIECE_LENGTH, 'hashes': hashes, 'total_length': len(self.data),
+                       'file_offset': 0, 'file_size': len(self.data)}
+
+    def feed_in_segments(self, checker, segments):
+        """像分段下载一样：每个线程按顺序写入自己的分块范围，每次写入半个分块"""
+        per_segment = PIECES // segments * PIECE_LENGTH
+
+        def write_segment(start):
+            for offset in range(start, start + per_segment, PIECE_LENGTH // 2):
+                checker.feed(offset, bytes(self.data[offset:offset + PIECE_LENGTH // 2]))
+
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            list(pool.map(write_segment, range(0, len(self.data), per_segment)))
+
+    def test_default_settings_skip_whole_file_hash(self):
+        transfer = download_bt.get_transfer_settings(download_bt.get_downloader_settings({}))
+        self.assertIsNone(transfer['hash_algorithm'])
+
+    def test_concurrent_segments_count_every_piece(self):
+        for _ in range(20):
+            checker = download_bt.IntegrityChecker(None, None, self.layout)
+            self.feed_in_segments(checker, 8)
+            result = checker.result()
+            self.assertEqual((result['status'], result['pieces_verified'], result['pieces_failed']),
+                             ('verified', PIECES, 0))
+            self.assertEqual(checker.partial, {})
+
+    def test_concurrent_segments_report_corrupt_piece(self):
+        self.data[5 * PIECE_LENGTH + 10] ^= 0xFF
+        checker = download_bt.IntegrityChecker(None, None, self.layout)
+        self.feed_in_segments(checker, 8)
+        result = checker.result()
+        self.assertEqual((result['status'], result['pieces_verified'], result['pieces_failed']),
+                         ('corrupt', PIECES - 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
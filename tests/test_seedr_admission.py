@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Seedr 准入控制测试
+用假的 Seedr 客户端模拟云端配额只够同时下载两个任务、任务一直下载不完的情况，
+确认超时失败的任务会删除云端种子并释放预留，暂缓的任务随后能被添加，而不是因"空间不足"失败
+运行: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download_bt  # noqa: E402
+
+SPACE_MAX = 25
+TASK_SIZE = 10
+
+
+class FakeSeedr:
+    """添加的种子一直停在 0%，按种子大小占用空间"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.torrents = {}
+        self.added = []
+        self.deleted = []
+
+    def add_torrent(self, magnet_link):
+        with self.lock:
+            if sum(self.torrents.values()) + TASK_SIZE > SPACE_MAX:
+                return types.SimpleNamespace(result=False)
+            torrent_id = len(self.added) + 1
+            self.torrents[torrent_id] = TASK_SIZE
+            self.added.append(magnet_link)
+        return types.SimpleNamespace(result=True, user_torrent_id=torrent_id, torrent_hash=f'h{torrent_id}',
+                                     title=f'torrent {torrent_id}')
+
+    def list_contents(self, folder_id='0'):
+        with self.lock:
+            torrents = [types.SimpleNamespace(id=torrent_id, name=f'torrent {torrent_id}', hash=f'h{torrent_id}',
+                                              size=size, progress='0', download_rate=0)
+                        for torrent_id, size in self.torrents.items()]
+            used = sum(self.torrents.values())
+        return types.SimpleNamespace(files=[], folders=[], torrents=torrents, space_used=used, space_max=SPACE_MAX)
+
+    def delete_torrent(self, torrent_id):
+        with self.lock:
+            self.torrents.pop(int(torrent_id))
+            self.deleted.append(torrent_id)
+        return types.SimpleNamespace(result=True)
+
+
+class FakeHistory:
+
+    def is_downloaded(self, magnet):
+        return False
+
+    def has_transferred_file(self, name, size):
+        return False
+
+
+class SeedrAdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        patcher = mock.patch.object(download_bt, 'SEEDR_CACHE_FILE', os.path.join(self.tmp, 'seedr_cache.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = FakeSeedr()
+        self.backend = download_bt.SeedrBackend(self.client, FakeHistory(), download_dir=self.tmp)
+        self.settings = download_bt.get_downloader_settings({'bt_downloader': {
+            'cloud_timeout': 0.1, 'poll_min_interval': 0.01, 'poll_max_interval': 0.02,
+            'min_cloud_rate': 10 ** 9, 'max_retries': 1}})
+        self.settings['download_dir'] = self.tmp
+        self.tasks = [{'title': f'task {i}', 'magnet': f'magnet:?xt=urn:btih:{i:040x}', 'size': TASK_SIZE}
+                      for i in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_failed_jobs_release_cloud_space(self):
+        download_bt.run_download_pipeline(self.backend, self.tasks, FakeHistory(), self.settings)
+
+        # 每个任务都被添加过，失败原因是超时而不是空间不足
+        self.assertEqual(sorted(self.client.added), sorted(task['magnet'] for task in self.tasks))
+        for task in self.tasks:
+            state = task['download_state']
+            self.assertEqual(state['stage'], 'failed')
+            self.assertEqual(state['last_error'], 'seedr 下载超时')
+            self.assertEqual(state['backend_ids'], {})
+        # 失败任务的云端种子都被删除，没有残留的预留
+        self.assertEqual(len(self.client.deleted), len(self.tasks))
+        self.assertEqual(self.client.torrents, {})
+        self.assertEqual(self.backend.reserved, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
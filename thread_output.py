@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按线程分流的标准输出 / 错误输出
+进程内作业要捕获自己的输出，但同一进程中 Web 应用的请求线程等仍在打印，
+所以不能在作业期间整体替换 sys.stdout / sys.stderr。install() 一次性把它们换成按线程分流的代理：
+- 设置了写入端的线程（作业工作线程，以及作业中用 thread_pool 创建的传输线程）写到作业的捕获中
+- 其他线程照常写到原来的流
+写入端保存在 threading.local 中，线程结束后自动失效，不会串到复用了同一线程 id 的新线程上
+"""
+
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+LOCAL = threading.local()
+INSTALL_LOCK = threading.Lock()
+
+
+class RoutedStream(io.TextIOBase):
+    """sys.stdout / sys.stderr 的代理：当前线程有写入端时写到写入端，否则写到原来的流"""
+
+    def __init__(self, original, stream):
+        self.original = original
+        self.stream = stream
+
+    def target(self):
+        writers = getattr(LOCAL, 'writers', None)
+        return writers[self.stream] if writers else self.original
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def isatty(self):
+        return self.original.isatty()
+
+    def fileno(self):
+        return self.original.fileno()
+
+    @property
+    def encoding(self):
+        return self.original.encoding
+
+    @property
+    def errors(self):
+        return self.original.errors
+
+    def __getattr__(self, name):
+        # 其他属性（如 buffer）交给原来的流
+        return getattr(self.original, name)
+
+
+def install():
+    """把 sys.stdout / sys.stderr 换成按线程分流的代理（重复调用无影响）"""
+    with INSTALL_LOCK:
+        if sys.stdout is not None and not isinstance(sys.stdout, RoutedStream):
+            sys.stdout = RoutedStream(sys.stdout, 'stdout')
+        if sys.stderr is not None and not isinstance(sys.stderr, RoutedStream):
+            sys.stderr = RoutedStream(sys.stderr, 'stderr')
+
+
+def get_writers():
+    """当前线程的写入端 {'stdout', 'stderr'}，没有时返回 None"""
+    return getattr(LOCAL, 'writers', None)
+
+
+def set_writers(writers):
+    LOCAL.writers = writers
+
+
+@contextmanager
+def route_output(stdout, stderr):
+    """在 with 块中把当前线程的输出写到 stdout / stderr（需要先 install()）"""
+    previous = get_writers()
+    set_writers({'stdout': stdout, 'stderr': stderr})
+    try:
+        yield
+    finally:
+        set_writers(previous)
+
+
+def thread_pool(max_workers):
+    """创建线程池，池中线程的输出和创建它的线程去向相同"""
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=set_writers, initargs=(get_writers(),))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+调度器的定时器和控制接口
+TimerScheduler 用最小堆保存定时器（带时区的 datetime，按 UTC 时间戳排序），
+主循环一直睡眠到最早的到期时间；新增定时器、收到信号或 wake() 时通过 socketpair 提前唤醒。
+运行中的调度器把 pid 和下一次运行信息写入 data/scheduler.pid / data/scheduler_status.json，
+并在运行期间一直持有 pid 文件的排他锁（进程被强制结束时锁由系统释放），只有锁仍被持有时 pid 才被认为有效，
+不会向复用了残留 pid 的无关进程发信号：
+- Web 应用修改追番列表或配置后调用 notify_scheduler()，发送 SIGHUP 让调度器重新计算检查时间
+- kill -USR1 <pid> 让调度器把下一次运行信息写入日志
+- kill <pid>（SIGTERM）让调度器正常退出（执行清理后删除 pid 文件）
+"""
+
+import datetime
+import heapq
+import itertools
+import os
+import select
+import signal
+import socket
+import time
+
+from state_store import atomic_write_json, read_json
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只能用 os.kill(pid, 0) 判断进程是否存在
+    fcntl = None
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+PID_FILE = os.path.join(PROJECT_ROOT, 'data/scheduler.pid')
+STATUS_FILE = os.path.join(PROJECT_ROOT, 'data/scheduler_status.json')
+# 最长睡眠时间：系统时间被调整或休眠唤醒后，最多这么久就按新的时间重新计算
+MAX_SLEEP_SECONDS = 3600
+# 调度器进程中持有 pid 文件锁的文件对象
+PID_HANDLE = None
+
+
+class TimerScheduler:
+    """最小堆定时器（只在主线程中运行；wake 可在信号处理函数和其他线程中调用）"""
+
+    def __init__(self, max_sleep=MAX_SLEEP_SECONDS):
+        self.max_sleep = max_sleep
+        self.heap = []
+        self.counter = itertools.count()
+        # 唤醒原因（如 'reload'、'report'），由 run_once 返回给调用方处理
+        self.pending = []
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+
+    def call_at(self, when, name, callback):
+        """在 when（带时区的 datetime）执行 callback()"""
+        heapq.heappush(self.heap, (when.timestamp(), next(self.counter), name, when, callback))
+        self.wake()
+
+    def cancel(self, name):
+        self.heap = [entry for entry in self.heap if entry[2] != name]
+        heapq.heapify(self.heap)
+
+    def next_run(self):
+        """(最早的到期时间, 定时器名称)，没有定时器时返回 (None, None)"""
+        if not self.heap:
+            return None, None
+        _, _, name, when, _ = self.heap[0]
+        return when, name
+
+    def wake(self, reason=None):
+        if reason:
+            self.pending.append(reason)
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            # 缓冲区已满说明已有未处理的唤醒
+            pass
+
+    def run_once(self):
+        """
+        睡眠到最早的到期时间（或被唤醒），执行所有到期的定时器，返回期间收到的唤醒原因。
+        定时器抛出的异常会在执行完其他到期定时器后继续抛出
+        """
+        timeout = self.max_sleep
+        if self.heap:
+            timeout = max(0.0, min(self.heap[0][0] - time.time(), self.max_sleep))
+        readable, _, _ = select.select([self.wake_r], [], [], timeout)
+        if readable:
+            try:
+                while self.wake_r.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+        reasons, self.pending = self.pending, []
+
+        error = None
+        while self.heap and self.heap[0][0] <= time.time():
+            _, _, _, _, callback = heapq.heappop(self.heap)
+            try:
+                callback()
+            except Exception as e:
+                error = error or e
+        if error:
+            raise error
+        return reasons
+
+    def install_signal_handlers(self):
+        """
+        SIGHUP: 重新加载；SIGUSR1: 报告下一次运行（Windows 上没有这两个信号，跳过）；
+        SIGTERM: 在主线程中抛出 SystemExit，调用方的 finally 会执行（默认处理是直接结束进程）
+        """
+        for name, reason in (('SIGHUP', 'reload'), ('SIGUSR1', 'report')):
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                signal.signal(signum, lambda *_, reason=reason: self.wake(reason))
+        signal.signal(signal.SIGTERM, exit_on_signal)
+
+
+def exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def write_status(next_run, titles, tz):
+    """记录调度器的 pid 和下一次运行信息，供 Web 应用查询"""
+    atomic_write_json(STATUS_FILE, {
+        'pid': os.getpid(),
+        'updated_at': datetime.datetime.now(tz).isoformat(timespec='seconds'),
+        'next_run': next_run.astimezone(tz).isoformat(timespec='seconds') if next_run else None,
+        'titles': titles,
+    })
+
+
+def write_pid():
+    """
+    写入当前 pid 并持有 pid 文件的排他锁直到 remove_pid（或进程退出）。
+    已有调度器在运行（锁被占用）时抛出 BlockingIOError
+    """
+    global PID_HANDLE
+    os.makedirs(os.path.dirname(PID_FILE), exist_ok=True)
+    # 不能用 'w' 打开：加锁失败时会清空正在运行的调度器的 pid
+    handle = open(PID_FILE, 'a+', encoding='utf-8')
+    if fcntl is not None:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            raise
+    handle.seek(0)
+    handle.truncate()
+    handle.write(str(os.getpid()))
+    handle.flush()
+    PID_HANDLE = handle
+
+
+def remove_pid():
+    """删除 pid 文件并释放锁（只在 write_pid 成功的进程中生效）"""
+    global PID_HANDLE
+    if PID_HANDLE is None:
+        return
+    try:
+        os.remove(PID_FILE)
+    except OSError:
+        pass
+    PID_HANDLE.close()
+    PID_HANDLE = None
+
+
+def scheduler_pid():
+    """正在运行的调度器的 pid，没有运行时返回 None"""
+    try:
+        with open(PID_FILE, 'r', encoding='utf-8') as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # 锁被持有，说明写入 pid 的调度器仍在运行
+                    pass
+                else:
+                    # 能加锁说明 pid 文件是残留的，其中的 pid 可能已被其他进程复用
+                    return None
+            pid = int(f.read().strip())
+        if fcntl is None:
+            os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+def notify_scheduler():
+    """让正在运行的调度器重新加载追番列表和配置，返回是否已通知"""
+    pid = scheduler_pid()
+    if pid is None or not hasattr(signal, 'SIGHUP'):
+        return False
+    try:
+        os.kill(pid, signal.SIGHUP)
+    except OSError:
+        return False
+    return True
+
+
+def read_status():
+    """调度器状态：{'running', 'pid', 'next_run', 'titles', 'updated_at'}"""
+    status = read_json(STATUS_FILE, {})
+    pid = scheduler_pid()
+    return {**status, 'running': pid is not None and status.get('pid') == pid}
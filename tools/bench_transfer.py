@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地传输基准测试
+在独立进程中启动支持 Range 的本地 HTTP 服务器（可按连接限速，模拟 Seedr 对单连接的限速），
+用 download_bt 的下载函数下载随机数据文件，输出吞吐量或每 GB 消耗的 CPU 时间。
+命令行: python tools/bench_transfer.py segments [文件MB] [单连接限速MB/s] [连接数...]
+            多连接分段下载的吞吐量（默认 64 MB 文件、单连接 8 MB/s、1 / 4 / 8 个连接）
+        python tools/bench_transfer.py cpu [文件MB]
+            单连接下载每 GB 消耗的 CPU 时间（默认 512 MB 文件，不限速），
+            对比旧的传输循环（8 KB iter_content、每块打印进度）和 stream_to_fd
+        python tools/bench_transfer.py serve <文件> <端口> [单连接限速B/s]   （内部使用）
+"""
+
+import http.server
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import requests  # noqa: E402
+
+import download_bt  # noqa: E402
+
+MB = 1024 * 1024
+SEND_CHUNK = 64 * 1024
+
+def print_error(msg): print(f"❌ {msg}", file=sys.stderr)
+def print_info(msg): print(f"ℹ️ {msg}")
+def print_success(msg): print(f"✅ {msg}")
+
+
+class RangeFileHandler(http.server.BaseHTTPRequestHandler):
+    """只提供一个文件，支持 Range；rate 不为 0 时每个连接限速为 rate 字节/秒"""
+
+    protocol_version = 'HTTP/1.1'
+    path_to_serve = None
+    rate = 0
+
+    def do_GET(self):
+        size = os.path.getsize(self.path_to_serve)
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start, end = int(first), int(last) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        began = time.monotonic()
+        sent = 0
+        with open(self.path_to_serve, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left:
+                chunk = f.read(min(SEND_CHUNK, left))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                left -= len(chunk)
+                sent += len(chunk)
+                if self.rate:
+                    delay = began + sent / self.rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # 客户端关闭空闲的 keep-alive 连接不算错误
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(path, port, rate=0):
+    RangeFileHandler.path_to_serve = path
+    RangeFileHandler.rate = rate
+    QuietServer(('127.0.0.1', port), RangeFileHandler).serve_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_file(path, size):
+    with open(path, 'wb') as f:
+        for _ in range(size // MB):
+            f.write(os.urandom(MB))
+        f.write(os.urandom(size % MB))
+
+
+def start_server(path, rate=0):
+    """在子进程中启动服务器（服务器的 CPU 时间不计入下载进程），返回 (进程, 文件地址)"""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', path, str(port), str(rate)])
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, f'http://127.0.0.1:{port}/{os.path.basename(path)}'
+
+
+def run_quietly(func, *args, **kwargs):
+    """下载过程中的进度输出重定向到 /dev/null，避免终端输出影响结果"""
+    real_stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sys.stdout = real_stdout
+
+
+def bench_segments(size_mb=64, rate_mb=8, connection_counts=(1, 4, 8)):
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, 'source.bin')
+    size = size_mb * MB
+    make_file(source, size)
+    process, url = start_server(source, int(rate_mb * MB))
+    print_info(f"文件 {size_mb} MB，单连接限速 {rate_mb:g} MB/s")
+    try:
+        for connections in connection_counts:
+            target = os.path.join(tmp, f'segments_{connections}.bin')
+            settings = {'download_segments': connections, 'segment_min_size': 1, 'fsync': 'none'}
+            began = time.monotonic()
+            result = run_quietly(download_bt.download_file, url, target, size, settings)
+            elapsed = time.monotonic() - began
+            if result is None or os.path.getsize(target) != size:
+                print_error(f"{connections} 个连接: 下载失败")
+                continue
+            print_success(f"{connections} 个连接: {size / elapsed / MB:.1f} MB/s")
+            os.remove(target)
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(tmp)
+
+
+def legacy_download(url, save_path):
+    """旧的传输循环（用于对比）：8 KB iter_content，每块写入一次并打印一次进度"""
+    with requests.get(url, stream=True, timeout=download_bt.DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        total_size = int(r.headers.get('content-length', 0))
+        downloaded = 0
+        with open(save_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                if chunk:
+                    f.write(chunk)
+                    downloaded += len(chunk)
+                    if total_size > 0:
+                        progress = (downloaded / total_size) * 100
+                        print(f"\r进度: {progress:.1f}% ({downloaded/MB:.1f}/{total_size/MB:.1f} MB)", end='', flush=True)
+        print()
+    return {'status': 'unchecked'}
+
+
+def bench_cpu(size_mb=512):
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, 'source.bin')
+    size = size_mb * MB
+    make_file(source, size)
+    process, url = start_server(source)
+    print_info(f"文件 {size_mb} MB，进度输出到 /dev/null")
+    variants = [
+        ('旧循环 (8 KB iter_content，每块打印进度)', legacy_download, ()),
+        ('stream_to_fd (1 MB readinto，不计算哈希，fsync=end)', download_bt.download_url_to_file, (size, {})),
+        ('stream_to_fd (1 MB readinto，sha1，fsync=end)', download_bt.download_url_to_file,
+         (size, {'hash_algorithm': 'sha1'})),
+    ]
+    try:
+        for label, func, extra in variants:
+            target = os.path.join(tmp, 'target.bin')
+            began, cpu_began = time.monotonic(), time.process_time()
+            result = run_quietly(func, url, target, *extra)
+            cpu, elapsed = time.process_time() - cpu_began, time.monotonic() - began
+            if result is None or os.path.getsize(target) != size:
+                print_error(f"{label}: 下载失败")
+                continue
+            print_success(f"{label}: CPU {cpu / (size / 1024 ** 3):.2f} s/GB，{size / elapsed / MB:.0f} MB/s")
+            os.remove(target)
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(tmp)
+
+
+def main():
+    args = sys.argv[1:]
+    command = args[0] if args else 'segments'
+    if command == 'serve':
+        serve(args[1], int(args[2]), int(args[3]) if len(args) > 3 else 0)
+    elif command == 'segments':
+        size_mb = int(args[1]) if len(args) > 1 else 64
+        rate_mb = float(args[2]) if len(args) > 2 else 8
+        counts = [int(n) for n in args[3:]] or [1, 4, 8]
+        bench_segments(size_mb, rate_mb, counts)
+    elif command == 'cpu':
+        bench_cpu(int(args[1]) if len(args) > 1 else 512)
+    else:
+        print_error(f"未知命令: {command}（可用: segments, cpu）")
+
+
+if __name__ == "__main__":
+    main()